@@ -0,0 +1,500 @@
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '../utils'))
+import numpy as np
+import argparse
+import time
+import shutil
+import tracemalloc
+import h5py
+import torch
+
+from inference import PianoTranscription
+from utilities import (read_hdf5s_meta, get_waveform_store_paths, 
+    read_waveform_store_indexes)
+from data_generator import (Hdf5Pool, MemmapPool, MaestroDataset, Sampler, 
+    collate_fn, compact_collate_fn)
+from pytorch_utils import move_data_to_device, PinnedBatchBuffer
+from models import Regress_onset_offset_frame_velocity_CRNN, Regress_pedal_CRNN
+from losses import get_loss_func
+from features import get_waveform_layout, create_waveform_dataset
+import config
+
+
+def measure(func, *args, **kwargs):
+    """Run a function and measure its time and peak memory allocated by Python
+    and numpy during the call.
+
+    Returns:
+      output: output of func
+      run_time: float, seconds
+      peak_memory: int, bytes
+    """
+    tracemalloc.start()
+    run_time = time.time()
+    output = func(*args, **kwargs)
+    run_time = time.time() - run_time
+    (_, peak_memory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return output, run_time, peak_memory
+
+
+def legacy_enframe(audio, segment_samples):
+    """Padding and enframing of PianoTranscription.transcribe before they
+    were replaced by a strided view."""
+    audio = audio[None, :]
+    audio_len = audio.shape[1]
+    pad_len = int(np.ceil(audio_len / segment_samples)) * segment_samples - audio_len
+    audio = np.concatenate((audio, np.zeros((1, pad_len))), axis=1)
+
+    batch = []
+    pointer = 0
+    while pointer + segment_samples <= audio.shape[1]:
+        batch.append(audio[:, pointer : pointer + segment_samples])
+        pointer += segment_samples // 2
+
+    batch = np.concatenate(batch, axis=0)
+    return batch
+
+
+def legacy_deframe(batch_outputs):
+    """Concatenating mini-batch outputs in forward and deframing them before
+    they were replaced by a preallocated stitch buffer."""
+    x = np.concatenate(batch_outputs, axis=0)
+
+    if x.shape[0] == 1:
+        return x[0]
+
+    x = x[:, 0 : -1, :]
+    (N, segment_samples, classes_num) = x.shape
+    y = []
+    y.append(x[0, 0 : int(segment_samples * 0.75)])
+    for i in range(1, N - 1):
+        y.append(x[i, int(segment_samples * 0.25) : int(segment_samples * 0.75)])
+    y.append(x[-1, int(segment_samples * 0.25) :])
+    y = np.concatenate(y, axis=0)
+    return y
+
+
+def benchmark_enframe_deframe(args):
+    """Compare the time and peak memory of the legacy and the strided /
+    preallocated enframe and deframe on a long recording. The model is not
+    run, each mini-batch output of one head is simulated by a fresh array.
+
+    Args:
+      duration: float, seconds of audio
+      batch_size: int
+    """
+
+    # Arguments & parameters
+    duration = args.duration
+    batch_size = args.batch_size
+
+    sample_rate = config.sample_rate
+    segment_samples = sample_rate * 10
+    segment_frames = config.frames_per_second * 10 + 1
+    classes_num = config.classes_num
+
+    transcriptor = object.__new__(PianoTranscription)
+    """enframe and deframe do not use the model, so no checkpoint is loaded"""
+
+    audio = np.random.uniform(-0.1, 0.1, int(duration * sample_rate)).astype(np.float32)
+
+    def enframe(audio):
+        x = audio[None, :]
+        pad_len = int(np.ceil(x.shape[1] / segment_samples)) * segment_samples - x.shape[1]
+        x = np.concatenate((x, np.zeros((1, pad_len), dtype=x.dtype)), axis=1)
+        return transcriptor.enframe(x, segment_samples)
+
+    (legacy_segments, legacy_time, legacy_memory) = measure(legacy_enframe, audio, segment_samples)
+    (segments, new_time, new_memory) = measure(enframe, audio)
+    assert np.array_equal(legacy_segments, segments)
+    segments_num = len(segments)
+    del legacy_segments
+
+    print('Audio: {:.1f} s, {} segments'.format(duration, segments_num))
+    print('enframe: legacy {:.3f} s, {:.1f} MB | strided {:.3f} s, {:.1f} MB'.format(
+        legacy_time, legacy_memory / 1e6, new_time, new_memory / 1e6))
+
+    batch_output = np.random.uniform(0, 1, (batch_size, segment_frames, classes_num)).astype(np.float32)
+
+    def batch_outputs():
+        for pointer in range(0, segments_num, batch_size):
+            yield batch_output[0 : min(batch_size, segments_num - pointer)].copy()
+
+    def deframe():
+        y = None
+        for pointer, x in zip(range(0, segments_num, batch_size), batch_outputs()):
+            if y is None:
+                y = transcriptor.allocate_deframe_buffer(x, segments_num)
+            transcriptor.deframe_into(y, x, index=pointer, segments_num=segments_num)
+        return y
+
+    (legacy_y, legacy_time, legacy_memory) = measure(lambda: legacy_deframe(list(batch_outputs())))
+    (y, new_time, new_memory) = measure(deframe)
+    assert np.array_equal(legacy_y, y)
+
+    print('deframe per head: legacy {:.3f} s, {:.1f} MB | preallocated {:.3f} s, {:.1f} MB'.format(
+        legacy_time, legacy_memory / 1e6, new_time, new_memory / 1e6))
+
+
+def benchmark_waveform_read(args):
+    """Compare the throughput of reading random waveform segments from hdf5 
+    files and from memory-mapped waveform stores. Run it twice or drop the 
+    page cache in between to compare warm and cold reads.
+
+    Args:
+      workspace: str, directory of your workspace
+      split: 'train' | 'validation' | 'test'
+      reads_num: int
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    split = args.split
+    reads_num = args.reads_num
+
+    segment_samples = int(config.sample_rate * config.segment_seconds)
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', 'maestro')
+    waveforms_dir = os.path.join(workspace, 'waveforms', 'maestro')
+
+    waveform_index = read_waveform_store_indexes(waveforms_dir)
+    paths = [meta['path'] for meta in read_hdf5s_meta(hdf5s_dir) 
+        if meta['split'] == split and meta['path'] in waveform_index.keys()]
+
+    random_state = np.random.RandomState(1234)
+    reads = []
+    for path in random_state.choice(paths, size=reads_num):
+        (_, offset, samples_num) = waveform_index[path]
+        start_sample = random_state.randint(0, max(samples_num - segment_samples, 1))
+        reads.append((path, offset, start_sample))
+
+    (waveform_path, _) = get_waveform_store_paths(waveforms_dir, split)
+
+    def read_hdf5():
+        hdf5_pool = Hdf5Pool(log_interval=None)
+        for (path, offset, start_sample) in reads:
+            hf = hdf5_pool.get(os.path.join(hdf5s_dir, path))
+            hf['waveform'][start_sample : start_sample + segment_samples]
+        hdf5_pool.close()
+
+    def read_memmap():
+        memmap_pool = MemmapPool(log_interval=None)
+        for (path, offset, start_sample) in reads:
+            waveforms = memmap_pool.get(waveform_path)
+            np.array(waveforms[offset + start_sample : offset + start_sample + segment_samples])
+        memmap_pool.close()
+
+    megabytes = reads_num * segment_samples * 2 / 1e6
+    print('{} reads of {} samples from {} files'.format(reads_num, segment_samples, len(paths)))
+
+    for (name, func) in [('hdf5', read_hdf5), ('memmap', read_memmap)]:
+        run_time = time.time()
+        func()
+        run_time = time.time() - run_time
+        print('{}: {:.3f} s, {:.1f} reads/s, {:.1f} MB/s'.format(
+            name, run_time, reads_num / run_time, megabytes / run_time))
+
+
+def benchmark_waveform_layouts(args):
+    """Compare the disk footprint and the latency of reading random waveform 
+    segments of hdf5 layouts, i.e. contiguous, or chunked and optionally 
+    compressed waveforms. Waveforms of packed files are copied to each layout 
+    under benchmark_dir, which can be put on a local disk or on a network file 
+    system to compare them. Drop the page cache in between runs to compare 
+    cold reads.
+
+    Args:
+      workspace: str, directory of your workspace
+      split: 'train' | 'validation' | 'test'
+      files_num: int, number of packed files copied to each layout
+      reads_num: int
+      chunk_seconds: list of float
+      benchmark_dir: str, directory of the copies, removed after the benchmark
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    split = args.split
+    files_num = args.files_num
+    reads_num = args.reads_num
+    chunk_seconds_list = args.chunk_seconds
+
+    segment_samples = int(config.sample_rate * config.segment_seconds)
+    hop_samples = int(config.sample_rate * config.hop_seconds)
+
+    layouts = [('contiguous', get_waveform_layout(0, 'none'))]
+    for chunk_seconds in chunk_seconds_list:
+        for compression in ['none', 'lzf', 'shuffle_lzf', 'gzip', 'shuffle_gzip']:
+            layouts.append(('chunk_{}s_{}'.format(chunk_seconds, compression), 
+                get_waveform_layout(chunk_seconds, compression)))
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', 'maestro')
+
+    if args.benchmark_dir:
+        benchmark_dir = args.benchmark_dir
+    else:
+        benchmark_dir = os.path.join(workspace, 'benchmarks', 'waveform_layouts')
+
+    metas = [meta for meta in read_hdf5s_meta(hdf5s_dir) if meta['split'] == split]
+    random_state = np.random.RandomState(1234)
+    metas = [metas[n] for n in random_state.permutation(len(metas))[0 : files_num]]
+
+    reads = []
+    for n in random_state.randint(0, len(metas), size=reads_num):
+        samples_num = int(metas[n]['duration'] * config.sample_rate)
+        """Segments start at multiples of hop_samples as in the Sampler"""
+        start_sample = random_state.randint(0, max(samples_num - segment_samples, 0) // hop_samples + 1) * hop_samples
+        reads.append((n, start_sample))
+
+    print('{} reads of {} samples from {} files'.format(reads_num, segment_samples, len(metas)))
+    contiguous_size = None
+
+    for (name, layout) in layouts:
+        layout_dir = os.path.join(benchmark_dir, name)
+        os.makedirs(layout_dir, exist_ok=True)
+        paths = []
+
+        for (n, meta) in enumerate(metas):
+            with h5py.File(os.path.join(hdf5s_dir, meta['path']), 'r') as hf:
+                waveform = hf['waveform'][:]
+
+            paths.append(os.path.join(layout_dir, '{}.h5'.format(n)))
+            with h5py.File(paths[-1], 'w') as hf:
+                create_waveform_dataset(hf, waveform, layout)
+
+        size = sum([os.path.getsize(path) for path in paths])
+        if contiguous_size is None:
+            contiguous_size = size
+
+        hdf5_pool = Hdf5Pool(log_interval=None)
+        latencies = []
+
+        for (n, start_sample) in reads:
+            read_time = time.time()
+            hf = hdf5_pool.get(paths[n])
+            hf['waveform'][start_sample : start_sample + segment_samples]
+            latencies.append(time.time() - read_time)
+
+        hdf5_pool.close()
+        latencies = np.array(latencies) * 1000
+        shutil.rmtree(layout_dir)
+
+        print('{}: {:.1f} MB ({:.3f}x), latency mean {:.3f} ms, p50 {:.3f} ms, '
+            'p99 {:.3f} ms, {:.1f} reads/s'.format(name, size / 1e6, 
+            size / contiguous_size, np.mean(latencies), np.percentile(latencies, 50), 
+            np.percentile(latencies, 99), 1000 / np.mean(latencies)))
+
+
+def benchmark_collate(args):
+    """Compare the bytes and the time of collating a mini-batch and moving it 
+    to a device with float64 rolls by collate_fn and move_data_to_device, and 
+    with compact rolls by compact_collate_fn and PinnedBatchBuffer.
+
+    Args:
+      workspace: str, directory of your workspace
+      batch_size: int
+      repeats_num: int
+      cuda: bool
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    batch_size = args.batch_size
+    repeats_num = args.repeats_num
+    device = 'cuda' if args.cuda and torch.cuda.is_available() else 'cpu'
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', 'maestro')
+
+    def get_dataset(compact_rolls):
+        return MaestroDataset(hdf5s_dir=hdf5s_dir, 
+            segment_seconds=config.segment_seconds, 
+            frames_per_second=config.frames_per_second, 
+            compact_rolls=compact_rolls)
+
+    sampler = Sampler(hdf5s_dir=hdf5s_dir, split='train', 
+        segment_seconds=config.segment_seconds, hop_seconds=config.hop_seconds, 
+        batch_size=batch_size, mini_data=False)
+
+    metas = next(iter(sampler))
+    legacy_list_data_dict = [get_dataset(False)[meta] for meta in metas]
+    list_data_dict = [get_dataset(True)[meta] for meta in metas]
+
+    def legacy():
+        np_data_dict = collate_fn(legacy_list_data_dict)
+        device_data_dict = {key: move_data_to_device(np_data_dict[key], device) 
+            for key in np_data_dict.keys()}
+        return np_data_dict, device_data_dict
+
+    batch_buffer = PinnedBatchBuffer()
+
+    def compact():
+        batch_data_dict = compact_collate_fn(list_data_dict)
+        device_data_dict = batch_buffer.to_device(batch_data_dict, device)
+        return batch_data_dict, device_data_dict
+
+    (np_data_dict, legacy_device_dict) = legacy()
+    (batch_data_dict, device_data_dict) = compact()
+
+    for key in legacy_device_dict.keys():
+        assert torch.equal(legacy_device_dict[key], device_data_dict[key].float()), key
+
+    legacy_bytes = sum([x.nbytes for x in np_data_dict.values()])
+    legacy_move_bytes = sum([torch.Tensor(x).numel() * 4 for x in np_data_dict.values()])
+    """move_data_to_device converts float64 arrays to float32 before moving"""
+    compact_bytes = sum([x.numel() * x.element_size() for x in batch_data_dict.values()])
+
+    print('Batch size: {}, device: {}'.format(batch_size, device))
+    print('Collated: legacy {:.1f} MB | compact {:.1f} MB'.format(
+        legacy_bytes / 1e6, compact_bytes / 1e6))
+    print('Moved to device: legacy {:.1f} MB | compact {:.1f} MB'.format(
+        legacy_move_bytes / 1e6, compact_bytes / 1e6))
+
+    for (name, func) in [('legacy', legacy), ('compact', compact)]:
+        run_time = time.time()
+        for _ in range(repeats_num):
+            func()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        run_time = (time.time() - run_time) / repeats_num
+        print('{}: {:.2f} ms per mini-batch'.format(name, run_time * 1000))
+
+
+
+def benchmark_amp(args):
+    """Compare the throughput of float32 training steps and mixed precision 
+    training steps under autocast, float16 with a grad scaler on GPU and 
+    bfloat16 on CPU. Random waveforms and targets are used.
+
+    Args:
+      model_type: str
+      loss_type: str
+      batch_size: int
+      steps_num: int
+      cuda: bool
+    """
+
+    # Arguments & parameters
+    model_type = args.model_type
+    loss_type = args.loss_type
+    batch_size = args.batch_size
+    steps_num = args.steps_num
+    device = 'cuda' if args.cuda and torch.cuda.is_available() else 'cpu'
+
+    segment_samples = int(config.sample_rate * config.segment_seconds)
+    frames_num = int(config.frames_per_second * config.segment_seconds) + 1
+    amp_dtype = torch.float16 if device == 'cuda' else torch.bfloat16
+    loss_func = get_loss_func(loss_type)
+
+    target_dict = {
+        'waveform': torch.rand(batch_size, segment_samples) * 2 - 1}
+
+    for key in ['onset_roll', 'offset_roll', 'reg_onset_roll', 'reg_offset_roll', 
+        'frame_roll', 'velocity_roll', 'mask_roll']:
+        target_dict[key] = torch.rand(batch_size, frames_num, config.classes_num)
+
+    for key in ['pedal_onset_roll', 'pedal_offset_roll', 'reg_pedal_onset_roll', 
+        'reg_pedal_offset_roll', 'pedal_frame_roll']:
+        target_dict[key] = torch.rand(batch_size, frames_num)
+
+    target_dict['onset_roll'] = (target_dict['onset_roll'] > 0.9).float()
+    target_dict['velocity_roll'] *= 128
+    target_dict = {key: target_dict[key].to(device) for key in target_dict.keys()}
+
+    print('Model: {}, batch size: {}, device: {}'.format(model_type, batch_size, device))
+
+    for amp in [False, True]:
+        torch.manual_seed(1234)
+        Model = eval(model_type)
+        model = Model(frames_per_second=config.frames_per_second, 
+            classes_num=config.classes_num).to(device)
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        scaler = torch.amp.GradScaler(device, enabled=amp and amp_dtype == torch.float16)
+
+        def step():
+            with torch.autocast(device_type=device, dtype=amp_dtype, enabled=amp):
+                output_dict = model(target_dict['waveform'])
+            loss = loss_func(model, output_dict, target_dict)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            return loss
+
+        step()
+        """Warm up"""
+        
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+        run_time = time.time()
+        for _ in range(steps_num):
+            loss = step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        run_time = (time.time() - run_time) / steps_num
+
+        name = str(amp_dtype).replace('torch.', '') if amp else 'float32'
+        print('{}: {:.3f} s per step, {:.2f} steps/s, {:.1f} segments/s, '
+            'loss {:.4f}'.format(name, run_time, 1. / run_time, 
+            batch_size / run_time, loss.item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    parser_enframe_deframe = subparsers.add_parser('enframe_deframe')
+    parser_enframe_deframe.add_argument('--duration', type=float, default=3600., help='Seconds of audio.')
+    parser_enframe_deframe.add_argument('--batch_size', type=int, default=8)
+
+    parser_waveform_read = subparsers.add_parser('waveform_read')
+    parser_waveform_read.add_argument('--workspace', type=str, required=True)
+    parser_waveform_read.add_argument('--split', type=str, default='train')
+    parser_waveform_read.add_argument('--reads_num', type=int, default=2000)
+
+    parser_collate = subparsers.add_parser('collate')
+    parser_collate.add_argument('--workspace', type=str, required=True)
+    parser_collate.add_argument('--batch_size', type=int, default=12)
+    parser_collate.add_argument('--repeats_num', type=int, default=20)
+    parser_collate.add_argument('--cuda', action='store_true', default=False)
+
+    parser_waveform_layouts = subparsers.add_parser('waveform_layouts')
+    parser_waveform_layouts.add_argument('--workspace', type=str, required=True)
+    parser_waveform_layouts.add_argument('--split', type=str, default='train')
+    parser_waveform_layouts.add_argument('--files_num', type=int, default=10)
+    parser_waveform_layouts.add_argument('--reads_num', type=int, default=2000)
+    parser_waveform_layouts.add_argument('--chunk_seconds', type=float, nargs='+', default=[1., 10.], help='Chunks of the chunked layouts.')
+    parser_waveform_layouts.add_argument('--benchmark_dir', type=str, default='', help='Directory of the copies, e.g. on a network file system. Default is under the workspace.')
+
+    parser_amp = subparsers.add_parser('amp')
+    parser_amp.add_argument('--model_type', type=str, default='Regress_onset_offset_frame_velocity_CRNN')
+    parser_amp.add_argument('--loss_type', type=str, default='regress_onset_offset_frame_velocity_bce')
+    parser_amp.add_argument('--batch_size', type=int, default=12)
+    parser_amp.add_argument('--steps_num', type=int, default=5)
+    parser_amp.add_argument('--cuda', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.mode == 'enframe_deframe':
+        benchmark_enframe_deframe(args)
+
+    elif args.mode == 'waveform_read':
+        benchmark_waveform_read(args)
+
+    elif args.mode == 'collate':
+        benchmark_collate(args)
+
+    elif args.mode == 'waveform_layouts':
+        benchmark_waveform_layouts(args)
+
+    elif args.mode == 'amp':
+        benchmark_amp(args)
+
+    else:
+        raise Exception('Error argument!')
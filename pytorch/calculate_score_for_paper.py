@@ -15,7 +15,7 @@ from concurrent.futures import ProcessPoolExecutor
  
 from utilities import (create_folder, get_filename, traverse_folder, 
     int16_to_float32, note_to_freq, TargetProcessor, RegressionPostProcessor, 
-    OnsetsFramesPostProcessor)
+    OnsetsFramesPostProcessor, read_midi_events, read_hdf5s_meta)
 import config
 from inference import PianoTranscription
 
@@ -78,8 +78,8 @@ def infer_prob(args):
 
                 # Load audio                
                 audio = int16_to_float32(hf['waveform'][:])
-                midi_events = [e.decode() for e in hf['midi_event'][:]]
-                midi_events_time = hf['midi_event_time'][:]
+                (midi_events_time, midi_events, midi_events_active_bgn) = \
+                    read_midi_events(hf)
         
                 # Ground truths processor
                 target_processor = TargetProcessor(
@@ -91,7 +91,8 @@ def infer_prob(args):
                 (target_dict, note_events, pedal_events) = \
                     target_processor.process(start_time=0, 
                         midi_events_time=midi_events_time, 
-                        midi_events=midi_events, extend_pedal=True)
+                        midi_events=midi_events, extend_pedal=True, 
+                        midi_events_active_bgn=midi_events_active_bgn)
 
                 ref_on_off_pairs = np.array([[event['onset_time'], event['offset_time']] for event in note_events])
                 ref_midi_notes = np.array([event['midi_note'] for event in note_events])
@@ -142,7 +143,8 @@ class ScoreCalculator(object):
 
         self.post_processor_type = post_processor_type
         
-        (hdf5_names, self.hdf5_paths) = traverse_folder(hdf5s_dir)
+        self.hdf5s_dir = hdf5s_dir
+        self.hdf5s_meta = read_hdf5s_meta(hdf5s_dir)
 
     def __call__(self, params):
         """Calculate metrics of all songs.
@@ -162,11 +164,11 @@ class ScoreCalculator(object):
         n = 0
         list_args = []
 
-        for n, hdf5_path in enumerate(self.hdf5_paths):
-            with h5py.File(hdf5_path, 'r') as hf:
-                if hf.attrs['split'].decode() == self.split:
-                    list_args.append([n, hdf5_path, params])
-                    """e.g., [0, 'xx.h5', [0.3, 0.3, 0.3]]"""
+        for n, meta in enumerate(self.hdf5s_meta):
+            if meta['split'] == self.split:
+                hdf5_path = os.path.join(self.hdf5s_dir, meta['path'])
+                list_args.append([n, hdf5_path, params])
+                """e.g., [0, 'xx.h5', [0.3, 0.3, 0.3]]"""
            
         debug = False
         if debug:
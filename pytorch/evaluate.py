@@ -5,12 +5,13 @@ import numpy as np
 import torch
 import h5py
 import time
+import copy
+import threading
 import mir_eval
 import librosa
 import logging
-from sklearn import metrics
 
-from pytorch_utils import forward_dataloader
+from pytorch_utils import forward_dataloader_batches
 
 
 def mae(target, output, mask):
@@ -22,6 +23,156 @@ def mae(target, output, mask):
         return np.sum(np.abs(target - output)) / np.clip(np.sum(mask), 1e-8, np.inf)
 
 
+class AveragePrecisionAccumulator(object):
+    def __init__(self, bins_num=10000):
+        """Accumulate average precision (AP) over mini-batches in fixed memory. 
+        Outputs in [0, 1] are quantized to bins_num bins, and the positive and 
+        negative targets of each bin are counted per class. The AP equals 
+        average_precision_score of the flattened targets and outputs, up to 
+        the quantization of outputs.
+
+        Args:
+          bins_num: int
+        """
+        self.bins_num = bins_num
+        self.positive_counts = None
+        self.negative_counts = None
+        """(classes_num, bins_num)"""
+
+    def update(self, target, output):
+        """Count the targets and outputs of a mini-batch.
+
+        Args:
+          target: (..., classes_num), binary
+          output: (..., classes_num), in [0, 1]
+        """
+        classes_num = output.shape[-1]
+        target = np.asarray(target, dtype=np.float64).reshape(-1, classes_num)
+        output = np.asarray(output).reshape(-1, classes_num)
+
+        bins = np.clip((output * self.bins_num).astype(np.int64), 0, self.bins_num - 1)
+        indexes = (bins + np.arange(classes_num) * self.bins_num).flatten()
+        size = classes_num * self.bins_num
+
+        positive_counts = np.bincount(indexes, weights=target.flatten(), 
+            minlength=size).reshape(classes_num, self.bins_num)
+        negative_counts = np.bincount(indexes, weights=1. - target.flatten(), 
+            minlength=size).reshape(classes_num, self.bins_num)
+
+        if self.positive_counts is None:
+            self.positive_counts = positive_counts
+            self.negative_counts = negative_counts
+        else:
+            self.positive_counts += positive_counts
+            self.negative_counts += negative_counts
+
+    def merge(self, accumulator):
+        """Add the counts of another accumulator, e.g. of another rank."""
+        if accumulator.positive_counts is None:
+            return
+
+        if self.positive_counts is None:
+            self.positive_counts = accumulator.positive_counts.copy()
+            self.negative_counts = accumulator.negative_counts.copy()
+        else:
+            self.positive_counts += accumulator.positive_counts
+            self.negative_counts += accumulator.negative_counts
+
+    def result(self, per_class=False):
+        """
+        Args:
+          per_class: bool, return the AP of each class instead of the AP of 
+            all classes pooled
+
+        Returns:
+          ap: float | (classes_num,)
+        """
+        if per_class:
+            return np.array([get_binned_average_precision(self.positive_counts[k], 
+                self.negative_counts[k]) for k in range(len(self.positive_counts))])
+        else:
+            return get_binned_average_precision(
+                np.sum(self.positive_counts, axis=0), 
+                np.sum(self.negative_counts, axis=0))
+
+
+def get_binned_average_precision(positive_counts, negative_counts):
+    """AP from counts of positive and negative targets of output bins, where 
+    each bin is a threshold from high outputs to low outputs.
+
+    Args:
+      positive_counts: (bins_num,)
+      negative_counts: (bins_num,)
+
+    Returns:
+      ap: float
+    """
+    positive_counts = positive_counts[::-1]
+    true_positives = np.cumsum(positive_counts)
+    false_positives = np.cumsum(negative_counts[::-1])
+
+    if true_positives[-1] == 0:
+        return 0.
+
+    precisions = true_positives / np.clip(true_positives + false_positives, 1e-8, np.inf)
+    return np.sum(positive_counts * precisions) / true_positives[-1]
+
+
+class MaeAccumulator(object):
+    def __init__(self):
+        """Accumulate the mean absolute error (MAE) with mask over mini-batches, 
+        the same as mae of all mini-batches."""
+        self.error_sum = 0.
+        self.mask_sum = 0.
+
+    def update(self, target, output, mask):
+        """
+        Args:
+          target: (...)
+          output: (...)
+          mask: None | (...)
+        """
+        if mask is None:
+            self.error_sum += np.sum(np.abs(target - output))
+            self.mask_sum += target.size
+        else:
+            self.error_sum += np.sum(np.abs(target * mask - output * mask))
+            self.mask_sum += np.sum(mask)
+
+    def merge(self, accumulator):
+        """Add the sums of another accumulator, e.g. of another rank."""
+        self.error_sum += accumulator.error_sum
+        self.mask_sum += accumulator.mask_sum
+
+    def result(self):
+        return self.error_sum / np.clip(self.mask_sum, 1e-8, np.inf)
+
+
+def gather_accumulators(accumulators):
+    """Merge the accumulators of all ranks of a distributed evaluation. Every 
+    rank must call this function.
+
+    Args:
+      accumulators: dict, e.g. {'frame_ap': AveragePrecisionAccumulator, ...}
+
+    Returns:
+      accumulators: dict, merged accumulators of all ranks
+    """
+    list_accumulators = [None] * torch.distributed.get_world_size()
+    torch.distributed.all_gather_object(list_accumulators, accumulators)
+
+    accumulators = {}
+
+    for rank_accumulators in list_accumulators:
+        for key in rank_accumulators.keys():
+            if key in accumulators.keys():
+                accumulators[key].merge(rank_accumulators[key])
+            else:
+                accumulators[key] = rank_accumulators[key]
+
+    return accumulators
+
+
 class SegmentEvaluator(object):
     def __init__(self, model, batch_size):
         """Evaluate segment-wise metrics.
@@ -34,7 +185,8 @@ class SegmentEvaluator(object):
         self.batch_size = batch_size
 
     def evaluate(self, dataloader):
-        """Evaluate over a few mini-batches.
+        """Evaluate over a few mini-batches. Metrics are accumulated over 
+        mini-batches, so that outputs are not kept.
 
         Args:
           dataloader: object, used to generate mini-batches for evaluation.
@@ -47,61 +199,170 @@ class SegmentEvaluator(object):
             ...}
         """
 
+        accumulators = {}
+
+        for output_dict in forward_dataloader_batches(self.model, dataloader):
+            self.update(accumulators, output_dict)
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            accumulators = gather_accumulators(accumulators)
+            """Each rank forwards its own mini-batches of a TestSampler"""
+
         statistics = {}
-        output_dict = forward_dataloader(self.model, dataloader, self.batch_size)
-        
+
+        for key in accumulators.keys():
+            statistics[key] = np.around(accumulators[key].result(), decimals=4)
+
+        return statistics
+
+    def update(self, accumulators, output_dict):
+        """Update accumulators with the outputs and targets of a mini-batch.
+
+        Args:
+          accumulators: dict, accumulators are created at the first mini-batch
+          output_dict: dict, outputs and targets of a mini-batch
+        """
+
+        def accumulator(key, Accumulator):
+            if key not in accumulators.keys():
+                accumulators[key] = Accumulator()
+            return accumulators[key]
+
         # Frame and onset evaluation
         if 'frame_output' in output_dict.keys():
-            statistics['frame_ap'] = metrics.average_precision_score(
-                output_dict['frame_roll'].flatten(), 
-                output_dict['frame_output'].flatten(), average='macro')
+            accumulator('frame_ap', AveragePrecisionAccumulator).update(
+                output_dict['frame_roll'], output_dict['frame_output'])
         
         if 'onset_output' in output_dict.keys():
-            statistics['onset_macro_ap'] = metrics.average_precision_score(
-                output_dict['onset_roll'].flatten(), 
-                output_dict['onset_output'].flatten(), average='macro')
+            accumulator('onset_macro_ap', AveragePrecisionAccumulator).update(
+                output_dict['onset_roll'], output_dict['onset_output'])
 
         if 'offset_output' in output_dict.keys():
-            statistics['offset_ap'] = metrics.average_precision_score(
-                output_dict['offset_roll'].flatten(), 
-                output_dict['offset_output'].flatten(), average='macro')
+            accumulator('offset_ap', AveragePrecisionAccumulator).update(
+                output_dict['offset_roll'], output_dict['offset_output'])
 
         if 'reg_onset_output' in output_dict.keys():
             """Mask indictes only evaluate where either prediction or ground truth exists"""
             mask = (np.sign(output_dict['reg_onset_output'] + output_dict['reg_onset_roll'] - 0.01) + 1) / 2
-            statistics['reg_onset_mae'] = mae(output_dict['reg_onset_output'], 
-                output_dict['reg_onset_roll'], mask)
+            accumulator('reg_onset_mae', MaeAccumulator).update(
+                output_dict['reg_onset_output'], output_dict['reg_onset_roll'], mask)
 
         if 'reg_offset_output' in output_dict.keys():
             """Mask indictes only evaluate where either prediction or ground truth exists"""
             mask = (np.sign(output_dict['reg_offset_output'] + output_dict['reg_offset_roll'] - 0.01) + 1) / 2
-            statistics['reg_offset_mae'] = mae(output_dict['reg_offset_output'], 
-                output_dict['reg_offset_roll'], mask)
+            accumulator('reg_offset_mae', MaeAccumulator).update(
+                output_dict['reg_offset_output'], output_dict['reg_offset_roll'], mask)
 
         if 'velocity_output' in output_dict.keys():
             """Mask indictes only evaluate where onset exists"""
-            statistics['velocity_mae'] = mae(output_dict['velocity_output'], 
-                output_dict['velocity_roll'] / 128, output_dict['onset_roll'])
+            accumulator('velocity_mae', MaeAccumulator).update(
+                output_dict['velocity_output'], output_dict['velocity_roll'] / 128, 
+                output_dict['onset_roll'])
 
         if 'reg_pedal_onset_output' in output_dict.keys():
-            statistics['reg_pedal_onset_mae'] = mae(
+            accumulator('reg_pedal_onset_mae', MaeAccumulator).update(
                 output_dict['reg_pedal_onset_roll'].flatten(), 
                 output_dict['reg_pedal_onset_output'].flatten(), 
                 mask=None)
 
         if 'reg_pedal_offset_output' in output_dict.keys():
-            statistics['reg_pedal_offset_mae'] = mae(
+            accumulator('reg_pedal_offset_mae', MaeAccumulator).update(
                 output_dict['reg_pedal_offset_output'].flatten(), 
                 output_dict['reg_pedal_offset_roll'].flatten(), 
                 mask=None)
 
         if 'pedal_frame_output' in output_dict.keys():
-            statistics['pedal_frame_mae'] = mae(
+            accumulator('pedal_frame_mae', MaeAccumulator).update(
                 output_dict['pedal_frame_output'].flatten(), 
                 output_dict['pedal_frame_roll'].flatten(), 
                 mask=None)
 
-        for key in statistics.keys():
-            statistics[key] = np.around(statistics[key], decimals=4)
 
-        return statistics
\ No newline at end of file
+class AsyncEvaluator(object):
+    def __init__(self, model, batch_size, dataloaders):
+        """Evaluate snapshots of a model in a background thread while the 
+        model continues training. On GPU the evaluation runs on its own CUDA 
+        stream. One evaluation runs at a time.
+
+        Args:
+          model: object, the model being trained, not wrapped by DataParallel
+          batch_size: int
+          dataloaders: dict, e.g. {'train': object, 'validation': object, 
+            'test': object}
+        """
+        self.model = model
+        self.evaluate_model = copy.deepcopy(model)
+        self.evaluator = SegmentEvaluator(self.evaluate_model, batch_size)
+        self.dataloaders = dataloaders
+        self.device = next(model.parameters()).device
+
+        self.thread = None
+        self.result = None
+        self.error = None
+
+    def start(self, iteration):
+        """Snapshot the weights of the model and start evaluating them.
+
+        Args:
+          iteration: int
+        """
+        if self.thread is not None:
+            raise Exception('Get the result of the previous evaluation by poll '
+                'before starting a new one!')
+
+        self.evaluate_model.load_state_dict(self.model.state_dict())
+        
+        if self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            """The snapshot is copied on the current stream"""
+        else:
+            stream = None
+
+        self.thread = threading.Thread(target=self.evaluate, 
+            args=(iteration, stream), daemon=True)
+        self.thread.start()
+
+    def evaluate(self, iteration, stream):
+        try:
+            evaluate_bgn_time = time.time()
+            statistics_dict = {}
+
+            with torch.cuda.stream(stream):
+                """No-op if stream is None"""
+                for data_type in self.dataloaders.keys():
+                    statistics_dict[data_type] = self.evaluator.evaluate(
+                        self.dataloaders[data_type])
+
+            self.result = (iteration, statistics_dict, time.time() - evaluate_bgn_time)
+        except Exception as e:
+            self.error = e
+
+    def poll(self, wait=False):
+        """Get the result of the last evaluation if it has finished.
+
+        Args:
+          wait: bool, wait until the last evaluation finishes
+
+        Returns:
+          None | (iteration, statistics_dict, evaluate_time), where 
+            statistics_dict looks like {'train': statistics, 
+            'validation': statistics, 'test': statistics}
+        """
+        if self.thread is None:
+            return None
+
+        if wait:
+            self.thread.join()
+        elif self.thread.is_alive():
+            return None
+
+        self.thread = None
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+        (result, self.result) = (self.result, None)
+        return result
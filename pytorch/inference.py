@@ -13,16 +13,17 @@ import matplotlib.pyplot as plt
 import torch
  
 from utilities import (create_folder, get_filename, RegressionPostProcessor, 
-    OnsetsFramesPostProcessor, write_events_to_midi, load_audio)
+    OnsetsFramesPostProcessor, StreamingRegressionPostProcessor, 
+    write_events_to_midi, load_audio)
 from models import Note_pedal
-from pytorch_utils import move_data_to_device, forward
+from pytorch_utils import move_data_to_device, forward, get_inference_batch_size
 import config
 
 
 class PianoTranscription(object):
     def __init__(self, model_type, checkpoint_path=None, 
         segment_samples=16000*10, device=torch.device('cuda'), 
-        post_processor_type='regression'):
+        post_processor_type='regression', batch_size=1):
         """Class for transcribing piano solo recording.
 
         Args:
@@ -30,6 +31,12 @@ class PianoTranscription(object):
           checkpoint_path: str
           segment_samples: int
           device: 'cuda' | 'cpu'
+          post_processor_type: 'regression' | 'onsets_frames'
+          batch_size: int | 'auto', number of segments forwarded together. 
+            1: forward segments one by one, which is bit-identical to older 
+            versions. Larger batches and 'auto', which chooses from the 
+            available memory of device, are faster but not bit-exact, as 
+            batched kernels round differently.
         """
 
         if 'cuda' in str(device) and torch.cuda.is_available():
@@ -46,6 +53,10 @@ class PianoTranscription(object):
         self.frame_threshold = 0.1
         self.pedal_offset_threshold = 0.2
 
+        if batch_size == 'auto':
+            batch_size = get_inference_batch_size(self.device, segment_samples)
+        self.batch_size = batch_size
+
         # Build model
         Model = eval(model_type)
         self.model = Model(frames_per_second=self.frames_per_second, 
@@ -63,6 +74,8 @@ class PianoTranscription(object):
         else:
             print('Using CPU.')
 
+        print('Inference batch size: {}'.format(self.batch_size))
+
     def transcribe(self, audio, midi_path):
         """Transcribe an audio recording.
 
@@ -82,19 +95,36 @@ class PianoTranscription(object):
         pad_len = int(np.ceil(audio_len / self.segment_samples)) \
             * self.segment_samples - audio_len
 
-        audio = np.concatenate((audio, np.zeros((1, pad_len))), axis=1)
+        audio = np.concatenate((audio, np.zeros((1, pad_len), dtype=audio.dtype)), axis=1)
 
         # Enframe to segments
         segments = self.enframe(audio, self.segment_samples)
-        """(N, segment_samples)"""
+        """(N, segment_samples), a view of audio"""
+
+        # Forward and deframe each mini-batch into the output buffers
+        output_dict = {}
+        segments_num = len(segments)
+
+        for pointer in range(0, segments_num, self.batch_size):
+            batch_segments = np.ascontiguousarray(
+                segments[pointer : pointer + self.batch_size])
+            """Only a mini-batch of segments is copied out of the view"""
 
-        # Forward
-        output_dict = forward(self.model, segments, batch_size=1)
-        """{'reg_onset_output': (N, segment_frames, classes_num), ...}"""
+            batch_output_dict = forward(self.model, batch_segments, 
+                batch_size=self.batch_size)
+            """{'reg_onset_output': (batch_size, segment_frames, classes_num), ...}"""
+
+            for key in batch_output_dict.keys():
+                if key not in output_dict.keys():
+                    output_dict[key] = self.allocate_deframe_buffer(
+                        batch_output_dict[key], segments_num)
+
+                self.deframe_into(output_dict[key], batch_output_dict[key], 
+                    index=pointer, segments_num=segments_num)
 
         # Deframe to original length
         for key in output_dict.keys():
-            output_dict[key] = self.deframe(output_dict[key])[0 : audio_len]
+            output_dict[key] = output_dict[key][0 : audio_len]
         """output_dict: {
           'reg_onset_output': (segment_frames, classes_num), 
           'reg_offset_output': (segment_frames, classes_num), 
@@ -136,8 +166,144 @@ class PianoTranscription(object):
 
         return transcribed_dict
 
+    def transcribe_stream(self, audio_iter):
+        """Transcribe an audio stream block by block. Segments are forwarded 
+        as soon as they are filled, stitched with the same rule as deframe, 
+        and post processed incrementally, so the memory only depends on the 
+        segment length instead of the length of the recording. The events are 
+        the same as transcribe() up to the batch size effect of forward.
+
+        Args:
+          audio_iter: iterable of (block_samples,) audio blocks
+
+        Yields:
+          transcribed_dict, dict: {'est_note_events': ..., 
+            'est_pedal_events': ...}, events finalized after each block
+        """
+
+        if self.post_processor_type != 'regression':
+            raise Exception('transcribe_stream only supports the regression post processor!')
+
+        post_processor = StreamingRegressionPostProcessor(self.frames_per_second, 
+            classes_num=self.classes_num, onset_threshold=self.onset_threshold, 
+            offset_threshold=self.offset_threshod, 
+            frame_threshold=self.frame_threshold, 
+            pedal_offset_threshold=self.pedal_offset_threshold)
+
+        hop_samples = self.segment_samples // 2
+        buffer = np.zeros(0, dtype=np.float32)
+        audio_len = 0
+        segments_num = 0
+        last_output_dict = None
+        """Output of the latest segment. It is stitched when the next segment 
+        arrives because the last segment of a recording keeps its tail."""
+
+        for audio in audio_iter:
+            buffer = np.concatenate((buffer, np.asarray(audio, dtype=np.float32)))
+            audio_len += len(audio)
+
+            segments = []
+            while len(buffer) >= self.segment_samples:
+                segments.append(buffer[0 : self.segment_samples])
+                buffer = buffer[hop_samples :]
+
+            if segments:
+                (output_dict, last_output_dict) = self.stitch_segments(
+                    np.stack(segments, axis=0), last_output_dict, segments_num)
+                segments_num += len(segments)
+
+                if output_dict:
+                    yield self.stream_events(post_processor, output_dict, final=False)
+
+        if audio_len == 0:
+            return
+
+        # Pad audio to be evenly divided by segment_samples
+        pad_len = int(np.ceil(audio_len / self.segment_samples)) \
+            * self.segment_samples - audio_len
+        buffer = np.concatenate((buffer, np.zeros(pad_len, dtype=np.float32)))
+
+        segments = []
+        while len(buffer) >= self.segment_samples:
+            segments.append(buffer[0 : self.segment_samples])
+            buffer = buffer[hop_samples :]
+
+        if segments:
+            (output_dict, last_output_dict) = self.stitch_segments(
+                np.stack(segments, axis=0), last_output_dict, segments_num)
+            segments_num += len(segments)
+        else:
+            output_dict = {}
+
+        # The last segment
+        for key in last_output_dict.keys():
+            if segments_num == 1:
+                tail = last_output_dict[key]
+            else:
+                segment_frames = last_output_dict[key].shape[0] - 1
+                tail = last_output_dict[key][int(segment_frames * 0.25) : -1]
+
+            if key in output_dict.keys():
+                output_dict[key] = np.concatenate((output_dict[key], tail), axis=0)
+            else:
+                output_dict[key] = tail
+
+        yield self.stream_events(post_processor, output_dict, final=True)
+
+    def stitch_segments(self, segments, last_output_dict, segments_num):
+        """Forward new segments of a stream and stitch the finished ones with
+        the same rule as deframe.
+
+        Args:
+          segments: (N, segment_samples)
+          last_output_dict: dict | None, output of the latest forwarded segment
+          segments_num: int, number of segments forwarded before
+
+        Returns:
+          output_dict: dict, stitched frames, e.g. {
+            'reg_onset_output': (frames_num, classes_num), ...}
+          last_output_dict: dict, output of the latest forwarded segment
+        """
+        segments_dict = forward(self.model, segments, batch_size=self.batch_size)
+        """{'reg_onset_output': (N, segment_frames + 1, classes_num), ...}"""
+
+        output_dict = {key: [] for key in segments_dict.keys()}
+
+        for n in range(len(segments)):
+            if last_output_dict is not None:
+                for key in segments_dict.keys():
+                    x = last_output_dict[key]
+                    segment_frames = x.shape[0] - 1
+                    if segments_num + n == 1:
+                        """The first segment of the stream"""
+                        output_dict[key].append(x[0 : int(segment_frames * 0.75)])
+                    else:
+                        output_dict[key].append(x[int(segment_frames * 0.25) : int(segment_frames * 0.75)])
+
+            last_output_dict = {key: segments_dict[key][n] for key in segments_dict.keys()}
+
+        for key in list(output_dict.keys()):
+            if output_dict[key]:
+                output_dict[key] = np.concatenate(output_dict[key], axis=0)
+            else:
+                del output_dict[key]
+
+        return output_dict, last_output_dict
+
+    def stream_events(self, post_processor, output_dict, final):
+        """Post process stitched frames of a stream to finalized events."""
+        (est_note_events, est_pedal_events) = post_processor.process(
+            output_dict, final=final)
+
+        transcribed_dict = {
+            'est_note_events': est_note_events,
+            'est_pedal_events': est_pedal_events}
+
+        return transcribed_dict
+
     def enframe(self, x, segment_samples):
-        """Enframe long sequence to short segments.
+        """Enframe long sequence to short segments with 50% overlap. The 
+        segments are a read-only strided view of x, so no audio is copied.
 
         Args:
           x: (1, audio_samples)
@@ -147,14 +313,13 @@ class PianoTranscription(object):
           batch: (N, segment_samples)
         """
         assert x.shape[1] % segment_samples == 0
-        batch = []
+        hop_samples = segment_samples // 2
+        segments_num = (x.shape[1] - segment_samples) // hop_samples + 1
 
-        pointer = 0
-        while pointer + segment_samples <= x.shape[1]:
-            batch.append(x[:, pointer : pointer + segment_samples])
-            pointer += segment_samples // 2
+        batch = np.lib.stride_tricks.as_strided(x[0], 
+            shape=(segments_num, segment_samples), 
+            strides=(hop_samples * x.strides[1], x.strides[1]), writeable=False)
 
-        batch = np.concatenate(batch, axis=0)
         return batch
 
     def deframe(self, x):
@@ -166,23 +331,68 @@ class PianoTranscription(object):
         Returns:
           y: (audio_frames, classes_num)
         """
-        if x.shape[0] == 1:
-            return x[0]
+        y = self.allocate_deframe_buffer(x, segments_num=x.shape[0])
+        self.deframe_into(y, x, index=0, segments_num=x.shape[0])
+        return y
 
+    def allocate_deframe_buffer(self, x, segments_num):
+        """Allocate the output of deframe.
+
+        Args:
+          x: (batch_size, segment_frames, classes_num), predicted segments
+          segments_num: int, number of segments of the whole sequence
+
+        Returns:
+          y: (audio_frames, classes_num)
+        """
+        if segments_num == 1:
+            frames_num = x.shape[1]
         else:
-            x = x[:, 0 : -1, :]
-            """Remove an extra frame in the end of each segment caused by the
-            'center=True' argument when calculating spectrogram."""
-            (N, segment_samples, classes_num) = x.shape
-            assert segment_samples % 4 == 0
+            frames_num = (segments_num + 1) * ((x.shape[1] - 1) // 2)
+
+        return np.zeros((frames_num,) + x.shape[2 :], dtype=x.dtype)
+
+    def deframe_into(self, y, x, index, segments_num):
+        """Write predicted segments to their place of the original sequence. 
+        The first segment keeps its first 75% frames, the last segment keeps 
+        its last 75% frames, and the other segments keep their middle 50% 
+        frames.
+
+        Args:
+          y: (audio_frames, classes_num), output of allocate_deframe_buffer
+          x: (batch_size, segment_frames, classes_num), predicted segments
+          index: int, index of x[0] among all segments
+          segments_num: int, number of segments of the whole sequence
+        """
+        if segments_num == 1:
+            y[:] = x[0]
+            return
+
+        x = x[:, 0 : -1]
+        """Remove an extra frame in the end of each segment caused by the
+        'center=True' argument when calculating spectrogram."""
+        segment_frames = x.shape[1]
+        assert segment_frames % 4 == 0
+        quarter = segment_frames // 4
+        hop = segment_frames // 2
+
+        (bgn, fin) = (0, len(x))
+
+        if index == 0:
+            """First segment"""
+            y[0 : 3 * quarter] = x[0, 0 : 3 * quarter]
+            bgn = 1
+
+        if index + len(x) == segments_num:
+            """Last segment"""
+            n = segments_num - 1
+            y[n * hop + quarter : n * hop + segment_frames] = x[-1, quarter :]
+            fin = len(x) - 1
 
-            y = []
-            y.append(x[0, 0 : int(segment_samples * 0.75)])
-            for i in range(1, N - 1):
-                y.append(x[i, int(segment_samples * 0.25) : int(segment_samples * 0.75)])
-            y.append(x[-1, int(segment_samples * 0.25) :])
-            y = np.concatenate(y, axis=0)
-            return y
+        if fin > bgn:
+            """Middle segments are contiguous in y"""
+            y[(index + bgn) * hop + quarter : (index + fin) * hop + quarter] = \
+                x[bgn : fin, quarter : 3 * quarter].reshape((-1,) + x.shape[2 :])
 
 
 def inference(args):
@@ -196,6 +406,11 @@ def inference(args):
         with Googl's onsets and frames system.
       audio_path: str
       cuda: bool
+      batch_size: int | 'auto', number of segments forwarded together. 1 is 
+        bit-identical to older versions. 'auto' chooses from the available 
+        memory and is not bit-exact.
+      res_type: str, resampling method of load_audio. 'polyphase' is the 
+        fastest and decodes and resamples block by block.
     """
 
     # Arugments & parameters
@@ -204,6 +419,8 @@ def inference(args):
     post_processor_type = args.post_processor_type
     device = 'cuda' if args.cuda and torch.cuda.is_available() else 'cpu'
     audio_path = args.audio_path
+    batch_size = args.batch_size if args.batch_size == 'auto' else int(args.batch_size)
+    res_type = args.res_type
     
     sample_rate = config.sample_rate
     segment_samples = sample_rate * 10  
@@ -214,12 +431,13 @@ def inference(args):
     create_folder(os.path.dirname(midi_path))
  
     # Load audio
-    (audio, _) = load_audio(audio_path, sr=sample_rate, mono=True)
+    (audio, _) = load_audio(audio_path, sr=sample_rate, mono=True, 
+        res_type=res_type)
 
     # Transcriptor
     transcriptor = PianoTranscription(model_type, device=device, 
         checkpoint_path=checkpoint_path, segment_samples=segment_samples, 
-        post_processor_type=post_processor_type)
+        post_processor_type=post_processor_type, batch_size=batch_size)
 
     # Transcribe and write out to MIDI file
     transcribe_time = time.time()
@@ -258,6 +476,8 @@ if __name__ == '__main__':
     parser.add_argument('--post_processor_type', type=str, default='regression', choices=['onsets_frames', 'regression'])
     parser.add_argument('--audio_path', type=str, required=True)
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--batch_size', type=str, default='1', help="Number of segments forwarded together, or 'auto' to choose from the available memory. Only 1 is bit-identical to older versions.")
+    parser.add_argument('--res_type', type=str, default='kaiser_best', choices=['kaiser_best', 'kaiser_fast', 'polyphase'], help='Resampling method of the input audio.')
 
     args = parser.parse_args()
     inference(args)
\ No newline at end of file
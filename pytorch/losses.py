@@ -4,22 +4,53 @@ import torch.nn.functional as F
 
 def bce(output, target, mask):
     """Binary crossentropy (BCE) with mask. The positions where mask=0 will be 
-    deactivated when calculation BCE.
+    deactivated when calculation BCE. Targets and masks can be compact uint8 
+    rolls, which are expanded to float here on the device. Outputs are cast to 
+    float32, so that 1 - eps is not rounded to 1 under float16 / bfloat16 
+    autocast.
     """
+    output = output.float()
+    target = target.float()
+    mask = mask.float()
     eps = 1e-7
     output = torch.clamp(output, eps, 1. - eps)
     matrix = - target * torch.log(output) - (1. - target) * torch.log(1. - output)
     return torch.sum(matrix * mask) / torch.sum(mask)
 
+
+def bce_with_logits(logits, target, mask):
+    """BCE with mask on logits, the sigmoid is fused into the loss, which is 
+    numerically safe under float16 / bfloat16 autocast.
+    """
+    target = target.float()
+    mask = mask.float()
+    matrix = F.binary_cross_entropy_with_logits(logits.float(), target, reduction='none')
+    return torch.sum(matrix * mask) / torch.sum(mask)
+
+
+def output_bce(output_dict, key, target, mask=None):
+    """BCE of an output of a model, e.g. 'frame_output'. It is calculated from 
+    the logits of the output, e.g. 'frame_logits', if the model returns them.
+    """
+    logits_key = key.replace('_output', '_logits')
+
+    if mask is None:
+        mask = torch.ones_like(target)
+
+    if logits_key in output_dict.keys():
+        return bce_with_logits(output_dict[logits_key], target, mask)
+    else:
+        return bce(output_dict[key], target, mask)
+
 ############ High-resolution regression loss ############
 def regress_onset_offset_frame_velocity_bce(model, output_dict, target_dict):
     """High-resolution piano note regression loss, including onset regression, 
     offset regression, velocity regression and frame-wise classification losses.
     """
-    onset_loss = bce(output_dict['reg_onset_output'], target_dict['reg_onset_roll'], target_dict['mask_roll'])
-    offset_loss = bce(output_dict['reg_offset_output'], target_dict['reg_offset_roll'], target_dict['mask_roll'])
-    frame_loss = bce(output_dict['frame_output'], target_dict['frame_roll'], target_dict['mask_roll'])
-    velocity_loss = bce(output_dict['velocity_output'], target_dict['velocity_roll'] / 128, target_dict['onset_roll'])
+    onset_loss = output_bce(output_dict, 'reg_onset_output', target_dict['reg_onset_roll'], target_dict['mask_roll'])
+    offset_loss = output_bce(output_dict, 'reg_offset_output', target_dict['reg_offset_roll'], target_dict['mask_roll'])
+    frame_loss = output_bce(output_dict, 'frame_output', target_dict['frame_roll'], target_dict['mask_roll'])
+    velocity_loss = output_bce(output_dict, 'velocity_output', target_dict['velocity_roll'].float() / 128, target_dict['onset_roll'])
     total_loss = onset_loss + offset_loss + frame_loss + velocity_loss
     return total_loss
 
@@ -28,9 +59,9 @@ def regress_pedal_bce(model, output_dict, target_dict):
     """High-resolution piano pedal regression loss, including pedal onset 
     regression, pedal offset regression and pedal frame-wise classification losses.
     """
-    onset_pedal_loss = F.binary_cross_entropy(output_dict['reg_pedal_onset_output'], target_dict['reg_pedal_onset_roll'][:, :, None])
-    offset_pedal_loss = F.binary_cross_entropy(output_dict['reg_pedal_offset_output'], target_dict['reg_pedal_offset_roll'][:, :, None])
-    frame_pedal_loss = F.binary_cross_entropy(output_dict['pedal_frame_output'], target_dict['pedal_frame_roll'][:, :, None])
+    onset_pedal_loss = output_bce(output_dict, 'reg_pedal_onset_output', target_dict['reg_pedal_onset_roll'][:, :, None])
+    offset_pedal_loss = output_bce(output_dict, 'reg_pedal_offset_output', target_dict['reg_pedal_offset_roll'][:, :, None])
+    frame_pedal_loss = output_bce(output_dict, 'pedal_frame_output', target_dict['pedal_frame_roll'][:, :, None])
     total_loss = onset_pedal_loss + offset_pedal_loss + frame_pedal_loss
     return total_loss
 
@@ -38,10 +69,10 @@ def regress_pedal_bce(model, output_dict, target_dict):
 def google_onset_offset_frame_velocity_bce(model, output_dict, target_dict):
     """Google's onsets and frames system piano note loss. Only used for comparison.
     """
-    onset_loss = bce(output_dict['reg_onset_output'], target_dict['onset_roll'], target_dict['mask_roll'])
-    offset_loss = bce(output_dict['reg_offset_output'], target_dict['offset_roll'], target_dict['mask_roll'])
-    frame_loss = bce(output_dict['frame_output'], target_dict['frame_roll'], target_dict['mask_roll'])
-    velocity_loss = bce(output_dict['velocity_output'], target_dict['velocity_roll'] / 128, target_dict['onset_roll'])
+    onset_loss = output_bce(output_dict, 'reg_onset_output', target_dict['onset_roll'], target_dict['mask_roll'])
+    offset_loss = output_bce(output_dict, 'reg_offset_output', target_dict['offset_roll'], target_dict['mask_roll'])
+    frame_loss = output_bce(output_dict, 'frame_output', target_dict['frame_roll'], target_dict['mask_roll'])
+    velocity_loss = output_bce(output_dict, 'velocity_output', target_dict['velocity_roll'].float() / 128, target_dict['onset_roll'])
     total_loss = onset_loss + offset_loss + frame_loss + velocity_loss
     return total_loss
 
@@ -49,9 +80,9 @@ def google_onset_offset_frame_velocity_bce(model, output_dict, target_dict):
 def google_pedal_bce(model, output_dict, target_dict):
     """Google's onsets and frames system piano pedal loss. Only used for comparison.
     """
-    onset_pedal_loss = F.binary_cross_entropy(output_dict['reg_pedal_onset_output'], target_dict['pedal_onset_roll'][:, :, None])
-    offset_pedal_loss = F.binary_cross_entropy(output_dict['reg_pedal_offset_output'], target_dict['pedal_offset_roll'][:, :, None])
-    frame_pedal_loss = F.binary_cross_entropy(output_dict['pedal_frame_output'], target_dict['pedal_frame_roll'][:, :, None])
+    onset_pedal_loss = output_bce(output_dict, 'reg_pedal_onset_output', target_dict['pedal_onset_roll'][:, :, None])
+    offset_pedal_loss = output_bce(output_dict, 'reg_pedal_offset_output', target_dict['pedal_offset_roll'][:, :, None])
+    frame_pedal_loss = output_bce(output_dict, 'pedal_frame_output', target_dict['pedal_frame_roll'][:, :, None])
     total_loss = onset_pedal_loss + offset_pedal_loss + frame_pedal_loss
     return total_loss
 
@@ -19,16 +19,120 @@ import torch.utils.data
 
 from utilities import (create_folder, get_filename, create_logging, 
     StatisticsContainer, RegressionPostProcessor) 
-from data_generator import MaestroDataset, Augmentor, Sampler, TestSampler, collate_fn
+from data_generator import (MaestroDataset, Augmentor, Sampler, 
+    DistributedSampler, TestSampler, collate_fn, compact_collate_fn, 
+    worker_init_fn)
 from models import Regress_onset_offset_frame_velocity_CRNN, Regress_pedal_CRNN, Regress_onset_offset_frame_velocity_S4
-from pytorch_utils import move_data_to_device
+from pytorch_utils import (move_data_to_device, BatchAugmentor, 
+    PinnedBatchBuffer, CheckpointSaver)
 from losses import get_loss_func
-from evaluate import SegmentEvaluator
+from evaluate import SegmentEvaluator, AsyncEvaluator
 import config
 
 import wandb
 
-torch.autograd.set_detect_anomaly(True)
+
+def get_random_states(device, batch_augmentor):
+    """Get the global random states of numpy and torch, and the random state 
+    of batch_augmentor, of this process.
+
+    Args:
+      device: 'cuda' | 'cpu'
+      batch_augmentor: None | BatchAugmentor
+
+    Returns:
+      random_states: dict
+    """
+    random_states = {
+        'numpy': np.random.get_state(), 
+        'torch': torch.get_rng_state()}
+
+    if device == 'cuda':
+        random_states['cuda'] = torch.cuda.get_rng_state_all()
+
+    if batch_augmentor:
+        random_states['batch_augmentor'] = batch_augmentor.random_state.get_state()
+
+    return random_states
+
+
+def set_random_states(random_states, device, batch_augmentor):
+    """Set the random states returned by get_random_states."""
+    np.random.set_state(random_states['numpy'])
+    torch.set_rng_state(random_states['torch'].cpu())
+
+    if device == 'cuda' and 'cuda' in random_states.keys():
+        torch.cuda.set_rng_state_all([state.cpu() for state in random_states['cuda']])
+
+    if batch_augmentor and 'batch_augmentor' in random_states.keys():
+        batch_augmentor.random_state.set_state(random_states['batch_augmentor'])
+
+
+def gather_random_states(device, batch_augmentor, distributed):
+    """Gather the random states of all ranks. Every rank must call this 
+    function.
+
+    Returns:
+      rank_random_states: list, random states of each rank
+    """
+    random_states = get_random_states(device, batch_augmentor)
+
+    if distributed:
+        rank_random_states = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(rank_random_states, random_states)
+    else:
+        rank_random_states = [random_states]
+
+    return rank_random_states
+
+
+def log_statistics(statistics_container, iteration, statistics_dict, rank, step):
+    """Log evaluation statistics to the logs, the statistics container and 
+    weights & biases.
+
+    Args:
+      statistics_container: StatisticsContainer
+      iteration: int, iteration of the evaluated weights
+      statistics_dict: dict, {'train': statistics, 'validation': statistics, 
+        'test': statistics}
+      rank: int, only rank 0 dumps the statistics
+      step: int, step of weights & biases, the current training iteration. 
+        W&B drops logs with steps behind its last step, so results of earlier 
+        iterations are logged at the current step and plotted against 
+        evaluate_iteration
+    """
+    prefixes = {'train': 'train_', 'validation': 'val_', 'test': 'test_'}
+
+    for data_type in ['train', 'validation', 'test']:
+        logging.info('    {} statistics: {}'.format(data_type.capitalize(), 
+            statistics_dict[data_type]))
+
+    for data_type in ['train', 'validation', 'test']:
+        statistics_container.append(iteration, statistics_dict[data_type], 
+            data_type=data_type)
+
+    if rank == 0:
+        statistics_container.dump()
+
+    # Log statistics to weights & biases
+    for data_type in ['train', 'validation', 'test']:
+        statistics = {prefixes[data_type] + k: v for k, v in 
+            statistics_dict[data_type].items()}
+        statistics['evaluate_iteration'] = iteration
+        wandb.log(statistics, step=step)
+
+
+def log_async_result(statistics_container, result, step):
+    """Log the result of an AsyncEvaluator at the W&B step of the current 
+    training iteration."""
+    (iteration, statistics_dict, evaluate_time) = result
+
+    logging.info('------------------------------------')
+    logging.info('Finished evaluating iteration {}'.format(iteration))
+    log_statistics(statistics_container, iteration, statistics_dict, 
+        rank=0, step=step)
+    logging.info('Evaluate time: {:.3f} s'.format(evaluate_time))
+
 
 def train(args):
     """Train a piano transcription system.
@@ -37,14 +141,39 @@ def train(args):
       workspace: str, directory of your workspace
       model_type: str, e.g. 'Regressonset_regressoffset_frame_velocity_CRNN'
       loss_type: str, e.g. 'regress_onset_offset_frame_velocity_bce'
-      augmentation: str, e.g. 'none'
-      batch_size: int
+      augmentation: 'none' | 'aug' | 'batch_aug', 'aug' augments each segment 
+        by sox in the DataLoader workers, 'batch_aug' augments each mini-batch 
+        on the device by BatchAugmentor
+      batch_size: int, total over the ranks of distributed training
       learning_rate: float
       reduce_iteration: int
       resume_iteration: int
       early_stop: int
       device: 'cuda' | 'cpu'
       mini_data: bool
+      max_open_hdf5s: int, number of hdf5 files kept open by each worker
+      target_cache: bool, slice targets from the caches built by features.py 
+        build_target_caches
+      storage: 'hdf5' | 'memmap', read waveforms from hdf5 files or from the 
+        waveform stores written by features.py write_waveform_stores
+      pitch_shift_stores: bool, read pitch shifted waveforms from the stores 
+        written by features.py write_pitch_shifted_stores, used with memmap 
+        storage
+      legacy_rolls: bool, collate float64 target rolls by collate_fn as 
+        before compact rolls, for comparing with earlier runs
+      amp: bool, mixed precision training by autocast, float16 with a grad 
+        scaler on GPU and bfloat16 on CPU
+      debug_anomaly: bool, detect anomalies in backward passes, which makes 
+        them much slower
+      async_evaluate: bool, evaluate snapshots of the weights in a background 
+        thread while training continues, statistics are logged when each 
+        evaluation finishes
+      max_evaluate_iteration: int, number of mini-batches of each evaluation
+
+    Launched by torchrun with more than one process, e.g. 
+    torchrun --nproc_per_node=4 pytorch/main.py train ..., each process trains 
+    a DistributedDataParallel replica on its own shard of the data, with the 
+    nccl backend on GPUs and the gloo backend on CPUs.
     """
 
     # Arugments & parameters
@@ -60,6 +189,15 @@ def train(args):
     early_stop = args.early_stop
     device = torch.device('cuda') if args.cuda and torch.cuda.is_available() else torch.device('cpu')
     mini_data = args.mini_data
+    max_open_hdf5s = args.max_open_hdf5s
+    target_cache = args.target_cache
+    storage = args.storage
+    pitch_shift_stores = args.pitch_shift_stores
+    legacy_rolls = args.legacy_rolls
+    amp = args.amp
+    debug_anomaly = args.debug_anomaly
+    async_evaluate = args.async_evaluate
+    max_evaluate_iteration = args.max_evaluate_iteration
     filename = args.filename
 
     sample_rate = config.sample_rate
@@ -70,12 +208,49 @@ def train(args):
     classes_num = config.classes_num
     num_workers = 8 # TODO(jxm): configure automatically
 
+    # Distributed
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    distributed = world_size > 1
+    """WORLD_SIZE, RANK and LOCAL_RANK are set by torchrun"""
+
+    if distributed:
+        rank = int(os.environ['RANK'])
+        local_rank = int(os.environ['LOCAL_RANK'])
+
+        if 'cuda' in str(device):
+            torch.cuda.set_device(local_rank)
+            device = torch.device('cuda', local_rank)
+            backend = 'nccl'
+        else:
+            backend = 'gloo'
+
+        torch.distributed.init_process_group(backend=backend)
+    else:
+        rank = 0
+
+    if batch_size % world_size != 0:
+        raise Exception('batch_size {} is not divisible by {} ranks!'.format(
+            batch_size, world_size))
+
+    rank_batch_size = batch_size // world_size
+
+    if distributed and async_evaluate:
+        raise Exception('async_evaluate is not supported in distributed '
+            'training, where evaluation is gathered across ranks!')
+
     # Loss function
     loss_func = get_loss_func(loss_type)
 
     # Paths
     hdf5s_dir = os.path.join(workspace, 'hdf5s', 'maestro')
 
+    if target_cache:
+        target_caches_dir = os.path.join(workspace, 'target_caches', 'maestro')
+    else:
+        target_caches_dir = None
+
+    waveforms_dir = os.path.join(workspace, 'waveforms', 'maestro')
+
     checkpoints_dir = os.path.join(workspace, 'checkpoints', filename, 
         model_type, 'loss_type={}'.format(loss_type), 
         'augmentation={}'.format(augmentation), 
@@ -97,7 +272,8 @@ def train(args):
         'batch_size={}'.format(batch_size))
     create_folder(logs_dir)
 
-    create_logging(logs_dir, filemode='w')
+    if rank == 0:
+        create_logging(logs_dir, filemode='w')
     logging.info(args)
 
     if 'cuda' in str(device):
@@ -107,61 +283,94 @@ def train(args):
         logging.info('Using CPU.')
         device = 'cpu'
     
+    if debug_anomaly:
+        torch.autograd.set_detect_anomaly(True)
+
+    # Mixed precision
+    amp_dtype = torch.float16 if device == 'cuda' else torch.bfloat16
+    scaler = torch.amp.GradScaler(device, enabled=amp and amp_dtype == torch.float16)
+    """bfloat16 has the range of float32 and needs no loss scaling"""
+
     # Model
     Model = eval(model_type)
     model = Model(frames_per_second=frames_per_second, classes_num=classes_num)
     print('model:', model)
 
+    batch_augmentor = None
+
     if augmentation == 'none':
         augmentor = None
     elif augmentation == 'aug':
         augmentor = Augmentor()
+    elif augmentation == 'batch_aug':
+        augmentor = None
+        batch_augmentor = BatchAugmentor(sample_rate, random_seed=1234 + rank)
     else:
         raise Exception('Incorrect argumentation!')
     
     # Dataset
     train_dataset = MaestroDataset(hdf5s_dir=hdf5s_dir, 
         segment_seconds=segment_seconds, frames_per_second=frames_per_second, 
-        max_note_shift=max_note_shift, augmentor=augmentor)
+        max_note_shift=max_note_shift, augmentor=augmentor, 
+        max_open_hdf5s=max_open_hdf5s, target_caches_dir=target_caches_dir, 
+        storage=storage, waveforms_dir=waveforms_dir, 
+        pitch_shift_stores=pitch_shift_stores, compact_rolls=not legacy_rolls)
 
     evaluate_dataset = MaestroDataset(hdf5s_dir=hdf5s_dir, 
         segment_seconds=segment_seconds, frames_per_second=frames_per_second, 
-        max_note_shift=0)
+        max_note_shift=0, max_open_hdf5s=max_open_hdf5s, storage=storage, 
+        waveforms_dir=waveforms_dir, compact_rolls=not legacy_rolls)
 
     # Sampler for training
-    train_sampler = Sampler(hdf5s_dir=hdf5s_dir, split='train', 
-        segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
-        batch_size=batch_size, mini_data=mini_data)
+    if distributed:
+        train_sampler = DistributedSampler(hdf5s_dir=hdf5s_dir, split='train', 
+            segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
+            batch_size=rank_batch_size, mini_data=mini_data, rank=rank, 
+            world_size=world_size)
+    else:
+        train_sampler = Sampler(hdf5s_dir=hdf5s_dir, split='train', 
+            segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
+            batch_size=batch_size, mini_data=mini_data)
 
     # Sampler for evaluation
     evaluate_train_sampler = TestSampler(hdf5s_dir=hdf5s_dir, 
         split='train', segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
-        batch_size=batch_size, mini_data=mini_data)
+        batch_size=batch_size, mini_data=mini_data, rank=rank, 
+        world_size=world_size, max_evaluate_iteration=max_evaluate_iteration)
 
     evaluate_validate_sampler = TestSampler(hdf5s_dir=hdf5s_dir, 
         split='validation', segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
-        batch_size=batch_size, mini_data=mini_data)
+        batch_size=batch_size, mini_data=mini_data, rank=rank, 
+        world_size=world_size, max_evaluate_iteration=max_evaluate_iteration)
 
     evaluate_test_sampler = TestSampler(hdf5s_dir=hdf5s_dir, 
         split='test', segment_seconds=segment_seconds, hop_seconds=hop_seconds, 
-        batch_size=batch_size, mini_data=mini_data)
+        batch_size=batch_size, mini_data=mini_data, rank=rank, 
+        world_size=world_size, max_evaluate_iteration=max_evaluate_iteration)
 
     # Dataloader
     train_loader = torch.utils.data.DataLoader(dataset=train_dataset, 
-        batch_sampler=train_sampler, collate_fn=collate_fn, 
-        num_workers=num_workers, pin_memory=True)
+        batch_sampler=train_sampler, 
+        collate_fn=collate_fn if legacy_rolls else compact_collate_fn, 
+        num_workers=num_workers, pin_memory=legacy_rolls, 
+        worker_init_fn=worker_init_fn)
+    """Compact mini-batches are pinned by batch_buffer"""
 
     evaluate_train_loader = torch.utils.data.DataLoader(dataset=evaluate_dataset, 
         batch_sampler=evaluate_train_sampler, collate_fn=collate_fn, 
-        num_workers=num_workers, pin_memory=True)
+        num_workers=num_workers, pin_memory=True, worker_init_fn=worker_init_fn, 
+        persistent_workers=num_workers > 0)
 
     validate_loader = torch.utils.data.DataLoader(dataset=evaluate_dataset, 
         batch_sampler=evaluate_validate_sampler, collate_fn=collate_fn, 
-        num_workers=num_workers, pin_memory=True)
+        num_workers=num_workers, pin_memory=True, worker_init_fn=worker_init_fn, 
+        persistent_workers=num_workers > 0)
 
     test_loader = torch.utils.data.DataLoader(dataset=evaluate_dataset, 
         batch_sampler=evaluate_test_sampler, collate_fn=collate_fn, 
-        num_workers=num_workers, pin_memory=True)
+        num_workers=num_workers, pin_memory=True, worker_init_fn=worker_init_fn, 
+        persistent_workers=num_workers > 0)
+    """Workers of the evaluation loaders are kept between evaluations"""
 
     # Evaluator
     evaluator = SegmentEvaluator(model, batch_size)
@@ -179,34 +388,84 @@ def train(args):
         entity='jxmorris12',
         project=os.environ.get('WANDB_PROJECT', wandb_project_name),
         job_type='train',
-        config=args
+        config=args, 
+        mode=None if rank == 0 else 'disabled'
     )
     wandb.watch(model)
 
+    if async_evaluate:
+        wandb.define_metric('evaluate_iteration')
+
+        for prefix in ['train_', 'val_', 'test_']:
+            wandb.define_metric(prefix + '*', step_metric='evaluate_iteration')
+        """Statistics are logged when an evaluation finishes, and are plotted 
+        at the iteration of the evaluated weights"""
+
     # Resume training
     if resume_iteration > 0:
-        resume_checkpoint_path = os.path.join(workspace, 'checkpoints', filename, 
-            model_type, 'loss_type={}'.format(loss_type), 
-            'augmentation={}'.format(augmentation), 'batch_size={}'.format(batch_size), 
-                '{}_iterations.pth'.format(resume_iteration))
+        resume_checkpoint_path = os.path.join(checkpoints_dir, 
+            '{}_iterations.pth'.format(resume_iteration))
 
         logging.info('Loading checkpoint {}'.format(resume_checkpoint_path))
-        checkpoint = torch.load(resume_checkpoint_path)
+        checkpoint = torch.load(resume_checkpoint_path, map_location=device, 
+            weights_only=False)
         model.load_state_dict(checkpoint['model'])
         train_sampler.load_state_dict(checkpoint['sampler'])
         statistics_container.load_state_dict(resume_iteration)
         iteration = checkpoint['iteration']
 
+        if 'optimizer' in checkpoint.keys():
+            model.to(device)
+            """Optimizer states are loaded to the device of parameters"""
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scaler.load_state_dict(checkpoint['scaler'])
+
+            if rank < len(checkpoint['rank_random_states']):
+                set_random_states(checkpoint['rank_random_states'][rank], 
+                    device, batch_augmentor)
+            else:
+                logging.info('The checkpoint has no random states of rank {}, '
+                    'reseed them.'.format(rank))
+                seed = int(np.random.SeedSequence(
+                    [1234, rank, iteration]).generate_state(1)[0])
+                np.random.seed(seed)
+                torch.manual_seed(seed)
+
+                if batch_augmentor:
+                    batch_augmentor.random_state = np.random.RandomState(seed)
+        else:
+            logging.info('The checkpoint has no training state, the optimizer '
+                'starts again.')
+
     else:
         iteration = 0
+
+    train_dataset.random_seed = int(np.random.SeedSequence(
+        [1234, rank, iteration]).generate_state(1)[0])
+    """DataLoader workers are reseeded from the rank and the iteration, so that 
+    a resumed run does not repeat the note shifts and augmentations drawn 
+    since iteration 0"""
     
     # Parallel
     print('GPU number: {}'.format(torch.cuda.device_count()))
-    model = torch.nn.DataParallel(model)
 
-    if 'cuda' in str(device):
+    if distributed:
         model.to(device)
+        model = torch.nn.parallel.DistributedDataParallel(model, 
+            device_ids=[local_rank] if 'cuda' in str(device) else None)
+    else:
+        model = torch.nn.DataParallel(model)
+
+        if 'cuda' in str(device):
+            model.to(device)
 
+    if async_evaluate:
+        async_evaluator = AsyncEvaluator(evaluator.model, batch_size, 
+            dataloaders={'train': evaluate_train_loader, 
+                'validation': validate_loader, 'test': test_loader})
+
+    batch_buffer = PinnedBatchBuffer()
+    checkpoint_saver = CheckpointSaver()
     train_bgn_time = time.time()
 
     for batch_data_dict in train_loader:
@@ -218,52 +477,63 @@ def train(args):
 
             train_fin_time = time.time()
 
-            evaluate_train_statistics = evaluator.evaluate(evaluate_train_loader)
-            validate_statistics = evaluator.evaluate(validate_loader)
-            test_statistics = evaluator.evaluate(test_loader)
-
+            if async_evaluate:
+                result = async_evaluator.poll(wait=True)
+                """Wait for the previous evaluation if it is still running"""
 
-            logging.info('    Train statistics: {}'.format(evaluate_train_statistics))
-            logging.info('    Validation statistics: {}'.format(validate_statistics))
-            logging.info('    Test statistics: {}'.format(test_statistics))
+                if result:
+                    log_async_result(statistics_container, result, step=iteration)
 
-            statistics_container.append(iteration, evaluate_train_statistics, data_type='train')
-            statistics_container.append(iteration, validate_statistics, data_type='validation')
-            statistics_container.append(iteration, test_statistics, data_type='test')
-            statistics_container.dump()
+                async_evaluator.start(iteration)
+                logging.info('Started evaluating iteration {}'.format(iteration))
+            
+            else:
+                statistics_dict = {
+                    'train': evaluator.evaluate(evaluate_train_loader), 
+                    'validation': evaluator.evaluate(validate_loader), 
+                    'test': evaluator.evaluate(test_loader)}
 
-            train_time = train_fin_time - train_bgn_time
-            validate_time = time.time() - train_fin_time
+                log_statistics(statistics_container, iteration, statistics_dict, 
+                    rank=rank, step=iteration)
 
-            logging.info(
-                'Train time: {:.3f} s, validate time: {:.3f} s'
-                ''.format(train_time, validate_time))
+                train_time = train_fin_time - train_bgn_time
+                validate_time = time.time() - train_fin_time
 
-            train_bgn_time = time.time()
+                logging.info(
+                    'Train time: {:.3f} s, validate time: {:.3f} s'
+                    ''.format(train_time, validate_time))
 
-            # Log statistics to weights & biases
-            evaluate_train_statistics = {'train_' + k: v for k, v in evaluate_train_statistics.items()}
-            wandb.log(evaluate_train_statistics, step=iteration)
+                train_bgn_time = time.time()
 
-            validate_statistics = {'val_' + k: v for k, v in validate_statistics.items()}
-            wandb.log(validate_statistics, step=iteration)
+        elif async_evaluate:
+            result = async_evaluator.poll()
 
-            test_statistics = {'test_' + k: v for k, v in test_statistics.items()}
-            wandb.log(test_statistics, step=iteration)
+            if result:
+                log_async_result(statistics_container, result, step=iteration)
 
         
         # Save model
         if iteration % 20000 == 0:
+            rank_random_states = gather_random_states(device, batch_augmentor, 
+                distributed)
+            """Each rank draws its own augmentations, their random states are 
+            saved by rank 0"""
+
+        if iteration % 20000 == 0 and rank == 0:
             checkpoint = {
                 'iteration': iteration, 
                 'model': model.module.state_dict(), 
-                'sampler': train_sampler.state_dict()}
+                'sampler': train_sampler.state_dict(), 
+                'optimizer': optimizer.state_dict(), 
+                'scaler': scaler.state_dict(), 
+                'rank_random_states': rank_random_states}
+            """The learning rate reduced every reduce_iteration is in the 
+            param_groups of the optimizer state"""
 
             checkpoint_path = os.path.join(
                 checkpoints_dir, '{}_iterations.pth'.format(iteration))
                 
-            torch.save(checkpoint, checkpoint_path)
-            logging.info('Model saved to {}'.format(checkpoint_path))
+            checkpoint_saver.save(checkpoint, checkpoint_path)
         
         # Reduce learning rate
         if iteration % reduce_iteration == 0 and iteration > 0:
@@ -271,23 +541,33 @@ def train(args):
                 param_group['lr'] *= 0.9
         
         # Move data to device
-        device_data_dict = {}
-        for key in batch_data_dict.keys():
-            device_data_dict[key] = move_data_to_device(batch_data_dict[key], device)
+        if legacy_rolls:
+            device_data_dict = {}
+            for key in batch_data_dict.keys():
+                device_data_dict[key] = move_data_to_device(batch_data_dict[key], device)
+        else:
+            device_data_dict = batch_buffer.to_device(batch_data_dict, device)
+
+        if batch_augmentor:
+            device_data_dict['waveform'] = batch_augmentor.augment(
+                device_data_dict['waveform'])
          
         model.train()
-        batch_output_dict = model(device_data_dict['waveform'])
+        with torch.autocast(device_type=device, dtype=amp_dtype, enabled=amp):
+            batch_output_dict = model(device_data_dict['waveform'])
 
         # breakpoint()
         loss = loss_func(model, batch_output_dict, device_data_dict)
+        """Losses are calculated in float32 outside autocast"""
         wandb.log({'loss': loss}, step=iteration)
 
         print(f'{iteration}/{early_stop}', loss)
 
         # Backward
-        loss.backward()
+        scaler.scale(loss).backward()
         
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         optimizer.zero_grad()
         
         # Stop learning
@@ -296,6 +576,17 @@ def train(args):
 
         iteration += 1
 
+    checkpoint_saver.wait()
+
+    if async_evaluate:
+        result = async_evaluator.poll(wait=True)
+
+        if result:
+            log_async_result(statistics_container, result, step=iteration)
+
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == '__main__':
 
@@ -306,7 +597,7 @@ if __name__ == '__main__':
     parser_train.add_argument('--workspace', type=str, required=True)
     parser_train.add_argument('--model_type', type=str, required=True)
     parser_train.add_argument('--loss_type', type=str, required=True)
-    parser_train.add_argument('--augmentation', type=str, required=True, choices=['none', 'aug'])
+    parser_train.add_argument('--augmentation', type=str, required=True, choices=['none', 'aug', 'batch_aug'])
     parser_train.add_argument('--max_note_shift', type=int, required=True)
     parser_train.add_argument('--batch_size', type=int, required=True)
     parser_train.add_argument('--learning_rate', type=float, required=True)
@@ -315,6 +606,15 @@ if __name__ == '__main__':
     parser_train.add_argument('--early_stop', type=int, required=True)
     parser_train.add_argument('--mini_data', action='store_true', default=False)
     parser_train.add_argument('--cuda', action='store_true', default=False)
+    parser_train.add_argument('--amp', action='store_true', default=False, help='Mixed precision training, float16 on GPU and bfloat16 on CPU.')
+    parser_train.add_argument('--debug_anomaly', action='store_true', default=False, help='Detect anomalies in backward passes, slow.')
+    parser_train.add_argument('--async_evaluate', action='store_true', default=False, help='Evaluate in a background thread while training continues.')
+    parser_train.add_argument('--max_evaluate_iteration', type=int, default=20, help='Number of mini-batches of each evaluation.')
+    parser_train.add_argument('--max_open_hdf5s', type=int, default=128, help='Number of hdf5 files kept open by each DataLoader worker.')
+    parser_train.add_argument('--storage', type=str, default='hdf5', choices=['hdf5', 'memmap'], help='Read waveforms from hdf5 files or from the stores written by features.py write_waveform_stores.')
+    parser_train.add_argument('--legacy_rolls', action='store_true', default=False, help='Collate float64 target rolls as before compact uint8 / float32 rolls.')
+    parser_train.add_argument('--pitch_shift_stores', action='store_true', default=False, help='Read pitch shifted waveforms from the stores written by features.py write_pitch_shifted_stores.')
+    parser_train.add_argument('--target_cache', action='store_true', default=False, help='Slice targets from the caches built by features.py build_target_caches.')
     
     args = parser.parse_args()
     args.filename = get_filename(__file__)
@@ -64,6 +64,22 @@ def init_gru(rnn):
         torch.nn.init.constant_(getattr(rnn, 'bias_hh_l{}'.format(i)), 0)
 
 
+def extract_logmel(spectrogram_extractor, logmel_extractor, input):
+    """Extract log mel spectrograms in float32 also under autocast, where 
+    power spectrograms of the STFT would overflow float16.
+
+    Args:
+      input: (batch_size, data_length)
+
+    Outputs:
+      output: (batch_size, 1, time_steps, mel_bins)
+    """
+    with torch.autocast(device_type=input.device.type, enabled=False):
+        x = spectrogram_extractor(input.float())   # (batch_size, 1, time_steps, freq_bins)
+        x = logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+    return x
+
+
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, momentum):
         
@@ -142,6 +158,17 @@ class AcousticModelCRnn8Dropout(nn.Module):
         Outputs:
           output: (batch_size, time_steps, classes_num)
         """
+        return torch.sigmoid(self.forward_logits(input))
+
+    def forward_logits(self, input):
+        """Same as forward without the final sigmoid.
+
+        Args:
+          input: (batch_size, channels_num, time_steps, freq_bins)
+
+        Outputs:
+          logits: (batch_size, time_steps, classes_num)
+        """
 
         x = self.conv_block1(input, pool_size=(1, 2), pool_type='avg')
         x = F.dropout(x, p=0.2, training=self.training)
@@ -158,8 +185,8 @@ class AcousticModelCRnn8Dropout(nn.Module):
         
         (x, _) = self.gru(x)
         x = F.dropout(x, p=0.5, training=self.training, inplace=False)
-        output = torch.sigmoid(self.fc(x))
-        return output
+        logits = self.fc(x)
+        return logits
 
 
 class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
@@ -228,11 +255,11 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
             'reg_offset_output': (batch_size, time_steps, classes_num),
             'frame_output': (batch_size, time_steps, classes_num),
             'velocity_output': (batch_size, time_steps, classes_num)
-          }
+          }, and in training mode also the logits of each output, e.g. 
+          'reg_onset_logits', for losses with a fused sigmoid
         """
 
-        x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
-        x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        x = extract_logmel(self.spectrogram_extractor, self.logmel_extractor, input)
 
         x = x.transpose(1, 3)
         x = self.bn0(x)
@@ -240,21 +267,25 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
 
         frame_output = self.frame_model(x)  # (batch_size, time_steps, classes_num)
         reg_onset_output = self.reg_onset_model(x)  # (batch_size, time_steps, classes_num)
-        reg_offset_output = self.reg_offset_model(x)    # (batch_size, time_steps, classes_num)
-        velocity_output = self.velocity_model(x)    # (batch_size, time_steps, classes_num)
+        reg_offset_logits = self.reg_offset_model.forward_logits(x)
+        reg_offset_output = torch.sigmoid(reg_offset_logits)    # (batch_size, time_steps, classes_num)
+        velocity_logits = self.velocity_model.forward_logits(x)
+        velocity_output = torch.sigmoid(velocity_logits)    # (batch_size, time_steps, classes_num)
  
         # Use velocities to condition onset regression
         x = torch.cat((reg_onset_output, (reg_onset_output ** 0.5) * velocity_output.detach()), dim=2)
         (x, _) = self.reg_onset_gru(x)
         x = F.dropout(x, p=0.5, training=self.training, inplace=False)
-        reg_onset_output = torch.sigmoid(self.reg_onset_fc(x))
+        reg_onset_logits = self.reg_onset_fc(x)
+        reg_onset_output = torch.sigmoid(reg_onset_logits)
         """(batch_size, time_steps, classes_num)"""
 
         # Use onsets and offsets to condition frame-wise classification
         x = torch.cat((frame_output, reg_onset_output.detach(), reg_offset_output.detach()), dim=2)
         (x, _) = self.frame_gru(x)
         x = F.dropout(x, p=0.5, training=self.training, inplace=False)
-        frame_output = torch.sigmoid(self.frame_fc(x))  # (batch_size, time_steps, classes_num)
+        frame_logits = self.frame_fc(x)
+        frame_output = torch.sigmoid(frame_logits)  # (batch_size, time_steps, classes_num)
         """(batch_size, time_steps, classes_num)"""
 
         output_dict = {
@@ -262,6 +293,13 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
             'reg_offset_output': reg_offset_output, 
             'frame_output': frame_output, 
             'velocity_output': velocity_output}
+
+        if self.training:
+            output_dict.update({
+                'reg_onset_logits': reg_onset_logits, 
+                'reg_offset_logits': reg_offset_logits, 
+                'frame_logits': frame_logits, 
+                'velocity_logits': velocity_logits})
         print('output_dict:', {k: v.shape for k, v in output_dict.items()}, f'(input.shape = {input.shape})')
 
         return output_dict
@@ -323,21 +361,26 @@ class Regress_pedal_CRNN(nn.Module):
           }
         """
 
-        x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
-        x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        x = extract_logmel(self.spectrogram_extractor, self.logmel_extractor, input)
 
         x = x.transpose(1, 3)
         x = self.bn0(x)
         x = x.transpose(1, 3)
 
-        reg_pedal_onset_output = self.reg_pedal_onset_model(x)  # (batch_size, time_steps, classes_num)
-        reg_pedal_offset_output = self.reg_pedal_offset_model(x)  # (batch_size, time_steps, classes_num)
-        pedal_frame_output = self.reg_pedal_frame_model(x)  # (batch_size, time_steps, classes_num)
+        reg_pedal_onset_logits = self.reg_pedal_onset_model.forward_logits(x)  # (batch_size, time_steps, classes_num)
+        reg_pedal_offset_logits = self.reg_pedal_offset_model.forward_logits(x)  # (batch_size, time_steps, classes_num)
+        pedal_frame_logits = self.reg_pedal_frame_model.forward_logits(x)  # (batch_size, time_steps, classes_num)
         
         output_dict = {
-            'reg_pedal_onset_output': reg_pedal_onset_output, 
-            'reg_pedal_offset_output': reg_pedal_offset_output,
-            'pedal_frame_output': pedal_frame_output}
+            'reg_pedal_onset_output': torch.sigmoid(reg_pedal_onset_logits), 
+            'reg_pedal_offset_output': torch.sigmoid(reg_pedal_offset_logits),
+            'pedal_frame_output': torch.sigmoid(pedal_frame_logits)}
+
+        if self.training:
+            output_dict.update({
+                'reg_pedal_onset_logits': reg_pedal_onset_logits, 
+                'reg_pedal_offset_logits': reg_pedal_offset_logits, 
+                'pedal_frame_logits': pedal_frame_logits})
 
         return output_dict
 
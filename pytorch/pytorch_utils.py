@@ -3,6 +3,8 @@ import sys
 sys.path.insert(1, os.path.join(sys.path[0], '../utils'))
 import numpy as np
 import time
+import logging
+import threading
 import librosa
 import torch
 import torch.nn as nn
@@ -10,8 +12,25 @@ import torch.nn as nn
 from utilities import pad_truncate_sequence
 
 
-def move_data_to_device(x, device):
-    if 'float' in str(x.dtype):
+def move_data_to_device(x, device, non_blocking=False):
+    """Move an array to a device as a float32 or int64 tensor. Compact uint8 
+    rolls and torch tensors are moved as they are, the losses expand rolls to 
+    float on the device.
+
+    Args:
+      x: np.ndarray | torch.Tensor
+      device: str | torch.device
+      non_blocking: bool, asynchronous if x is a tensor in pinned memory
+
+    Returns:
+      x: torch.Tensor
+    """
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
+
+    if x.dtype == np.uint8:
+        x = torch.from_numpy(x)
+    elif 'float' in str(x.dtype):
         x = torch.Tensor(x)
     elif 'int' in str(x.dtype):
         x = torch.LongTensor(x)
@@ -21,6 +40,385 @@ def move_data_to_device(x, device):
     return x.to(device)
 
 
+class PinnedBatchBuffer(object):
+    def __init__(self):
+        """Reusable pinned host buffers for moving mini-batches of 
+        compact_collate_fn to a GPU by non-blocking transfers. Each tensor of 
+        a mini-batch is copied into the buffer of its key, which is allocated 
+        once and reused while shapes and dtypes are unchanged. Buffers are 
+        only overwritten after the transfers of the previous mini-batch have 
+        finished."""
+        self.buffers = {}
+        self.copy_event = None
+
+    def to_device(self, batch_data_dict, device):
+        """Move a mini-batch to a device.
+
+        Args:
+          batch_data_dict: dict of torch.Tensor, see compact_collate_fn
+          device: 'cuda' | 'cpu'
+
+        Returns:
+          device_data_dict: dict of torch.Tensor
+        """
+        if 'cuda' not in str(device):
+            return {key: move_data_to_device(batch_data_dict[key], device) 
+                for key in batch_data_dict.keys()}
+
+        if self.copy_event is not None:
+            self.copy_event.synchronize()
+
+        device_data_dict = {}
+
+        for key in batch_data_dict.keys():
+            x = batch_data_dict[key]
+            buffer = self.buffers.get(key)
+
+            if buffer is None or buffer.shape != x.shape or buffer.dtype != x.dtype:
+                buffer = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+                self.buffers[key] = buffer
+
+            buffer.copy_(x)
+            device_data_dict[key] = move_data_to_device(buffer, device, 
+                non_blocking=True)
+
+        self.copy_event = torch.cuda.Event()
+        self.copy_event.record()
+
+        return device_data_dict
+
+
+def copy_to_cpu(x):
+    """Copy the tensors and arrays of a nested state to the CPU, so that the 
+    copy is not changed by later training steps.
+
+    Args:
+      x: torch.Tensor | np.ndarray | dict | list | tuple | object
+
+    Returns:
+      copied x
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+    elif isinstance(x, np.ndarray):
+        return x.copy()
+    elif isinstance(x, dict):
+        return {key: copy_to_cpu(value) for key, value in x.items()}
+    elif isinstance(x, (list, tuple)):
+        return type(x)(copy_to_cpu(value) for value in x)
+    else:
+        return x
+
+
+class CheckpointSaver(object):
+    def __init__(self):
+        """Save checkpoints in a background thread. A checkpoint is copied to 
+        the CPU in the calling thread, then serialized to a temporary file and 
+        renamed to its path, so that an interrupted save never leaves a 
+        truncated checkpoint. One checkpoint is written at a time.
+        """
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, checkpoint_path):
+        """Start saving a checkpoint, after the previous one is written.
+
+        Args:
+          checkpoint: dict
+          checkpoint_path: str
+        """
+        self.wait()
+        checkpoint = copy_to_cpu(checkpoint)
+
+        self.thread = threading.Thread(target=self.write, 
+            args=(checkpoint, checkpoint_path), daemon=True)
+        self.thread.start()
+
+    def write(self, checkpoint, checkpoint_path):
+        try:
+            tmp_path = checkpoint_path + '.tmp'
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, checkpoint_path)
+            logging.info('Model saved to {}'.format(checkpoint_path))
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Wait until the last checkpoint is written, and raise its error if 
+        writing failed."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+
+def get_available_memory(device):
+    """Get the free memory of a device in bytes. Returns None if unknown.
+
+    Args:
+      device: 'cuda' | 'cpu'
+    """
+    if 'cuda' in str(device):
+        try:
+            (free_bytes, total_bytes) = torch.cuda.mem_get_info()
+            return free_bytes
+        except (AttributeError, RuntimeError):
+            return None
+    else:
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+
+def get_inference_batch_size(device, segment_samples, max_batch_size=32):
+    """Choose the inference batch size from the free memory of a device. 
+    Forwarding a segment through Note_pedal without gradients needs about 
+    1 kB of activations per input sample, and half of the free memory is 
+    used to leave room for the model and other processes.
+
+    Args:
+      device: 'cuda' | 'cpu'
+      segment_samples: int
+      max_batch_size: int
+
+    Returns:
+      batch_size: int
+    """
+    bytes_per_sample = 1024
+    available_memory = get_available_memory(device)
+
+    if available_memory is None:
+        return 1
+
+    batch_size = int(available_memory * 0.5 // (bytes_per_sample * segment_samples))
+    return int(np.clip(batch_size, 1, max_batch_size))
+
+
+class BatchAugmentor(object):
+    def __init__(self, sample_rate, random_seed=1234):
+        """Augment a mini-batch of waveforms on their device with the effects 
+        and the random parameter ranges of data_generator.Augmentor, i.e. a 
+        pitch detune, contrast, two peaking equalizers and a reverb. Augmentor 
+        runs sox on each segment in the DataLoader workers. Here each effect 
+        is vectorized over the mini-batch instead: contrast is the waveshaper 
+        of sox, the equalizers and the reverb are multiplied with the 
+        waveforms as frequency responses of the sox biquads and of its 
+        Freeverb network, and the detune is a phase vocoder time stretch 
+        followed by resampling.
+
+        Args:
+          sample_rate: int
+          random_seed: int
+        """
+        self.sample_rate = sample_rate
+        self.random_state = np.random.RandomState(random_seed)
+
+        # Phase vocoder
+        self.n_fft = 2048
+        self.hop_length = 512
+
+        # Freeverb network of sox reverb with its default room scale, 
+        # hf damping, pre delay and wet gain
+        ratio = sample_rate / 44100.
+        self.comb_delays = [int(n * ratio + 0.5) for n in 
+            [1116, 1188, 1277, 1356, 1422, 1491, 1557, 1617]]
+        self.allpass_delays = [int(n * ratio + 0.5) for n in [225, 556, 441, 341]]
+        self.allpass_feedback = 0.5
+        self.hf_damping = 0.5 * 0.3 + 0.2
+        self.wet_gain = 0.015
+        self.delay_responses = {}
+
+    def augment(self, x):
+        """Augment a mini-batch of waveforms.
+
+        Args:
+          x: (batch_size, segment_samples), torch.Tensor
+
+        Returns:
+          aug_x: (batch_size, segment_samples), torch.Tensor
+        """
+        (batch_size, clip_samples) = x.shape
+
+        semitones = self.random_state.uniform(-0.1, 0.1, batch_size)
+        contrast = self.random_state.uniform(0, 100, batch_size)
+        eq_frequencies = self.loguniform(32, 4096, (2, batch_size))
+        eq_width_qs = self.random_state.uniform(1, 2, (2, batch_size))
+        eq_gains_db = self.random_state.uniform(-30, 10, (2, batch_size))
+        reverberance = self.random_state.uniform(0, 70, batch_size)
+
+        x = self.detune(x, semitones)
+        x = self.contrast(x, contrast)
+
+        feedback = self.get_reverb_feedback(reverberance)
+        """Pad the waveforms by the tail of the longest reverb decayed by 60 dB, 
+        so that the tail is not wrapped to the beginning"""
+        tail_samples = int(np.log(1e-3) / np.log(np.max(feedback)) * max(self.comb_delays))
+        n_fft = int(2 ** np.ceil(np.log2(clip_samples + tail_samples)))
+
+        omega = torch.arange(n_fft // 2 + 1, device=x.device, dtype=x.dtype) * (2 * np.pi / n_fft)
+        z = torch.exp(-1j * omega)[None, :]
+
+        response = 1.
+        for k in range(2):
+            response = response * self.get_equalizer_response(z, eq_frequencies[k], 
+                eq_width_qs[k], eq_gains_db[k])
+
+        response = response * (1. + self.get_reverb_response(z, feedback, n_fft))
+
+        aug_x = torch.fft.irfft(torch.fft.rfft(x, n=n_fft) * response, n=n_fft)
+        aug_x = torch.clamp(aug_x[:, 0 : clip_samples], -1., 1.)
+
+        return aug_x
+
+    def loguniform(self, low, high, size):
+        return np.exp(self.random_state.uniform(np.log(low), np.log(high), size))
+
+    def to_tensor(self, x, like):
+        """(batch_size,) array to a (batch_size, 1) tensor on the device of like."""
+        return torch.tensor(x, device=like.device, dtype=like.dtype)[:, None]
+
+    def detune(self, x, semitones):
+        """Shift pitches by a fraction of a semitone and keep the timing.
+
+        Args:
+          x: (batch_size, segment_samples)
+          semitones: (batch_size,)
+
+        Returns:
+          (batch_size, segment_samples)
+        """
+        (batch_size, clip_samples) = x.shape
+        factors = 2. ** (semitones / 12.)
+
+        window = torch.hann_window(self.n_fft, device=x.device, dtype=x.dtype)
+        spectrogram = torch.stft(x, self.n_fft, self.hop_length, window=window, 
+            return_complex=True)
+        (_, freq_bins, frames_num) = spectrogram.shape
+
+        # Time stretch by each factor, a clip is stretched to clip_samples * factor
+        stretch_frames = int(np.ceil(frames_num * np.max(factors))) + 1
+        time_steps = torch.arange(stretch_frames, device=x.device, dtype=x.dtype)[None, :] \
+            / self.to_tensor(factors, x)
+        time_steps = torch.clamp(time_steps, max=frames_num)
+        
+        index = time_steps.long()
+        alpha = (time_steps - index)[:, None, :]
+        spectrogram = torch.nn.functional.pad(spectrogram, (0, 2))
+        
+        def gather(y, index):
+            return torch.gather(y, 2, index[:, None, :].expand(-1, freq_bins, -1))
+
+        magnitude = torch.abs(spectrogram)
+        angle = torch.angle(spectrogram)
+        
+        stretch_magnitude = (1. - alpha) * gather(magnitude, index) + \
+            alpha * gather(magnitude, index + 1)
+
+        bins = torch.arange(freq_bins, device=x.device)[None, :, None]
+        steps = torch.arange(stretch_frames, device=x.device)[None, None, :]
+        """Expected phase advance of each bin and expected phase of each 
+        stretched frame, wrapped by integer arithmetic to keep the precision 
+        of float32"""
+        expected_advance = (2. * np.pi / self.n_fft) * \
+            ((self.hop_length * bins) % self.n_fft).to(x.dtype)
+        expected_phase = (2. * np.pi / self.n_fft) * \
+            ((self.hop_length * bins * steps) % self.n_fft).to(x.dtype)
+
+        deviation = gather(angle, index + 1) - gather(angle, index) - expected_advance
+        deviation = deviation - 2. * np.pi * torch.round(deviation / (2. * np.pi))
+
+        """Accumulated phase of a frame excludes the deviation of the frame"""
+        phase = angle[:, :, 0 : 1] + expected_phase + \
+            torch.cumsum(deviation, dim=2) - deviation
+        stretch_spectrogram = torch.polar(stretch_magnitude, phase)
+
+        stretch_x = torch.istft(stretch_spectrogram, self.n_fft, self.hop_length, 
+            window=window, length=(stretch_frames - 1) * self.hop_length)
+
+        # Resample by each factor back to clip_samples
+        positions = torch.arange(clip_samples, device=x.device, dtype=x.dtype)[None, :] \
+            * self.to_tensor(factors, x)
+        index = positions.long()
+        alpha = positions - index
+        index = torch.clamp(index, max=stretch_x.shape[1] - 2)
+        
+        return (1. - alpha) * torch.gather(stretch_x, 1, index) + \
+            alpha * torch.gather(stretch_x, 1, index + 1)
+
+    def contrast(self, x, amount):
+        """Waveshaper of sox contrast, amount in [0, 100]."""
+        amount = self.to_tensor(amount / 750., x)
+        return torch.sin(x * (np.pi / 2) + amount * torch.sin(x * (2 * np.pi)))
+
+    def get_equalizer_response(self, z, frequencies, width_qs, gains_db):
+        """Frequency response of the peaking equalizer biquads of sox 
+        equalizer.
+
+        Args:
+          z: (1, freq_bins), complex, exp(-j * omega)
+          frequencies: (batch_size,), Hz
+          width_qs: (batch_size,)
+          gains_db: (batch_size,)
+
+        Returns:
+          response: (batch_size, freq_bins), complex
+        """
+        w0 = 2 * np.pi * frequencies / self.sample_rate
+        A = np.exp(gains_db / 40. * np.log(10.))
+        alpha = np.sin(w0) / (2. * width_qs)
+
+        (b0, b1, b2) = (1. + alpha * A, -2. * np.cos(w0), 1. - alpha * A)
+        (a0, a1, a2) = (1. + alpha / A, -2. * np.cos(w0), 1. - alpha / A)
+        [b0, b1, b2, a0, a1, a2] = [self.to_tensor(c, z.real) for c in [b0, b1, b2, a0, a1, a2]]
+
+        return (b0 + b1 * z + b2 * z ** 2) / (a0 + a1 * z + a2 * z ** 2)
+
+    def get_reverb_feedback(self, reverberance):
+        """Comb filter feedback of sox reverb, reverberance in [0, 100]."""
+        a = -1. / np.log(1. - 0.3)
+        b = 100. / (np.log(1. - 0.98) * a + 1.)
+        return 1. - np.exp((reverberance - b) / (a * b))
+
+    def get_reverb_response(self, z, feedback, n_fft):
+        """Frequency response of the wet path of sox reverb, i.e. parallel 
+        damped comb filters followed by allpass filters.
+
+        Args:
+          z: (1, freq_bins), complex, exp(-j * omega)
+          feedback: (batch_size,)
+          n_fft: int, responses of delays are cached by n_fft
+
+        Returns:
+          response: (batch_size, freq_bins), complex
+        """
+        key = (n_fft, str(z.device))
+        if key not in self.delay_responses.keys():
+            self.delay_responses[key] = {delay: z ** delay for delay in 
+                self.comb_delays + self.allpass_delays}
+        delay_responses = self.delay_responses[key]
+
+        feedback = self.to_tensor(feedback, z.real)
+        damping = self.hf_damping
+        lowpass = (1. - damping) / (1. - damping * z)
+        
+        response = 0.
+        for delay in self.comb_delays:
+            zd = delay_responses[delay]
+            response = response + zd / (1. - feedback * lowpass * zd)
+
+        g = self.allpass_feedback
+        for delay in self.allpass_delays:
+            zd = delay_responses[delay]
+            response = response * ((1. + g) * zd - 1.) / (1. - g * zd)
+
+        return self.wet_gain * response
+
+
 def append_to_dict(dict, key, value):
     
     if key in dict.keys():
@@ -29,25 +427,24 @@ def append_to_dict(dict, key, value):
         dict[key] = [value]
 
  
-def forward_dataloader(model, dataloader, batch_size, return_target=True):
-    """Forward data generated from dataloader to model.
+def forward_dataloader_batches(model, dataloader, return_target=True):
+    """Forward mini-batches generated from dataloader to model, and yield the 
+    outputs of each mini-batch without keeping them.
 
     Args:
       model: object
       dataloader: object, used to generate mini-batches for evaluation.
-      batch_size: int
       return_target: bool
 
-    Returns:
-      output_dict: dict, e.g. {
-        'frame_output': (segments_num, frames_num, classes_num),
-        'onset_output': (segments_num, frames_num, classes_num),
-        'frame_roll': (segments_num, frames_num, classes_num),
-        'onset_roll': (segments_num, frames_num, classes_num),
+    Yields:
+      batch_output_dict: dict, e.g. {
+        'frame_output': (batch_size, frames_num, classes_num),
+        'onset_output': (batch_size, frames_num, classes_num),
+        'frame_roll': (batch_size, frames_num, classes_num),
+        'onset_roll': (batch_size, frames_num, classes_num),
         ...}
     """
 
-    output_dict = {}
     device = next(model.parameters()).device
 
     for n, batch_data_dict in enumerate(dataloader):
@@ -58,17 +455,46 @@ def forward_dataloader(model, dataloader, batch_size, return_target=True):
             model.eval()
             batch_output_dict = model(batch_waveform)
 
+        output_dict = {}
+
         for key in batch_output_dict.keys():
             if '_list' not in key:
-                append_to_dict(output_dict, key, 
-                    batch_output_dict[key].data.cpu().numpy())
+                output_dict[key] = batch_output_dict[key].data.cpu().numpy()
 
         if return_target:
             for target_type in batch_data_dict.keys():
                 if 'roll' in target_type or 'reg_distance' in target_type or \
                     'reg_tail' in target_type:
-                    append_to_dict(output_dict, target_type, 
-                        batch_data_dict[target_type])
+                    output_dict[target_type] = batch_data_dict[target_type]
+
+        yield output_dict
+
+
+def forward_dataloader(model, dataloader, batch_size, return_target=True):
+    """Forward data generated from dataloader to model.
+
+    Args:
+      model: object
+      dataloader: object, used to generate mini-batches for evaluation.
+      batch_size: int
+      return_target: bool
+
+    Returns:
+      output_dict: dict, e.g. {
+        'frame_output': (segments_num, frames_num, classes_num),
+        'onset_output': (segments_num, frames_num, classes_num),
+        'frame_roll': (segments_num, frames_num, classes_num),
+        'onset_roll': (segments_num, frames_num, classes_num),
+        ...}
+    """
+
+    output_dict = {}
+
+    for batch_output_dict in forward_dataloader_batches(model, dataloader, 
+        return_target):
+
+        for key in batch_output_dict.keys():
+            append_to_dict(output_dict, key, batch_output_dict[key])
 
     for key in output_dict.keys():
         output_dict[key] = np.concatenate(output_dict[key], axis=0)
@@ -0,0 +1,121 @@
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../utils'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../pytorch'))
+import numpy as np
+import pytest
+from sklearn import metrics
+
+from evaluate import (mae, AveragePrecisionAccumulator,
+    get_binned_average_precision, MaeAccumulator)
+
+
+def random_targets_outputs(random_state, samples_num, classes_num, bins_num=None):
+    """Binary targets and outputs correlated with the targets. Outputs are
+    quantized to the centers of bins if bins_num is given."""
+    target = (random_state.uniform(0, 1, (samples_num, classes_num)) < 0.2).astype(np.float32)
+    output = np.clip(0.3 * target + random_state.uniform(0, 0.7, target.shape), 0, 1)
+
+    if bins_num is not None:
+        output = (np.floor(output * bins_num) + 0.5) / bins_num
+
+    return target, output
+
+
+@pytest.mark.parametrize('bins_num, quantized', [(10000, False), (20, True), (10000, True)])
+@pytest.mark.parametrize('seed', range(3))
+def test_average_precision_accumulator(bins_num, quantized, seed):
+    """AP of the accumulator equals average_precision_score, exactly if each
+    bin holds one output value."""
+    random_state = np.random.RandomState(seed)
+    (target, output) = random_targets_outputs(random_state,
+        samples_num=3000, classes_num=5, bins_num=bins_num if quantized else None)
+
+    accumulator = AveragePrecisionAccumulator(bins_num)
+    accumulator.update(target, output)
+
+    if quantized:
+        (rtol, atol) = (1e-10, 0)
+    else:
+        (rtol, atol) = (0, 1e-3)
+        """Continuous outputs differ by the quantization of outputs"""
+
+    np.testing.assert_allclose(accumulator.result(),
+        metrics.average_precision_score(target.flatten(), output.flatten()),
+        rtol=rtol, atol=atol)
+
+    np.testing.assert_allclose(accumulator.result(per_class=True),
+        metrics.average_precision_score(target, output, average=None),
+        rtol=rtol, atol=atol)
+
+
+def test_average_precision_accumulator_merge():
+    """Accumulators of split mini-batches merge to the accumulator of all
+    mini-batches."""
+    random_state = np.random.RandomState(0)
+    (target, output) = random_targets_outputs(random_state,
+        samples_num=3000, classes_num=5)
+
+    accumulator = AveragePrecisionAccumulator()
+    accumulator.update(target, output)
+
+    merged_accumulator = AveragePrecisionAccumulator()
+    merged_accumulator.merge(AveragePrecisionAccumulator())
+
+    for indexes in np.array_split(np.arange(len(target)), 4):
+        split_accumulator = AveragePrecisionAccumulator()
+        split_accumulator.update(target[indexes], output[indexes])
+        merged_accumulator.merge(split_accumulator)
+
+    np.testing.assert_array_equal(merged_accumulator.positive_counts, accumulator.positive_counts)
+    np.testing.assert_array_equal(merged_accumulator.negative_counts, accumulator.negative_counts)
+    np.testing.assert_allclose(merged_accumulator.result(per_class=True),
+        accumulator.result(per_class=True), rtol=1e-12)
+
+
+def test_average_precision_without_positives():
+    """A class without positive targets has an AP of 0, as in
+    average_precision_score."""
+    random_state = np.random.RandomState(0)
+    (target, output) = random_targets_outputs(random_state,
+        samples_num=1000, classes_num=3)
+    target[:, 1] = 0
+
+    accumulator = AveragePrecisionAccumulator()
+    accumulator.update(target, output)
+
+    assert accumulator.result(per_class=True)[1] == 0.
+    assert get_binned_average_precision(np.zeros(10), np.ones(10)) == 0.
+
+    with pytest.warns(UserWarning):
+        assert metrics.average_precision_score(target[:, 1], output[:, 1]) == 0.
+
+
+@pytest.mark.parametrize('masked', [True, False])
+def test_mae_accumulator(masked):
+    """MaeAccumulator of mini-batches equals mae of all mini-batches."""
+    random_state = np.random.RandomState(0)
+    target = random_state.uniform(0, 1, (8, 100, 5))
+    output = random_state.uniform(0, 1, (8, 100, 5))
+
+    if masked:
+        mask = (random_state.uniform(0, 1, target.shape) < 0.3).astype(np.float64)
+    else:
+        mask = None
+
+    accumulator = MaeAccumulator()
+    merged_accumulator = MaeAccumulator()
+
+    for n in range(len(target)):
+        batch_mask = None if mask is None else mask[n]
+        accumulator.update(target[n], output[n], batch_mask)
+
+        split_accumulator = MaeAccumulator()
+        split_accumulator.update(target[n], output[n], batch_mask)
+        merged_accumulator.merge(split_accumulator)
+
+    expected = mae(target.copy(), output.copy(), mask)
+    """mae masks its arguments in place"""
+
+    np.testing.assert_allclose(accumulator.result(), expected, rtol=1e-12)
+    np.testing.assert_allclose(merged_accumulator.result(), expected, rtol=1e-12)
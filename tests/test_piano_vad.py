@@ -0,0 +1,130 @@
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../utils'))
+import numpy as np
+import pytest
+
+import piano_vad
+
+
+def get_detection_function(packed_function, use_numba):
+    """Compiled function, or the pure Python function as run without numba."""
+    if use_numba:
+        pytest.importorskip('numba')
+        return packed_function
+    else:
+        return getattr(packed_function, 'py_func', packed_function)
+
+
+def random_outputs(random_state, frames_num, classes_num, onset_probability):
+    """Random frame outputs, and binarized onset and offset outputs."""
+    frame_output = random_state.uniform(0, 1, (frames_num, classes_num))
+
+    # Long runs of frames above and below threshold
+    frame_output = np.repeat(frame_output[:: 20], 20, axis=0)[: frames_num]
+    frame_output += random_state.uniform(-0.1, 0.1, (frames_num, classes_num))
+
+    onset_output = (random_state.uniform(0, 1, (frames_num, classes_num)) < onset_probability).astype(np.float32)
+    offset_output = (random_state.uniform(0, 1, (frames_num, classes_num)) < onset_probability).astype(np.float32)
+    return frame_output, onset_output, offset_output
+
+
+def unpack_notes(output, classes_num):
+    """Rows of packed notes grouped by class, see piano_vad."""
+    return [output[output[:, 5] == k, 0 : 5].tolist() for k in range(classes_num)]
+
+
+@pytest.mark.parametrize('use_numba', [True, False])
+@pytest.mark.parametrize('onset_probability', [0.001, 0.02, 0.2])
+@pytest.mark.parametrize('seed', range(3))
+def test_note_detection_packed(use_numba, onset_probability, seed):
+    random_state = np.random.RandomState(seed)
+    (frames_num, classes_num, frame_threshold) = (1501, 6, 0.3)
+    (frame_output, onset_output, offset_output) = random_outputs(
+        random_state, frames_num, classes_num, onset_probability)
+    frame_output[:, 0] = 1.
+    onset_output[100 : 800, 0] = 0.
+    """Notes of the first class are held until they are cut at 600 frames"""
+    onset_shift_output = random_state.uniform(-0.5, 0.5, (frames_num, classes_num))
+    offset_shift_output = random_state.uniform(-0.5, 0.5, (frames_num, classes_num))
+    velocity_output = random_state.uniform(0, 1, (frames_num, classes_num))
+
+    detect = get_detection_function(
+        piano_vad.note_detection_with_onset_offset_regress_packed, use_numba)
+
+    output = detect(frame_output, onset_output, onset_shift_output,
+        offset_output, offset_shift_output, velocity_output, frame_threshold)
+
+    for k, packed_tuples in enumerate(unpack_notes(output, classes_num)):
+        expected_tuples = piano_vad.note_detection_with_onset_offset_regress(
+            frame_output[:, k], onset_output[:, k], onset_shift_output[:, k],
+            offset_output[:, k], offset_shift_output[:, k],
+            velocity_output[:, k], frame_threshold)
+
+        np.testing.assert_array_equal(np.array(packed_tuples).reshape(-1, 5),
+            np.array(expected_tuples, dtype=np.float64).reshape(-1, 5))
+
+
+@pytest.mark.parametrize('use_numba', [True, False])
+@pytest.mark.parametrize('seed', range(3))
+def test_onsets_frames_note_detection_packed(use_numba, seed):
+    random_state = np.random.RandomState(seed)
+    (frames_num, classes_num, threshold) = (1501, 6, 0.3)
+    (frame_output, _, _) = random_outputs(random_state, frames_num, classes_num, 0.)
+    onset_output = random_state.uniform(0, 0.33, (frames_num, classes_num))
+    offset_output = random_state.uniform(0, 1, (frames_num, classes_num))
+    velocity_output = random_state.uniform(0, 1, (frames_num, classes_num))
+
+    detect = get_detection_function(
+        piano_vad.onsets_frames_note_detection_packed, use_numba)
+
+    output = detect(frame_output, onset_output, offset_output,
+        velocity_output, threshold)
+
+    for k, packed_tuples in enumerate(unpack_notes(output, classes_num)):
+        expected_tuples = piano_vad.onsets_frames_note_detection(
+            frame_output[:, k], onset_output[:, k], offset_output[:, k],
+            velocity_output[:, k], threshold)
+
+        """Shifts are always 0 in packed notes"""
+        packed_tuples = [[bgn, fin, velocity] for (bgn, fin, _, _, velocity) in packed_tuples]
+
+        np.testing.assert_array_equal(np.array(packed_tuples).reshape(-1, 3),
+            np.array(expected_tuples, dtype=np.float64).reshape(-1, 3))
+
+
+@pytest.mark.parametrize('use_numba', [True, False])
+@pytest.mark.parametrize('offset_probability', [0.001, 0.02, 0.2])
+@pytest.mark.parametrize('seed', range(3))
+def test_pedal_detection_packed(use_numba, offset_probability, seed):
+    random_state = np.random.RandomState(seed)
+    (frames_num, frame_threshold) = (1501, 0.5)
+    (frame_output, _, offset_output) = random_outputs(
+        random_state, frames_num, 1, offset_probability)
+    (frame_output, offset_output) = (frame_output[:, 0], offset_output[:, 0])
+    offset_shift_output = random_state.uniform(-0.5, 0.5, frames_num)
+
+    detect = get_detection_function(
+        piano_vad.pedal_detection_with_onset_offset_regress_packed, use_numba)
+
+    output = detect(frame_output, offset_output, offset_shift_output,
+        frame_threshold)
+
+    expected_tuples = piano_vad.pedal_detection_with_onset_offset_regress(
+        frame_output, offset_output, offset_shift_output, frame_threshold)
+
+    np.testing.assert_array_equal(output,
+        np.array(expected_tuples, dtype=np.float64).reshape(-1, 4))
+
+    detect = get_detection_function(
+        piano_vad.onsets_frames_pedal_detection_packed, use_numba)
+
+    output = detect(frame_output, offset_output, frame_threshold)
+
+    expected_tuples = piano_vad.onsets_frames_pedal_detection(
+        frame_output, offset_output, frame_threshold)
+
+    """Shifts are always 0 in packed pedals"""
+    np.testing.assert_array_equal(output[:, 0 : 2],
+        np.array(expected_tuples, dtype=np.float64).reshape(-1, 2))
+    np.testing.assert_array_equal(output[:, 2 :], 0)
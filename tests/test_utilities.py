@@ -0,0 +1,289 @@
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../utils'))
+import numpy as np
+import h5py
+import pytest
+
+import utilities
+from utilities import (TargetProcessor, RegressionPostProcessor, 
+    write_manifest, read_hdf5s_meta, crawl_hdf5s_meta)
+import config
+
+
+def get_target_processor():
+    return TargetProcessor(segment_seconds=config.segment_seconds, 
+        frames_per_second=config.frames_per_second, 
+        begin_note=config.begin_note, classes_num=config.classes_num)
+
+
+def random_regression_column(random_state, frames_num, dtype):
+    """Column of a regression input roll: 1 where there is no anchor, and the 
+    offset of the onset or offset in [0, 0.5) at anchors."""
+    column = np.ones(frames_num, dtype=dtype)
+    anchors_num = random_state.randint(0, frames_num + 1)
+    anchors = random_state.choice(frames_num, anchors_num, replace=False)
+    column[anchors] = random_state.uniform(0, 0.5, anchors_num)
+    return column
+
+
+def special_regression_columns(frames_num, dtype):
+    """Empty, all anchors, single anchors, and anchors at the first and the 
+    last frames."""
+    columns = []
+
+    columns.append(np.ones(frames_num, dtype=dtype))
+    columns.append(np.zeros(frames_num, dtype=dtype))
+    columns.append(np.full(frames_num, 0.3, dtype=dtype))
+
+    for t in sorted(set([0, 1, frames_num // 2, frames_num - 2, frames_num - 1])):
+        if 0 <= t < frames_num:
+            column = np.ones(frames_num, dtype=dtype)
+            column[t] = 0.2
+            columns.append(column)
+
+    column = np.ones(frames_num, dtype=dtype)
+    column[[0, frames_num - 1]] = [0.1, 0.4]
+    columns.append(column)
+
+    return columns
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('frames_num', [1, 2, 3, 7, 101, 1001])
+def test_get_regression_1d(dtype, frames_num):
+    target_processor = get_target_processor()
+    random_state = np.random.RandomState(frames_num)
+
+    columns = special_regression_columns(frames_num, dtype) + [
+        random_regression_column(random_state, frames_num, dtype) 
+        for _ in range(20)]
+
+    for column in columns:
+        output = target_processor.get_regression(column.copy())
+        expected = target_processor.get_regression_loop(column.copy())
+        assert output.dtype == expected.dtype
+        np.testing.assert_array_equal(output, expected)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('frames_num', [1, 2, 5, 101, 1001])
+def test_get_regression_2d(dtype, frames_num):
+    target_processor = get_target_processor()
+    random_state = np.random.RandomState(1000 + frames_num)
+
+    columns = special_regression_columns(frames_num, dtype) + [
+        random_regression_column(random_state, frames_num, dtype) 
+        for _ in range(config.classes_num)]
+    random_state.shuffle(columns)
+    roll = np.stack(columns, axis=1)
+
+    output = target_processor.get_regression(roll.copy())
+    assert output.shape == roll.shape
+    assert output.dtype == roll.dtype
+
+    for k in range(roll.shape[1]):
+        np.testing.assert_array_equal(output[:, k], 
+            target_processor.get_regression_loop(roll[:, k].copy()))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_get_regression_2d_without_anchors(dtype):
+    target_processor = get_target_processor()
+    roll = np.ones((101, config.classes_num), dtype=dtype)
+    np.testing.assert_array_equal(target_processor.get_regression(roll), 
+        np.zeros_like(roll))
+
+
+def get_regression_post_processor():
+    return RegressionPostProcessor(frames_per_second=config.frames_per_second, 
+        classes_num=config.classes_num, onset_threshold=0.3, 
+        offset_threshold=0.3, frame_threshold=0.1, pedal_offset_threshold=0.2)
+
+
+def random_regression_heads(random_state, frames_num, classes_num, dtype):
+    """Random regression outputs with sharp peaks, plateaus, NaNs, and peaks at 
+    the first and the last frames."""
+    x = random_state.uniform(0, 1, (frames_num, classes_num))
+    x = np.round(x, 1)
+    """Rounding makes plateaus of equal neighbours"""
+
+    if frames_num >= 5:
+        for k in range(classes_num):
+            for t in random_state.randint(2, frames_num - 2, 3):
+                x[t - 2 : t + 3, k] = [0.2, 0.6, 0.9, 0.7, 0.2]
+
+    x[0, 0 : classes_num : 3] = 1.
+    x[-1, 1 : classes_num : 3] = 1.
+    x[random_state.uniform(0, 1, x.shape) < 0.02] = np.nan
+    x[:, -1] = 0.5
+    """A column of a single plateau"""
+    return x.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('frames_num', [1, 4, 5, 6, 50, 1001])
+@pytest.mark.parametrize('neighbour', [1, 2])
+def test_get_binarized_output_from_regression(dtype, frames_num, neighbour):
+    post_processor = get_regression_post_processor()
+    random_state = np.random.RandomState(frames_num * 10 + neighbour)
+
+    for threshold in [0.3, 0.5]:
+        reg_output = random_regression_heads(random_state, frames_num, 
+            config.classes_num, dtype)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            (binary_output, shift_output) = \
+                post_processor.get_binarized_output_from_regression(
+                    reg_output.copy(), threshold, neighbour)
+            (expected_binary_output, expected_shift_output) = \
+                post_processor.get_binarized_output_from_regression_loop(
+                    reg_output.copy(), threshold, neighbour)
+
+        if frames_num >= 50:
+            assert np.sum(binary_output) > 0
+        np.testing.assert_array_equal(binary_output, expected_binary_output)
+        np.testing.assert_array_equal(shift_output, expected_shift_output)
+
+
+def write_packed_hdf5(hdf5_path, split, duration):
+    with h5py.File(hdf5_path, 'w') as hf:
+        hf.attrs.create('split', data=split.encode(), dtype='S20')
+        hf.attrs.create('year', data=b'2004', dtype='S10')
+        hf.attrs.create('duration', data=duration, dtype=np.float32)
+
+
+def test_read_hdf5s_meta_detects_rewritten_packs(tmp_path, monkeypatch):
+    hdf5s_dir = str(tmp_path / 'maestro')
+    os.makedirs(os.path.join(hdf5s_dir, '2004'))
+    hdf5_path = os.path.join(hdf5s_dir, '2004', 'a.h5')
+    write_packed_hdf5(hdf5_path, 'train', 20.)
+    write_packed_hdf5(os.path.join(hdf5s_dir, '2004', 'b.h5'), 'test', 30.)
+    write_manifest(hdf5s_dir)
+
+    crawls = []
+    monkeypatch.setattr(utilities, 'crawl_hdf5s_meta', 
+        lambda hdf5s_dir: crawls.append(hdf5s_dir) or crawl_hdf5s_meta(hdf5s_dir))
+
+    hdf5s_meta = read_hdf5s_meta(hdf5s_dir)
+    assert crawls == []
+    assert {meta['path']: meta['split'] for meta in hdf5s_meta} == {
+        os.path.join('2004', 'a.h5'): 'train', os.path.join('2004', 'b.h5'): 'test'}
+
+    # Rewritten under the same name, e.g. by an interrupted pack_files resume
+    write_packed_hdf5(hdf5_path, 'validation', 40.)
+    stat = os.stat(hdf5_path)
+    os.utime(hdf5_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    hdf5s_meta = read_hdf5s_meta(hdf5s_dir)
+    assert len(crawls) == 1
+    meta = [meta for meta in hdf5s_meta if meta['path'].endswith('a.h5')][0]
+    assert (meta['split'], meta['duration']) == ('validation', 40.)
+
+
+def random_midi_events(random_state, duration):
+    """Random note and sustain pedal events sorted by time, including repeated 
+    onsets of the same note, notes released under the pedal, and pedal 
+    control changes with successive values above 64."""
+    events = []
+
+    for _ in range(int(duration * 8)):
+        midi_note = random_state.randint(60, 72)
+        onset_time = random_state.uniform(0, duration)
+        offset_time = onset_time + random_state.exponential(0.3)
+        velocity = random_state.randint(1, 128)
+        events.append((onset_time, 'note_on channel=0 note={} velocity={} time=0'.format(
+            midi_note, velocity)))
+        if random_state.rand() < 0.5:
+            events.append((offset_time, 'note_on channel=0 note={} velocity=0 time=0'.format(midi_note)))
+        else:
+            events.append((offset_time, 'note_off channel=0 note={} velocity=64 time=0'.format(midi_note)))
+
+    for _ in range(int(duration)):
+        pedal_time = random_state.uniform(0, duration)
+        for value in random_state.randint(0, 128, random_state.randint(1, 5)):
+            events.append((pedal_time, 'control_change channel=0 control=64 value={} time=0'.format(value)))
+            pedal_time += random_state.exponential(0.5)
+
+    events.append((random_state.uniform(0, duration), 'set_tempo tempo=500000 time=0'))
+    events.sort(key=lambda event: event[0])
+    midi_events_time = np.round([event[0] for event in events], 5)
+
+    return midi_events_time, [event[1] for event in events]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('extend_pedal', [True, False])
+def test_process_equals_full_history(seed, extend_pedal):
+    """Parsing the event strings, the event table, and the event table from 
+    the first event give the same targets."""
+    random_state = np.random.RandomState(seed)
+    target_processor = get_target_processor()
+    (midi_events_time, midi_events) = random_midi_events(random_state, duration=60.)
+    midi_event_table = utilities.midi_events_to_table(midi_events_time, midi_events)
+    midi_events_time = midi_event_table['time']
+    """Times are stored as float32, see read_midi_events"""
+    full_history_bgn = np.zeros(len(midi_events) + 1, dtype=np.int32)
+
+    start_times = list(random_state.uniform(-5, 60, 10))
+
+    # Segments beginning just after pedal releases and note offsets
+    half_frame = 0.5 / config.frames_per_second
+    for midi_event_time in random_state.choice(midi_events_time, 10):
+        start_times.append(midi_event_time + random_state.uniform(0, half_frame))
+    start_times.append(midi_events_time[-1] + half_frame)
+
+    for start_time in start_times:
+        (target_dict, _, _) = target_processor.process(start_time, 
+            midi_events_time, midi_events, extend_pedal=extend_pedal)
+        (table_target_dict, _, _) = target_processor.process(start_time, 
+            midi_events_time, midi_event_table, extend_pedal=extend_pedal)
+        (expected_target_dict, _, _) = target_processor.process(start_time, 
+            midi_events_time, midi_event_table, extend_pedal=extend_pedal, 
+            midi_events_active_bgn=full_history_bgn)
+
+        for key in expected_target_dict.keys():
+            np.testing.assert_array_equal(target_dict[key], expected_target_dict[key], err_msg=key)
+            np.testing.assert_array_equal(table_target_dict[key], expected_target_dict[key], err_msg=key)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_process_from_cache_equals_process(seed):
+    """Targets sliced from a target cache are identical to targets written 
+    from MIDI events, except for quantized regression targets."""
+    random_state = np.random.RandomState(seed)
+    target_processor = get_target_processor()
+    duration = 30.
+    (midi_events_time, midi_events) = random_midi_events(random_state, duration)
+    midi_event_table = utilities.midi_events_to_table(midi_events_time, midi_events)
+    midi_events_time = midi_event_table['time']
+    midi_events_active_bgn = utilities.get_midi_events_active_bgn(midi_event_table)
+
+    target_cache = TargetProcessor(duration, config.frames_per_second, 
+        config.begin_note, config.classes_num).process_to_cache(
+        midi_events_time, midi_event_table, extend_pedal=True, 
+        midi_events_active_bgn=midi_events_active_bgn)
+
+    # Segments of hops, between frames, and outside the recording
+    start_times = list(np.arange(0, duration - config.segment_seconds + 1e-6, 
+        config.hop_seconds))
+    start_times += list(random_state.uniform(-3, duration, 10))
+
+    for start_time in start_times:
+        for note_shift in [0, 2, -3, 40, -40]:
+            (target_dict, _, _) = target_processor.process(start_time, 
+                midi_events_time, midi_event_table, extend_pedal=True, 
+                note_shift=note_shift, 
+                midi_events_active_bgn=midi_events_active_bgn)
+            (cached_target_dict, _, _) = target_processor.process_from_cache(
+                target_cache, start_time, midi_events_time, midi_event_table, 
+                note_shift=note_shift, 
+                midi_events_active_bgn=midi_events_active_bgn)
+
+            for key in target_dict.keys():
+                if key.startswith('reg'):
+                    np.testing.assert_allclose(cached_target_dict[key], 
+                        target_dict[key], rtol=0, atol=1e-3, err_msg=key)
+                else:
+                    np.testing.assert_array_equal(cached_target_dict[key], 
+                        target_dict[key], err_msg=key)
@@ -8,16 +8,129 @@ import collections
 import librosa
 import sox
 import logging
+import torch
+import torch.utils.data
 
 from utilities import (create_folder, int16_to_float32, traverse_folder, 
     pad_truncate_sequence, TargetProcessor, write_events_to_midi, 
-    plot_waveform_midi_targets)
+    plot_waveform_midi_targets, read_midi_events, read_hdf5s_meta, 
+    get_target_cache_path, get_waveform_store_paths, read_waveform_store_indexes, 
+    get_shifted_waveform_store_path)
 import config
 
 
+class Hdf5Pool(object):
+    def __init__(self, capacity=128, log_interval=10000):
+        """Pool of open read-only hdf5 files. The least recently used file is 
+        closed when more than capacity files are open. Each process owns its 
+        own handles: handles inherited through fork are dropped, see 
+        worker_init_fn.
+
+        Args:
+          capacity: int, maximum number of open files
+          log_interval: int | None, log statistics every log_interval reads
+        """
+        self.capacity = capacity
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        """Forget open files and statistics. Handles inherited from a parent 
+        process are not closed, they are still used by the parent."""
+        self.pid = os.getpid()
+        self.hdf5s = collections.OrderedDict()
+        self.opens = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, hdf5_path):
+        """Get an open hdf5 file. Do not close it, it is owned by the pool.
+
+        Args:
+          hdf5_path: str
+
+        Returns:
+          hf: h5py.File
+        """
+        if os.getpid() != self.pid:
+            self.reset()
+
+        if hdf5_path in self.hdf5s.keys():
+            self.hdf5s.move_to_end(hdf5_path)
+            self.hits += 1
+        else:
+            self.hdf5s[hdf5_path] = self.open_file(hdf5_path)
+            self.opens += 1
+
+            if len(self.hdf5s) > self.capacity:
+                (_, hf) = self.hdf5s.popitem(last=False)
+                self.close_file(hf)
+                self.evictions += 1
+
+        if self.log_interval and (self.opens + self.hits) % self.log_interval == 0:
+            logging.info('Process {} {}: {}'.format(self.pid, 
+                self.__class__.__name__, self.statistics()))
+
+        return self.hdf5s[hdf5_path]
+
+    def open_file(self, path):
+        return h5py.File(path, 'r')
+
+    def close_file(self, hf):
+        hf.close()
+
+    def statistics(self):
+        return {
+            'opens': self.opens, 
+            'hits': self.hits, 
+            'evictions': self.evictions, 
+            'open_files': len(self.hdf5s)}
+
+    def close(self):
+        for hf in self.hdf5s.values():
+            self.close_file(hf)
+        self.hdf5s.clear()
+
+    def __getstate__(self):
+        """Open files are not pickled, e.g. for spawned DataLoader workers."""
+        return {'capacity': self.capacity, 'log_interval': self.log_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class MemmapPool(Hdf5Pool):
+    """Pool of read-only memory-mapped npy files, e.g. target caches. Each 
+    mapping keeps a file descriptor open until it is evicted."""
+
+    def open_file(self, path):
+        return np.load(path, mmap_mode='r')
+
+    def close_file(self, x):
+        """The mapping is closed when it is garbage collected."""
+        pass
+
+
+def worker_init_fn(worker_id):
+    """Used as worker_init_fn of DataLoader. Let each worker open its own hdf5 
+    files instead of using the ones opened by the main process before fork."""
+    worker_info = torch.utils.data.get_worker_info()
+    for value in vars(worker_info.dataset).values():
+        if isinstance(value, Hdf5Pool):
+            value.reset()
+
+    if isinstance(worker_info.dataset, MaestroDataset):
+        seed_sequence = np.random.SeedSequence(
+            [worker_info.dataset.random_seed, worker_id])
+        worker_info.dataset.set_random_seed(int(seed_sequence.generate_state(1)[0]))
+        """Workers draw different note shifts and augmentations"""
+
+
 class MaestroDataset(object):
     def __init__(self, hdf5s_dir, segment_seconds, frames_per_second, 
-        max_note_shift=0, augmentor=None):
+        max_note_shift=0, augmentor=None, max_open_hdf5s=128, 
+        target_caches_dir=None, storage='hdf5', waveforms_dir=None, 
+        pitch_shift_stores=False, compact_rolls=True):
         """This class takes the meta of an audio segment as input, and return 
         the waveform and targets of the audio segment. This class is used by 
         DataLoader. 
@@ -28,6 +141,23 @@ class MaestroDataset(object):
           frames_per_second: int
           max_note_shift: int, number of semitone for pitch augmentation
           augmentor: object
+          max_open_hdf5s: int, capacity of the pool of open hdf5 files in each 
+            DataLoader worker
+          target_caches_dir: str | None, slice targets from the caches built by 
+            features.py build_target_caches instead of writing them from MIDI 
+            events
+          storage: 'hdf5' | 'memmap', read waveforms from hdf5 files or from 
+            the memory-mapped waveform stores written by features.py 
+            write_waveform_stores
+          waveforms_dir: str, directory of waveform stores, used if storage is 
+            'memmap'
+          pitch_shift_stores: bool, read pitch shifted waveforms from the stores 
+            written by features.py write_pitch_shifted_stores instead of 
+            shifting them by librosa, used if storage is 'memmap'. Note shifts 
+            without a store are still shifted by librosa.
+          compact_rolls: bool, return uint8 binary and velocity rolls and 
+            float32 regression rolls instead of float64 rolls, see 
+            TargetProcessor
         """
         self.hdf5s_dir = hdf5s_dir
         self.segment_seconds = segment_seconds
@@ -39,12 +169,91 @@ class MaestroDataset(object):
         self.segment_samples = int(self.sample_rate * self.segment_seconds)
         self.augmentor = augmentor
 
-        self.random_state = np.random.RandomState(1234)
+        self.random_seed = 1234
+        self.random_state = np.random.RandomState(self.random_seed)
+        """DataLoader workers are reseeded from self.random_seed by 
+        worker_init_fn"""
+
+        self.hdf5_pool = Hdf5Pool(capacity=max_open_hdf5s)
+        """Keep hdf5 files open across segments."""
+
+        self.target_caches_dir = target_caches_dir
+
+        if self.target_caches_dir:
+            if not os.path.isdir(self.target_caches_dir):
+                raise Exception('Target caches {} do not exist, build them by '
+                    'features.py build_target_caches!'.format(self.target_caches_dir))
+
+            self.target_cache_pool = MemmapPool(capacity=max_open_hdf5s)
+        else:
+            self.target_cache_pool = None
+
+        self.storage = storage
+
+        if self.storage == 'hdf5':
+            self.waveform_pool = None
+
+        elif self.storage == 'memmap':
+            if not (waveforms_dir and os.path.isdir(waveforms_dir)):
+                raise Exception('Waveform stores {} do not exist, write them by '
+                    'features.py write_waveform_stores!'.format(waveforms_dir))
+
+            self.waveforms_dir = waveforms_dir
+            self.waveform_index = read_waveform_store_indexes(waveforms_dir)
+            self.waveform_pool = MemmapPool(capacity=max_open_hdf5s)
+            """A few large files, one per split, shared by the page cache of 
+            all workers."""
+
+        else:
+            raise Exception('Incorrect storage!')
+
+        self.shifted_waveform_paths = {}
+
+        if pitch_shift_stores:
+            if self.storage != 'memmap':
+                raise Exception('Pitch shifted waveform stores are only read '
+                    'with memmap storage!')
+
+            for split in sorted(set([value[0] for value in self.waveform_index.values()])):
+                (waveform_path, _) = get_waveform_store_paths(waveforms_dir, split)
+                samples_num = np.load(waveform_path, mmap_mode='r').shape[0]
+
+                for note_shift in range(-max_note_shift, max_note_shift + 1):
+                    shifted_path = get_shifted_waveform_store_path(
+                        waveforms_dir, split, note_shift)
+
+                    if note_shift == 0 or not os.path.isfile(shifted_path):
+                        continue
+
+                    if np.load(shifted_path, mmap_mode='r').shape[0] != samples_num:
+                        raise Exception('{} does not match {}, write it again by '
+                            'features.py write_pitch_shifted_stores!'.format(
+                            shifted_path, waveform_path))
+
+                    self.shifted_waveform_paths[(split, note_shift)] = shifted_path
+
+            logging.info('Pitch shifted waveform stores: {}'.format(
+                sorted(self.shifted_waveform_paths.keys())))
 
         self.target_processor = TargetProcessor(self.segment_seconds, 
-            self.frames_per_second, self.begin_note, self.classes_num)
+            self.frames_per_second, self.begin_note, self.classes_num, 
+            compact_rolls=compact_rolls)
         """Used for processing MIDI events to target."""
 
+    def set_random_seed(self, random_seed):
+        """Reseed the random states of note shifts and of the augmentor.
+
+        Args:
+          random_seed: int
+        """
+        (dataset_seed, augmentor_seed) = np.random.SeedSequence(
+            random_seed).generate_state(2)
+
+        self.random_state = np.random.RandomState(dataset_seed)
+
+        if self.augmentor:
+            self.augmentor.random_state = np.random.RandomState(augmentor_seed)
+
     def __getitem__(self, meta):
         """Prepare input and target of a segment for training.
         
@@ -78,34 +287,77 @@ class MaestroDataset(object):
         note_shift = self.random_state.randint(low=-self.max_note_shift, 
             high=self.max_note_shift + 1)
 
-        # Load hdf5
-        with h5py.File(hdf5_path, 'r') as hf:
-            start_sample = int(start_time * self.sample_rate)
-            end_sample = start_sample + self.segment_samples
+        # Load waveform
+        hf = None
+        shifted = False
 
-            if end_sample >= hf['waveform'].shape[0]:
-                start_sample -= self.segment_samples
-                end_sample -= self.segment_samples
+        if self.waveform_pool is not None:
+            relative_path = os.path.join(year, hdf5_name)
 
-            waveform = int16_to_float32(hf['waveform'][start_sample : end_sample])
+            if relative_path not in self.waveform_index.keys():
+                raise Exception('{} is not in waveform stores, write them again '
+                    'by features.py write_waveform_stores!'.format(relative_path))
 
-            if self.augmentor:
-                waveform = self.augmentor.augment(waveform)
+            (split, offset, samples_num) = self.waveform_index[relative_path]
 
-            if note_shift != 0:
-                """Augment pitch"""
-                waveform = librosa.effects.pitch_shift(waveform, self.sample_rate, 
-                    note_shift, bins_per_octave=12)
+            if (split, note_shift) in self.shifted_waveform_paths.keys():
+                waveform_path = self.shifted_waveform_paths[(split, note_shift)]
+                shifted = True
+            else:
+                (waveform_path, _) = get_waveform_store_paths(self.waveforms_dir, split)
 
-            data_dict['waveform'] = waveform
+            waveforms = self.waveform_pool.get(waveform_path)
 
-            midi_events = [e.decode() for e in hf['midi_event'][:]]
-            midi_events_time = hf['midi_event_time'][:]
+        else:
+            hf = self.hdf5_pool.get(hdf5_path)
+            waveforms = hf['waveform']
+            (offset, samples_num) = (0, waveforms.shape[0])
 
+        start_sample = int(start_time * self.sample_rate)
+        end_sample = start_sample + self.segment_samples
+
+        if end_sample >= samples_num:
+            start_sample -= self.segment_samples
+            end_sample -= self.segment_samples
+
+        waveform = int16_to_float32(
+            waveforms[offset + start_sample : offset + end_sample])
+
+        if note_shift != 0 and not shifted:
+            """Augment pitch"""
+            waveform = librosa.effects.pitch_shift(waveform, self.sample_rate, 
+                note_shift, bins_per_octave=12)
+
+        # Augment after pitch shift, as waveforms read from pitch shifted 
+        # stores are shifted before augmentation
+        if self.augmentor:
+            waveform = self.augmentor.augment(waveform)
+
+        data_dict['waveform'] = waveform
+
+        if hf is None:
+            hf = self.hdf5_pool.get(hdf5_path)
+
+        (midi_events_time, midi_events, midi_events_active_bgn) = \
+            read_midi_events(hf)
+
+        if self.target_cache_pool is not None:
+            # Slice target from cache
+            target_cache_path = get_target_cache_path(self.target_caches_dir, 
+                self.hdf5s_dir, hdf5_path)
+
+            (target_dict, note_events, pedal_events) = \
+                self.target_processor.process_from_cache(
+                    self.target_cache_pool.get(target_cache_path), start_time, 
+                    midi_events_time, midi_events, note_shift=note_shift, 
+                    midi_events_active_bgn=midi_events_active_bgn)
+
+        else:
             # Process MIDI events to target
             (target_dict, note_events, pedal_events) = \
                 self.target_processor.process(start_time, midi_events_time, 
-                    midi_events, extend_pedal=True, note_shift=note_shift)
+                    midi_events, extend_pedal=True, note_shift=note_shift, 
+                    midi_events_active_bgn=midi_events_active_bgn)
 
         # Combine input and target
         for key in target_dict.keys():
@@ -157,6 +409,73 @@ class Augmentor(object):
         return np.exp(self.random_state.uniform(np.log(low), np.log(high), size))
 
 
+class SegmentIndex(object):
+    def __init__(self, hdf5_names, years, file_ids, start_times):
+        """Columnar index of segments. Indexing returns the meta of a segment 
+        used by MaestroDataset, e.g. ['2004', 'xx.h5', 65.0].
+
+        Args:
+          hdf5_names: list of str, one per hdf5 file
+          years: list of str, one per hdf5 file
+          file_ids: (segments_num,), int32, index of hdf5_names of each segment
+          start_times: (segments_num,), float32, start time of each segment
+        """
+        self.hdf5_names = hdf5_names
+        self.years = years
+        self.file_ids = file_ids
+        self.start_times = start_times
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def __getitem__(self, index):
+        file_id = self.file_ids[index]
+        return [self.years[file_id], self.hdf5_names[file_id], 
+            float(self.start_times[index])]
+
+
+def get_segment_list(hdf5s_dir, split, segment_seconds, hop_seconds, mini_data):
+    """Get the meta of all segments of a split. The meta of hdf5 files is read 
+    from the manifest written by features.py, or crawled if it is missing.
+
+    Args:
+      hdf5s_dir: str
+      split: 'train' | 'validation' | 'test'
+      segment_seconds: float
+      hop_seconds: float
+      mini_data: bool, only use 10 files for debugging
+
+    Returns:
+      segment_list: SegmentIndex
+    """
+    hdf5_names = []
+    years = []
+    segments_nums = []
+    start_times = []
+
+    for meta in read_hdf5s_meta(hdf5s_dir):
+        if meta['split'] == split:
+            hdf5_names.append(os.path.basename(meta['path']))
+            years.append(meta['year'])
+            duration = np.float32(meta['duration'])
+            start_time = 0
+            segments_num = 0
+            while (start_time + segment_seconds < duration):
+                start_times.append(start_time)
+                start_time += hop_seconds
+                segments_num += 1
+
+            segments_nums.append(segments_num)
+            
+            if mini_data and len(hdf5_names) == 10:
+                break
+
+    file_ids = np.repeat(np.arange(len(hdf5_names), dtype=np.int32), segments_nums)
+    start_times = np.array(start_times, dtype=np.float32)
+
+    return SegmentIndex(hdf5_names, years, file_ids, start_times)
+
+
 class Sampler(object):
     def __init__(self, hdf5s_dir, split, segment_seconds, hop_seconds, 
             batch_size, mini_data, random_seed=1234):
@@ -178,35 +497,17 @@ class Sampler(object):
         self.batch_size = batch_size
         self.random_state = np.random.RandomState(random_seed)
 
-        (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
-        self.segment_list = []
-
-        n = 0
-        for hdf5_path in hdf5_paths:
-            with h5py.File(hdf5_path, 'r') as hf:
-                if hf.attrs['split'].decode() == split:
-                    audio_name = hdf5_path.split('/')[-1]
-                    year = hf.attrs['year'].decode()
-                    start_time = 0
-                    while (start_time + self.segment_seconds < hf.attrs['duration']):
-                        self.segment_list.append([year, audio_name, start_time])
-                        start_time += self.hop_seconds
-                    
-                    n += 1
-                    if mini_data and n == 10:
-                        break
-        """self.segment_list looks like:
-        [['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 0], 
-         ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 1.0], 
-         ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 2.0]
-         ...]"""
+        self.segment_list = get_segment_list(hdf5s_dir, split, 
+            segment_seconds, hop_seconds, mini_data)
+        """self.segment_list is a SegmentIndex, self.segment_list[i] looks like:
+        ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 1.0]"""
 
         logging.info('{} segments: {}'.format(split, len(self.segment_list)))
         if len(self.segment_list) == 0:
             raise Exception(f'Cannot initialize split {split} with empty segment list - check path of hdf5s folder {hdf5s_dir}')
 
         self.pointer = 0
-        self.segment_indexes = np.arange(len(self.segment_list))
+        self.segment_indexes = np.arange(len(self.segment_list), dtype=np.int32)
         self.random_state.shuffle(self.segment_indexes)
 
     def __iter__(self):
@@ -237,12 +538,86 @@ class Sampler(object):
             
     def load_state_dict(self, state):
         self.pointer = state['pointer']
-        self.segment_indexes = state['segment_indexes']
+        self.segment_indexes = np.array(state['segment_indexes'], dtype=np.int32)
+
+
+class DistributedSampler(Sampler):
+    def __init__(self, hdf5s_dir, split, segment_seconds, hop_seconds, 
+            batch_size, mini_data, rank, world_size, random_seed=1234):
+        """Sampler for distributed training. All ranks shuffle the same 
+        permutation of segments with the same random seed, and each rank 
+        samples from its own disjoint shard of the permutation. Shards have 
+        the same length, so that ranks stay in step and reshuffle together.
+
+        Args:
+          hdf5s_dir: str
+          split: 'train' | 'validation' | 'test'
+          segment_seconds: float
+          hop_seconds: float
+          batch_size: int, mini-batch size of each rank
+          mini_data: bool, sample from a small amount of data for debugging
+          rank: int
+          world_size: int
+        """
+        super(DistributedSampler, self).__init__(hdf5s_dir=hdf5s_dir, 
+            split=split, segment_seconds=segment_seconds, 
+            hop_seconds=hop_seconds, batch_size=batch_size, 
+            mini_data=mini_data, random_seed=random_seed)
+
+        assert 0 <= rank < world_size
+        self.rank = rank
+        self.world_size = world_size
+
+        if len(self.segment_indexes) < world_size:
+            raise Exception('Cannot shard {} segments to {} ranks!'.format(
+                len(self.segment_indexes), world_size))
+
+        self.shard_indexes = self.get_shard_indexes()
+
+    def get_shard_indexes(self):
+        shard_length = len(self.segment_indexes) // self.world_size
+        return self.segment_indexes[self.rank :: self.world_size][0 : shard_length]
+
+    def __iter__(self):
+        while True:
+            batch_segment_list = []
+            i = 0
+            while i < self.batch_size:
+                index = self.shard_indexes[self.pointer]
+                self.pointer += 1
+
+                if self.pointer >= len(self.shard_indexes):
+                    self.pointer = 0
+                    self.random_state.shuffle(self.segment_indexes)
+                    self.shard_indexes = self.get_shard_indexes()
+
+                batch_segment_list.append(self.segment_list[index])
+                i += 1
+
+            yield batch_segment_list
+
+    def state_dict(self):
+        """The state is the same on all ranks, so the state of any rank 
+        resumes every rank."""
+        state = {
+            'pointer': self.pointer, 
+            'segment_indexes': self.segment_indexes, 
+            'world_size': self.world_size}
+        return state
+
+    def load_state_dict(self, state):
+        """Also loads states of Sampler and of other world sizes, where the 
+        pointer is rescaled to the number of segments sampled by all ranks."""
+        self.segment_indexes = np.array(state['segment_indexes'], dtype=np.int32)
+        self.shard_indexes = self.get_shard_indexes()
+        self.pointer = state['pointer'] * state.get('world_size', 1) // self.world_size
+        self.pointer = min(self.pointer, len(self.shard_indexes) - 1)
 
 
 class TestSampler(object):
     def __init__(self, hdf5s_dir, split, segment_seconds, hop_seconds, 
-            batch_size, mini_data, random_seed=1234):
+            batch_size, mini_data, random_seed=1234, rank=0, world_size=1, 
+            max_evaluate_iteration=20):
         """Sampler for testing.
 
         Args:
@@ -252,6 +627,10 @@ class TestSampler(object):
           hop_seconds: float
           batch_size: int
           mini_data: bool, sample from a small amount of data for debugging
+          rank: int, in distributed evaluation each rank yields every 
+            world_size-th of the mini-batches
+          world_size: int
+          max_evaluate_iteration: int, number of mini-batches to evaluate
         """
         assert split in ['train', 'validation', 'test']
         self.hdf5s_dir = hdf5s_dir
@@ -260,34 +639,18 @@ class TestSampler(object):
         self.sample_rate = config.sample_rate
         self.batch_size = batch_size
         self.random_state = np.random.RandomState(random_seed)
-        self.max_evaluate_iteration = 20    # Number of mini-batches to validate
-
-        (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
-        self.segment_list = []
-
-        n = 0
-        for hdf5_path in hdf5_paths:
-            with h5py.File(hdf5_path, 'r') as hf:
-                if hf.attrs['split'].decode() == split:
-                    audio_name = hdf5_path.split('/')[-1]
-                    year = hf.attrs['year'].decode()
-                    start_time = 0
-                    while (start_time + self.segment_seconds < hf.attrs['duration']):
-                        self.segment_list.append([year, audio_name, start_time])
-                        start_time += self.hop_seconds
-                    
-                    n += 1
-                    if mini_data and n == 10:
-                        break
-        """self.segment_list looks like:
-        [['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 0], 
-         ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 1.0], 
-         ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 2.0]
-         ...]"""
+        self.max_evaluate_iteration = max_evaluate_iteration    # Number of mini-batches to validate
+        self.rank = rank
+        self.world_size = world_size
+
+        self.segment_list = get_segment_list(hdf5s_dir, split, 
+            segment_seconds, hop_seconds, mini_data)
+        """self.segment_list is a SegmentIndex, self.segment_list[i] looks like:
+        ['2004', 'MIDI-Unprocessed_SMF_22_R1_2004_01-04_ORIG_MID--AUDIO_22_R1_2004_17_Track17_wav.h5', 1.0]"""
 
         logging.info('Evaluate {} segments: {}'.format(split, len(self.segment_list)))
 
-        self.segment_indexes = np.arange(len(self.segment_list))
+        self.segment_indexes = np.arange(len(self.segment_list), dtype=np.int32)
         self.random_state.shuffle(self.segment_indexes)
 
     def __iter__(self):
@@ -309,7 +672,8 @@ class TestSampler(object):
 
             iteration += 1
 
-            yield batch_segment_list
+            if (iteration - 1) % self.world_size == self.rank:
+                yield batch_segment_list
 
     def __len__(self):
         return -1
@@ -335,3 +699,39 @@ def collate_fn(list_data_dict):
         np_data_dict[key] = np.array([data_dict[key] for data_dict in list_data_dict])
     
     return np_data_dict
+
+
+COMPACT_ROLLS = ['onset_roll', 'offset_roll', 'frame_roll', 'velocity_roll', 
+    'mask_roll', 'pedal_onset_roll', 'pedal_offset_roll', 'pedal_frame_roll']
+"""Rolls of integers in [0, 127], collated to uint8 by compact_collate_fn."""
+
+
+def compact_collate_fn(list_data_dict):
+    """Collate input and target of segments to a mini-batch of torch tensors, 
+    written straight into one preallocated array per key. Rolls in 
+    COMPACT_ROLLS are uint8 and other arrays are float32, instead of the 
+    float64 arrays of collate_fn. Tensors are sent from DataLoader workers by 
+    shared memory, see pytorch_utils.PinnedBatchBuffer for moving them to a 
+    device.
+
+    Args:
+      list_data_dict: see collate_fn
+
+    Returns:
+      batch_data_dict: e.g. {
+        'waveform': (batch_size, segment_samples), torch.float32
+        'frame_roll': (batch_size, segment_frames, classes_num), torch.uint8, 
+        ...}
+    """
+    batch_data_dict = {}
+    for key in list_data_dict[0].keys():
+        dtype = np.uint8 if key in COMPACT_ROLLS else np.float32
+        x = np.empty((len(list_data_dict),) + np.shape(list_data_dict[0][key]), 
+            dtype=dtype)
+
+        for n, data_dict in enumerate(list_data_dict):
+            x[n] = data_dict[key]
+
+        batch_data_dict[key] = torch.from_numpy(x)
+
+    return batch_data_dict
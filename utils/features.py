@@ -7,25 +7,228 @@ import logging
 import h5py
 import librosa
 import logging
+import multiprocessing
 
 from utilities import (create_folder, float32_to_int16, create_logging, 
-    get_filename, read_metadata, read_midi, read_maps_midi)
+    get_filename, read_metadata, read_midi, read_maps_midi, traverse_folder, 
+    midi_events_to_table, get_midi_events_active_bgn, write_manifest, 
+    read_midi_events, TargetProcessor, get_target_cache_path, 
+    get_target_cache_dtype, write_waveform_stores, int16_to_float32, 
+    get_waveform_store_paths, read_waveform_store_indexes, 
+    get_shifted_waveform_store_path)
 import config
 
 
+def get_progress_path(hdf5s_dir):
+    """Path of the progress log of packing, e.g. hdf5s/maestro_progress.txt 
+    for hdf5s/maestro."""
+    return '{}_progress.txt'.format(os.path.normpath(hdf5s_dir))
+
+
+def run_pack_job(job):
+    """Run a packing job in a worker process.
+
+    Args:
+      job: (pack_func, packed_hdf5_path, args), pack_func(packed_hdf5_path, 
+        *args) packs a file and returns the duration of its audio
+
+    Returns:
+      packed_hdf5_path: str
+      duration: float, seconds of audio
+      run_time: float, seconds of packing
+    """
+    (pack_func, packed_hdf5_path, args) = job
+    run_time = time.time()
+    duration = pack_func(packed_hdf5_path, *args)
+    return packed_hdf5_path, duration, time.time() - run_time
+
+
+def pack_files(jobs, hdf5s_dir, num_workers):
+    """Run packing jobs in a pool of processes. Each packed file is appended 
+    to a progress log, so that a run interrupted before finishing all jobs 
+    skips the packed files when it is started again. The log is removed when 
+    all jobs are finished, so that the next run packs all files again.
+
+    Args:
+      jobs: list of job, see run_pack_job
+      hdf5s_dir: str
+      num_workers: int, jobs are run in this process if 1
+    """
+    progress_path = get_progress_path(hdf5s_dir)
+    packed_paths = set()
+
+    if os.path.isfile(progress_path):
+        with open(progress_path, 'r') as f:
+            packed_paths = set([line.strip() for line in f if line.strip()])
+
+    jobs = [job for job in jobs if not (os.path.relpath(job[1], hdf5s_dir) in 
+        packed_paths and os.path.isfile(job[1]))]
+
+    logging.info('Pack {} files, {} packed before, {} workers'.format(
+        len(jobs), len(packed_paths), num_workers))
+
+    create_folder(hdf5s_dir)
+    pack_time = time.time()
+    total_duration = 0.
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap_unordered(run_pack_job, jobs)
+    else:
+        pool = None
+        results = map(run_pack_job, jobs)
+
+    try:
+        with open(progress_path, 'a') as progress_file:
+            for n, (packed_hdf5_path, duration, run_time) in enumerate(results):
+                progress_file.write('{}\n'.format(os.path.relpath(packed_hdf5_path, hdf5s_dir)))
+                progress_file.flush()
+
+                total_duration += duration
+                logging.info('{} / {} {}, audio: {:.1f} s, time: {:.1f} s'.format(
+                    n + 1, len(jobs), packed_hdf5_path, duration, run_time))
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    pack_time = time.time() - pack_time
+    logging.info('Packed {} files, audio: {:.2f} h, time: {:.1f} s, {:.1f} '
+        'files / min, {:.1f}x real time'.format(len(jobs), total_duration / 3600, 
+        pack_time, len(jobs) / max(pack_time, 1e-6) * 60, 
+        total_duration / max(pack_time, 1e-6)))
+
+    os.remove(progress_path)
+
+
+def get_waveform_layout(chunk_seconds, compression):
+    """Get the hdf5 layout of packed waveforms, as keyword arguments of
+    create_dataset. A chunk of hop_seconds aligns chunks to the starts of
+    training segments, so that a segment is read from segment_seconds /
+    hop_seconds whole chunks.
+
+    Args:
+      chunk_seconds: float, 0 for a contiguous dataset. Compressed datasets
+        are chunked by hop_seconds if 0.
+      compression: 'none' | 'lzf' | 'gzip' | 'shuffle_lzf' | 'shuffle_gzip',
+        shuffle groups the low and high bytes of int16 samples before
+        compressing
+
+    Returns:
+      layout: dict, e.g. {'chunks': (16000,), 'compression': 'lzf'}
+    """
+    if compression not in ['none', 'lzf', 'gzip', 'shuffle_lzf', 'shuffle_gzip']:
+        raise Exception('Incorrect compression: {}!'.format(compression))
+
+    if compression != 'none' and not chunk_seconds:
+        chunk_seconds = config.hop_seconds
+
+    layout = {}
+
+    if chunk_seconds:
+        layout['chunks'] = (int(round(chunk_seconds * config.sample_rate)),)
+
+    if compression.endswith('lzf'):
+        layout['compression'] = 'lzf'
+
+    elif compression.endswith('gzip'):
+        layout['compression'] = 'gzip'
+        layout['compression_opts'] = 4
+
+    if compression.startswith('shuffle'):
+        layout['shuffle'] = True
+
+    return layout
+
+
+def create_waveform_dataset(hf, waveform, layout):
+    """Write a int16 waveform to a hdf5 file with a layout from
+    get_waveform_layout. Chunks are shortened to waveforms shorter than a
+    chunk.
+
+    Args:
+      hf: h5py.File
+      waveform: (samples_num,), int16
+      layout: dict
+    """
+    layout = dict(layout)
+
+    if 'chunks' in layout.keys():
+        layout['chunks'] = (max(min(layout['chunks'][0], len(waveform)), 1),)
+
+    hf.create_dataset(name='waveform', data=waveform, dtype=np.int16, **layout)
+
+
+def pack_maestro_file(packed_hdf5_path, dataset_dir, meta, layout={}):
+    """Load & resample a MAESTRO audio file, then write it with its MIDI 
+    events to a hdf5 file. The hdf5 file is written under a temporary name 
+    first, so that an interrupted write is not taken for a packed file.
+
+    Args:
+      packed_hdf5_path: str
+      dataset_dir: str, directory of dataset
+      meta: dict, meta of the audio file in the csv of MAESTRO, e.g. {
+        'canonical_composer': 'Alban Berg', 'split': 'train', ...}
+      layout: dict, hdf5 layout of the waveform, see get_waveform_layout
+
+    Returns:
+      duration: float, seconds of audio
+    """
+    sample_rate = config.sample_rate
+
+    # Read midi
+    midi_path = os.path.join(dataset_dir, meta['midi_filename'])
+    midi_dict = read_midi(midi_path)
+
+    # Load audio
+    audio_path = os.path.join(dataset_dir, meta['audio_filename'])
+    (audio, _) = librosa.core.load(audio_path, sr=sample_rate, mono=True)
+
+    create_folder(os.path.dirname(packed_hdf5_path))
+    tmp_path = '{}.tmp'.format(packed_hdf5_path)
+
+    with h5py.File(tmp_path, 'w') as hf:
+        hf.attrs.create('canonical_composer', data=meta['canonical_composer'].encode(), dtype='S100')
+        hf.attrs.create('canonical_title', data=meta['canonical_title'].encode(), dtype='S100')
+        hf.attrs.create('split', data=meta['split'].encode(), dtype='S20')
+        hf.attrs.create('year', data=meta['year'].encode(), dtype='S10')
+        hf.attrs.create('midi_filename', data=meta['midi_filename'].encode(), dtype='S100')
+        hf.attrs.create('audio_filename', data=meta['audio_filename'].encode(), dtype='S100')
+        hf.attrs.create('duration', data=meta['duration'], dtype=np.float32)
+
+        hf.create_dataset(name='midi_event', data=[e.encode() for e in midi_dict['midi_event']], dtype='S100')
+        hf.create_dataset(name='midi_event_time', data=midi_dict['midi_event_time'], dtype=np.float32)
+        midi_event_table = midi_events_to_table(
+            midi_dict['midi_event_time'], midi_dict['midi_event'])
+        hf.create_dataset(name='midi_event_table', data=midi_event_table)
+        hf.create_dataset(name='midi_event_active_bgn', 
+            data=get_midi_events_active_bgn(midi_event_table), dtype=np.int32)
+        create_waveform_dataset(hf, float32_to_int16(audio), layout)
+
+    os.replace(tmp_path, packed_hdf5_path)
+
+    return len(audio) / sample_rate
+
+
 def pack_maestro_dataset_to_hdf5(args):
     """Load & resample MAESTRO audio files, then write to hdf5 files.
 
     Args:
       dataset_dir: str, directory of dataset
       workspace: str, directory of your workspace
+      num_workers: int, number of processes packing files
+      storage: 'hdf5' | 'memmap', also write waveform stores if 'memmap'
+      chunk_seconds: float, chunk of waveforms, 0 for contiguous waveforms
+      compression: str, filter of waveforms, see get_waveform_layout
     """
 
     # Arguments & parameters
     dataset_dir = args.dataset_dir
     workspace = args.workspace
-
-    sample_rate = config.sample_rate
+    num_workers = args.num_workers
+    storage = args.storage
+    layout = get_waveform_layout(args.chunk_seconds, args.compression)
 
     # Paths
     csv_path = os.path.join(dataset_dir, 'maestro-v2.0.0.csv')
@@ -44,39 +247,61 @@ def pack_maestro_dataset_to_hdf5(args):
     feature_time = time.time()
 
     # Load & resample each audio file to a hdf5 file
+    jobs = []
     for n in range(audios_num):
-        logging.info('{} {}'.format(n, meta_dict['midi_filename'][n]))
-
-        # Read midi
-        midi_path = os.path.join(dataset_dir, meta_dict['midi_filename'][n])
-        midi_dict = read_midi(midi_path)
-
-        # Load audio
-        audio_path = os.path.join(dataset_dir, meta_dict['audio_filename'][n])
-        (audio, _) = librosa.core.load(audio_path, sr=sample_rate, mono=True)
-
         packed_hdf5_path = os.path.join(waveform_hdf5s_dir, '{}.h5'.format(
             os.path.splitext(meta_dict['audio_filename'][n])[0]))
+        meta = {key: meta_dict[key][n] for key in meta_dict.keys()}
+        jobs.append((pack_maestro_file, packed_hdf5_path, (dataset_dir, meta, layout)))
 
-        create_folder(os.path.dirname(packed_hdf5_path))
+    pack_files(jobs, waveform_hdf5s_dir, num_workers)
+    logging.info('Write hdf5 to {}'.format(waveform_hdf5s_dir))
 
-        with h5py.File(packed_hdf5_path, 'w') as hf:
-            hf.attrs.create('canonical_composer', data=meta_dict['canonical_composer'][n].encode(), dtype='S100')
-            hf.attrs.create('canonical_title', data=meta_dict['canonical_title'][n].encode(), dtype='S100')
-            hf.attrs.create('split', data=meta_dict['split'][n].encode(), dtype='S20')
-            hf.attrs.create('year', data=meta_dict['year'][n].encode(), dtype='S10')
-            hf.attrs.create('midi_filename', data=meta_dict['midi_filename'][n].encode(), dtype='S100')
-            hf.attrs.create('audio_filename', data=meta_dict['audio_filename'][n].encode(), dtype='S100')
-            hf.attrs.create('duration', data=meta_dict['duration'][n], dtype=np.float32)
+    manifest_path = write_manifest(waveform_hdf5s_dir)
+    logging.info('Write manifest to {}'.format(manifest_path))
+
+    if storage == 'memmap':
+        waveform_paths = write_waveform_stores(waveform_hdf5s_dir, 
+            os.path.join(workspace, 'waveforms', 'maestro'))
+        logging.info('Write waveform stores to {}'.format(waveform_paths))
 
-            hf.create_dataset(name='midi_event', data=[e.encode() for e in midi_dict['midi_event']], dtype='S100')
-            hf.create_dataset(name='midi_event_time', data=midi_dict['midi_event_time'], dtype=np.float32)
-            hf.create_dataset(name='waveform', data=float32_to_int16(audio), dtype=np.int16)
-        
-    logging.info('Write hdf5 to {}'.format(packed_hdf5_path))
     logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
 
 
+def pack_maps_file(packed_hdf5_path, audio_path, midi_path, audio_name, 
+    layout={}):
+    """Load & resample a MAPS audio file, then write it with its MIDI events 
+    to a hdf5 file, see pack_maestro_file.
+
+    Returns:
+      duration: float, seconds of audio
+    """
+    sample_rate = config.sample_rate
+
+    (audio, _) = librosa.core.load(audio_path, sr=sample_rate, mono=True)
+    midi_dict = read_maps_midi(midi_path)
+
+    create_folder(os.path.dirname(packed_hdf5_path))
+    tmp_path = '{}.tmp'.format(packed_hdf5_path)
+
+    with h5py.File(tmp_path, 'w') as hf:
+        hf.attrs.create('split', data='test'.encode(), dtype='S20')
+        hf.attrs.create('midi_filename', data='{}.mid'.format(audio_name).encode(), dtype='S100')
+        hf.attrs.create('audio_filename', data='{}.wav'.format(audio_name).encode(), dtype='S100')
+        hf.create_dataset(name='midi_event', data=[e.encode() for e in midi_dict['midi_event']], dtype='S100')
+        hf.create_dataset(name='midi_event_time', data=midi_dict['midi_event_time'], dtype=np.float32)
+        midi_event_table = midi_events_to_table(
+            midi_dict['midi_event_time'], midi_dict['midi_event'])
+        hf.create_dataset(name='midi_event_table', data=midi_event_table)
+        hf.create_dataset(name='midi_event_active_bgn', 
+            data=get_midi_events_active_bgn(midi_event_table), dtype=np.int32)
+        create_waveform_dataset(hf, float32_to_int16(audio), layout)
+
+    os.replace(tmp_path, packed_hdf5_path)
+
+    return len(audio) / sample_rate
+
+
 def pack_maps_dataset_to_hdf5(args):
     """MAPS is a piano dataset only used for evaluating our piano transcription
     system (optional). Ref:
@@ -89,13 +314,19 @@ def pack_maps_dataset_to_hdf5(args):
     Args:
       dataset_dir: str, directory of dataset
       workspace: str, directory of your workspace
+      num_workers: int, number of processes packing files
+      storage: 'hdf5' | 'memmap', also write waveform stores if 'memmap'
+      chunk_seconds: float, chunk of waveforms, 0 for contiguous waveforms
+      compression: str, filter of waveforms, see get_waveform_layout
     """
 
     # Arguments & parameters
     dataset_dir = args.dataset_dir
     workspace = args.workspace
+    num_workers = args.num_workers
+    storage = args.storage
+    layout = get_waveform_layout(args.chunk_seconds, args.compression)
 
-    sample_rate = config.sample_rate
     pianos = ['ENSTDkCl', 'ENSTDkAm']
 
     # Paths
@@ -106,9 +337,9 @@ def pack_maps_dataset_to_hdf5(args):
     logging.info(args)
 
     feature_time = time.time()
-    count = 0
 
     # Load & resample each audio file to a hdf5 file
+    jobs = []
     for piano in pianos:
         sub_dir = os.path.join(dataset_dir, piano, 'MUS')
 
@@ -116,30 +347,417 @@ def pack_maps_dataset_to_hdf5(args):
             if os.path.splitext(name)[-1] == '.mid']
         
         for audio_name in audio_names:
-            print('{} {}'.format(count, audio_name))
             audio_path = '{}.wav'.format(os.path.join(sub_dir, audio_name))
             midi_path = '{}.mid'.format(os.path.join(sub_dir, audio_name))
-
-            (audio, _) = librosa.core.load(audio_path, sr=sample_rate, mono=True)
-            midi_dict = read_maps_midi(midi_path)
-            
             packed_hdf5_path = os.path.join(waveform_hdf5s_dir, '{}.h5'.format(audio_name))
-            create_folder(os.path.dirname(packed_hdf5_path))
-
-            with h5py.File(packed_hdf5_path, 'w') as hf:
-                hf.attrs.create('split', data='test'.encode(), dtype='S20')
-                hf.attrs.create('midi_filename', data='{}.mid'.format(audio_name).encode(), dtype='S100')
-                hf.attrs.create('audio_filename', data='{}.wav'.format(audio_name).encode(), dtype='S100')
-                hf.create_dataset(name='midi_event', data=[e.encode() for e in midi_dict['midi_event']], dtype='S100')
-                hf.create_dataset(name='midi_event_time', data=midi_dict['midi_event_time'], dtype=np.float32)
-                hf.create_dataset(name='waveform', data=float32_to_int16(audio), dtype=np.int16)
-            
-            count += 1
-
-    logging.info('Write hdf5 to {}'.format(packed_hdf5_path))
+            jobs.append((pack_maps_file, packed_hdf5_path, 
+                (audio_path, midi_path, audio_name, layout)))
+
+    pack_files(jobs, waveform_hdf5s_dir, num_workers)
+    logging.info('Write hdf5 to {}'.format(waveform_hdf5s_dir))
+
+    manifest_path = write_manifest(waveform_hdf5s_dir)
+    logging.info('Write manifest to {}'.format(manifest_path))
+
+    if storage == 'memmap':
+        waveform_paths = write_waveform_stores(waveform_hdf5s_dir, 
+            os.path.join(workspace, 'waveforms', 'maps'))
+        logging.info('Write waveform stores to {}'.format(waveform_paths))
+
+    logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
+
+
+def add_midi_event_tables(args):
+    """Add structured MIDI event tables and their active indexes to hdf5 files 
+    packed before they were written by pack_maestro_dataset_to_hdf5 and 
+    pack_maps_dataset_to_hdf5. Audio is not decoded again. Active indexes 
+    written by former versions of get_midi_events_active_bgn are rewritten.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', dataset)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
+    feature_time = time.time()
+
+    for n, hdf5_path in enumerate(hdf5_paths):
+        with h5py.File(hdf5_path, 'a') as hf:
+            if 'midi_event_table' not in hf.keys():
+                midi_events = [e.decode() for e in hf['midi_event'][:]]
+                hf.create_dataset(name='midi_event_table', data=midi_events_to_table(
+                    hf['midi_event_time'][:], midi_events))
+
+            active_bgn = get_midi_events_active_bgn(hf['midi_event_table'][:])
+
+            if 'midi_event_active_bgn' in hf.keys():
+                if np.array_equal(hf['midi_event_active_bgn'][:], active_bgn):
+                    continue
+                del hf['midi_event_active_bgn']
+
+            logging.info('{} {}'.format(n, hdf5_path))
+
+            hf.create_dataset(name='midi_event_active_bgn', data=active_bgn, 
+                dtype=np.int32)
+
     logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
 
 
+def write_hdf5s_manifest(args):
+    """Write the manifest of packed hdf5 files, which is read by the samplers 
+    and the score calculator instead of opening every hdf5 file. Added, 
+    removed and rewritten hdf5 files make the manifest stale, and readers 
+    crawl the hdf5 files until it is written again.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', dataset)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    feature_time = time.time()
+    manifest_path = write_manifest(hdf5s_dir)
+
+    logging.info('Write manifest to {}'.format(manifest_path))
+    logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
+
+
+def write_hdf5s_waveform_stores(args):
+    """Write the waveforms of packed hdf5 files to one contiguous npy file 
+    per split, which is memory-mapped by MaestroDataset if trained with 
+    --storage=memmap. The hdf5 files are kept for MIDI events and evaluation. 
+    Run it again if hdf5 files are packed again.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', dataset)
+    waveforms_dir = os.path.join(workspace, 'waveforms', dataset)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    feature_time = time.time()
+    waveform_paths = write_waveform_stores(hdf5s_dir, waveforms_dir)
+
+    logging.info('Write waveform stores to {}'.format(waveform_paths))
+    logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
+
+
+def run_pitch_shift_job(job):
+    """Pitch shift the waveform of a recording in a waveform store.
+
+    Args:
+      job: (waveform_path, offset, samples_num, note_shift)
+
+    Returns:
+      offset: int
+      shifted_waveform: (samples_num,), int16
+    """
+    (waveform_path, offset, samples_num, note_shift) = job
+    waveforms = np.load(waveform_path, mmap_mode='r')
+    waveform = int16_to_float32(waveforms[offset : offset + samples_num])
+
+    shifted_waveform = librosa.effects.pitch_shift(waveform, 
+        sr=config.sample_rate, n_steps=note_shift, bins_per_octave=12)
+    
+    return offset, float32_to_int16(np.clip(shifted_waveform, -1., 1.))
+
+
+def write_pitch_shifted_stores(args):
+    """Pitch shift the waveform store of a split by each note shift to a 
+    memory-mapped copy, which is read by MaestroDataset if trained with 
+    --storage=memmap --pitch_shift_stores instead of shifting each segment by 
+    librosa. Whole recordings are shifted, so segments differ from segments 
+    shifted alone only at the phases of the phase vocoder. Each store takes 
+    as much disk as the waveform store of the split, note shifts are written 
+    in the given order until the disk budget is used up. Stores newer than 
+    the waveform store are not written again.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+      split: 'train' | 'validation' | 'test'
+      note_shifts: list of int, e.g. [1, -1, 2, -2]
+      max_gigabytes: float, disk budget of the stores of the split, 0 for 
+        no budget
+      num_workers: int, number of processes shifting recordings
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+    split = args.split
+    note_shifts = args.note_shifts
+    max_gigabytes = args.max_gigabytes
+    num_workers = args.num_workers
+
+    # Paths
+    waveforms_dir = os.path.join(workspace, 'waveforms', dataset)
+    (waveform_path, _) = get_waveform_store_paths(waveforms_dir, split)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    if not os.path.isfile(waveform_path):
+        raise Exception('Waveform store {} does not exist, write it by '
+            'features.py write_waveform_stores!'.format(waveform_path))
+
+    waveform_index = read_waveform_store_indexes(waveforms_dir)
+    recordings = sorted([(offset, samples_num) for (recording_split, offset, 
+        samples_num) in waveform_index.values() if recording_split == split])
+
+    samples_num = np.load(waveform_path, mmap_mode='r').shape[0]
+    store_bytes = os.path.getsize(waveform_path)
+    used_bytes = 0
+    feature_time = time.time()
+
+    for note_shift in note_shifts:
+        if note_shift == 0:
+            continue
+
+        shifted_path = get_shifted_waveform_store_path(waveforms_dir, split, note_shift)
+
+        if max_gigabytes and used_bytes + store_bytes > max_gigabytes * 1e9:
+            logging.info('Skip note shift {}, over the budget of {} GB'.format(
+                note_shift, max_gigabytes))
+            continue
+
+        used_bytes += store_bytes
+
+        if os.path.isfile(shifted_path) and \
+            os.path.getmtime(shifted_path) >= os.path.getmtime(waveform_path):
+            logging.info('Keep {}'.format(shifted_path))
+            continue
+
+        # Write to a temporary file first, so that an interrupted write is 
+        # not taken for a complete store
+        tmp_path = '{}.tmp.npy'.format(shifted_path[: -len('.npy')])
+        shifted_waveforms = np.lib.format.open_memmap(tmp_path, mode='w+', 
+            dtype=np.int16, shape=(samples_num,))
+
+        jobs = [(waveform_path, offset, recording_samples_num, note_shift) 
+            for (offset, recording_samples_num) in recordings]
+
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            results = pool.imap_unordered(run_pitch_shift_job, jobs)
+        else:
+            pool = None
+            results = map(run_pitch_shift_job, jobs)
+
+        try:
+            for n, (offset, shifted_waveform) in enumerate(results):
+                shifted_waveforms[offset : offset + len(shifted_waveform)] = shifted_waveform
+                logging.info('Note shift {}: {} / {}'.format(note_shift, n + 1, len(jobs)))
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        shifted_waveforms.flush()
+        del shifted_waveforms
+        os.replace(tmp_path, shifted_path)
+        logging.info('Write {}'.format(shifted_path))
+
+    logging.info('Pitch shifted stores: {:.2f} GB'.format(used_bytes / 1e9))
+    logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
+
+
+def build_target_caches(args):
+    """Process MIDI events of each packed hdf5 file to a target cache of the 
+    whole recording, which is memory-mapped and sliced by MaestroDataset 
+    instead of writing targets from MIDI events for each segment. Caches newer 
+    than their hdf5 files and of the current layout are not built again.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+
+    sample_rate = config.sample_rate
+    frames_per_second = config.frames_per_second
+    begin_note = config.begin_note
+    classes_num = config.classes_num
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', dataset)
+    target_caches_dir = os.path.join(workspace, 'target_caches', dataset)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
+    feature_time = time.time()
+
+    for n, hdf5_path in enumerate(hdf5_paths):
+        target_cache_path = get_target_cache_path(target_caches_dir, 
+            hdf5s_dir, hdf5_path)
+
+        if os.path.isfile(target_cache_path) and \
+            os.path.getmtime(target_cache_path) >= os.path.getmtime(hdf5_path) and \
+            np.load(target_cache_path, mmap_mode='r').dtype == \
+            get_target_cache_dtype(classes_num):
+            continue
+
+        logging.info('{} {}'.format(n, hdf5_path))
+
+        with h5py.File(hdf5_path, 'r') as hf:
+            duration = hf['waveform'].shape[0] / sample_rate
+            (midi_events_time, midi_events, midi_events_active_bgn) = \
+                read_midi_events(hf)
+
+        target_processor = TargetProcessor(duration, frames_per_second, 
+            begin_note, classes_num)
+
+        target_cache = target_processor.process_to_cache(midi_events_time, 
+            midi_events, extend_pedal=True, 
+            midi_events_active_bgn=midi_events_active_bgn)
+
+        # Write to a temporary file first, so that an interrupted build is 
+        # not taken for a complete cache
+        create_folder(os.path.dirname(target_cache_path))
+        tmp_path = '{}.tmp.npy'.format(target_cache_path[: -len('.npy')])
+        np.save(tmp_path, target_cache)
+        os.replace(tmp_path, target_cache_path)
+
+    logging.info('Write target caches to {}'.format(target_caches_dir))
+    logging.info('Time: {:.3f} s'.format(time.time() - feature_time))
+
+
+def check_target_caches(args):
+    """Check target caches against TargetProcessor. Each cache must be 
+    identical to the cache processed again from the hdf5 file. Then targets 
+    of random segments from TargetProcessor.process_from_cache must be 
+    identical to targets from TargetProcessor.process, except for regression 
+    targets which differ by the quantization of onset and offset shifts.
+
+    Args:
+      workspace: str, directory of your workspace
+      dataset: 'maestro' | 'maps'
+      segments_per_file: int
+    """
+
+    # Arguments & parameters
+    workspace = args.workspace
+    dataset = args.dataset
+    segments_per_file = args.segments_per_file
+
+    sample_rate = config.sample_rate
+    segment_seconds = config.segment_seconds
+    hop_seconds = config.hop_seconds
+    frames_per_second = config.frames_per_second
+    begin_note = config.begin_note
+    classes_num = config.classes_num
+    atol = 1e-3
+    """Regression targets differ by quantization of onset and offset times"""
+
+    # Paths
+    hdf5s_dir = os.path.join(workspace, 'hdf5s', dataset)
+    target_caches_dir = os.path.join(workspace, 'target_caches', dataset)
+
+    logs_dir = os.path.join(workspace, 'logs', get_filename(__file__))
+    create_logging(logs_dir, filemode='w')
+    logging.info(args)
+
+    random_state = np.random.RandomState(1234)
+    segment_processor = TargetProcessor(segment_seconds, frames_per_second, 
+        begin_note, classes_num)
+
+    (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
+
+    for n, hdf5_path in enumerate(hdf5_paths):
+        target_cache_path = get_target_cache_path(target_caches_dir, 
+            hdf5s_dir, hdf5_path)
+
+        if not os.path.isfile(target_cache_path):
+            raise Exception('Target cache {} does not exist!'.format(target_cache_path))
+
+        target_cache = np.load(target_cache_path, mmap_mode='r')
+
+        with h5py.File(hdf5_path, 'r') as hf:
+            duration = hf['waveform'].shape[0] / sample_rate
+            (midi_events_time, midi_events, midi_events_active_bgn) = \
+                read_midi_events(hf)
+
+        # Whole recording
+        target_processor = TargetProcessor(duration, frames_per_second, 
+            begin_note, classes_num)
+
+        if target_cache.dtype != get_target_cache_dtype(classes_num) or \
+            not np.array_equal(target_cache, target_processor.process_to_cache(
+            midi_events_time, midi_events, extend_pedal=True, 
+            midi_events_active_bgn=midi_events_active_bgn)):
+            raise Exception('Target cache {} is stale or corrupted, build it '
+                'again!'.format(target_cache_path))
+
+        # Segments
+        start_times = np.arange(0, max(duration - segment_seconds, 0) + 1e-6, hop_seconds)
+        start_times = random_state.choice(start_times, 
+            size=min(segments_per_file, len(start_times)), replace=False)
+
+        for start_time in start_times:
+            (target_dict, _, _) = segment_processor.process(start_time, 
+                midi_events_time, midi_events, extend_pedal=True, 
+                midi_events_active_bgn=midi_events_active_bgn)
+
+            (cached_target_dict, _, _) = segment_processor.process_from_cache(
+                target_cache, start_time, midi_events_time, midi_events, 
+                midi_events_active_bgn=midi_events_active_bgn)
+
+            for key in target_dict.keys():
+                if key.startswith('reg'):
+                    equal = np.allclose(target_dict[key], cached_target_dict[key], 
+                        rtol=0, atol=atol)
+                else:
+                    equal = np.array_equal(target_dict[key], cached_target_dict[key])
+
+                if not equal:
+                    raise Exception('{} of {} at {} s sliced from the target '
+                        'cache differs from TargetProcessor.process!'.format(
+                        key, hdf5_path, start_time))
+
+        logging.info('{} {}, {} segments'.format(n, hdf5_path, len(start_times)))
+
+    logging.info('Target caches are consistent with TargetProcessor.')
+
+
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='')
@@ -148,10 +766,47 @@ if __name__ == '__main__':
     parser_pack_maestro = subparsers.add_parser('pack_maestro_dataset_to_hdf5')
     parser_pack_maestro.add_argument('--dataset_dir', type=str, required=True, help='Directory of dataset.')
     parser_pack_maestro.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_pack_maestro.add_argument('--num_workers', type=int, default=1, help='Number of processes packing files.')
+    parser_pack_maestro.add_argument('--storage', type=str, default='hdf5', choices=['hdf5', 'memmap'], help='Also write memory-mapped waveform stores if memmap.')
+    parser_pack_maestro.add_argument('--chunk_seconds', type=float, default=0., help='Chunk of waveforms, e.g. hop_seconds. 0 for contiguous waveforms.')
+    parser_pack_maestro.add_argument('--compression', type=str, default='none', choices=['none', 'lzf', 'gzip', 'shuffle_lzf', 'shuffle_gzip'])
 
     parser_pack_maps = subparsers.add_parser('pack_maps_dataset_to_hdf5')
     parser_pack_maps.add_argument('--dataset_dir', type=str, required=True, help='Directory of dataset.')
     parser_pack_maps.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_pack_maps.add_argument('--num_workers', type=int, default=1, help='Number of processes packing files.')
+    parser_pack_maps.add_argument('--storage', type=str, default='hdf5', choices=['hdf5', 'memmap'], help='Also write memory-mapped waveform stores if memmap.')
+    parser_pack_maps.add_argument('--chunk_seconds', type=float, default=0., help='Chunk of waveforms, e.g. hop_seconds. 0 for contiguous waveforms.')
+    parser_pack_maps.add_argument('--compression', type=str, default='none', choices=['none', 'lzf', 'gzip', 'shuffle_lzf', 'shuffle_gzip'])
+
+    parser_add_tables = subparsers.add_parser('add_midi_event_tables')
+    parser_add_tables.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_add_tables.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+
+    parser_manifest = subparsers.add_parser('write_hdf5s_manifest')
+    parser_manifest.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_manifest.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+
+    parser_waveform_stores = subparsers.add_parser('write_waveform_stores')
+    parser_waveform_stores.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_waveform_stores.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+
+    parser_shifted_stores = subparsers.add_parser('write_pitch_shifted_stores')
+    parser_shifted_stores.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_shifted_stores.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+    parser_shifted_stores.add_argument('--split', type=str, default='train', choices=['train', 'validation', 'test'])
+    parser_shifted_stores.add_argument('--note_shifts', type=int, nargs='+', required=True, help='Note shifts in the order of writing, e.g. 1 -1 2 -2.')
+    parser_shifted_stores.add_argument('--max_gigabytes', type=float, default=0., help='Disk budget of the stores of the split. 0 for no budget.')
+    parser_shifted_stores.add_argument('--num_workers', type=int, default=1, help='Number of processes shifting recordings.')
+
+    parser_build_caches = subparsers.add_parser('build_target_caches')
+    parser_build_caches.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_build_caches.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+
+    parser_check_caches = subparsers.add_parser('check_target_caches')
+    parser_check_caches.add_argument('--workspace', type=str, required=True, help='Directory of your workspace.')
+    parser_check_caches.add_argument('--dataset', type=str, default='maestro', choices=['maestro', 'maps'])
+    parser_check_caches.add_argument('--segments_per_file', type=int, default=10)
 
     # Parse arguments
     args = parser.parse_args()
@@ -162,5 +817,23 @@ if __name__ == '__main__':
     elif args.mode == 'pack_maps_dataset_to_hdf5':
         pack_maps_dataset_to_hdf5(args)
 
+    elif args.mode == 'add_midi_event_tables':
+        add_midi_event_tables(args)
+
+    elif args.mode == 'write_hdf5s_manifest':
+        write_hdf5s_manifest(args)
+
+    elif args.mode == 'write_waveform_stores':
+        write_hdf5s_waveform_stores(args)
+
+    elif args.mode == 'write_pitch_shifted_stores':
+        write_pitch_shifted_stores(args)
+
+    elif args.mode == 'build_target_caches':
+        build_target_caches(args)
+
+    elif args.mode == 'check_target_caches':
+        check_target_caches(args)
+
     else:
         raise Exception('Incorrect arguments!')
\ No newline at end of file
@@ -1,5 +1,14 @@
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Run the packed detections as pure Python when numba is missing."""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 
 def note_detection_with_onset_offset_regress(frame_output, onset_output, 
     onset_shift_output, offset_output, offset_shift_output, velocity_output,
@@ -222,4 +231,284 @@ def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold):
     # Sort pairs by onsets
     output_tuples.sort(key=lambda pair: pair[0])
 
-    return output_tuples
\ No newline at end of file
+    return output_tuples
+
+
+###### Packed detections of all classes, compiled by numba if available ######
+"""The functions below run the same state machines as the ones above on all 
+columns at once and return packed arrays instead of lists. The index 0 stands 
+for "not detected", the same as the falsy None / 0 checks above. Rows are 
+ordered by class, then by onset."""
+
+@njit(cache=True)
+def note_detection_with_onset_offset_regress_packed(frame_output, onset_output, 
+    onset_shift_output, offset_output, offset_shift_output, velocity_output,
+    frame_threshold):
+    """Packed version of note_detection_with_onset_offset_regress.
+
+    Args:
+      frame_output: (frames_num, classes_num)
+      onset_output: (frames_num, classes_num)
+      onset_shift_output: (frames_num, classes_num)
+      offset_output: (frames_num, classes_num)
+      offset_shift_output: (frames_num, classes_num)
+      velocity_output: (frames_num, classes_num)
+      frame_threshold: float
+
+    Returns:
+      output: (notes, 6), the six columns are bgn, fin, onset_shift, 
+        offset_shift, normalized_velocity and class index
+    """
+    (frames_num, classes_num) = onset_output.shape
+
+    # Every note starts from an onset
+    notes_num = 0
+    for k in range(classes_num):
+        for i in range(frames_num):
+            if onset_output[i, k] == 1:
+                notes_num += 1
+
+    output = np.zeros((notes_num, 6))
+    n = 0
+
+    for k in range(classes_num):
+        bgn = 0
+        frame_disappear = 0
+        offset_occur = 0
+
+        for i in range(frames_num):
+            if onset_output[i, k] == 1:
+                """Onset detected"""
+                if bgn > 0:
+                    """Consecutive onsets"""
+                    fin = max(i - 1, 0)
+                    output[n, 0] = bgn
+                    output[n, 1] = fin
+                    output[n, 2] = onset_shift_output[bgn, k]
+                    output[n, 3] = 0
+                    output[n, 4] = velocity_output[bgn, k]
+                    output[n, 5] = k
+                    n += 1
+                    frame_disappear = 0
+                    offset_occur = 0
+                bgn = i
+
+            if bgn > 0 and i > bgn:
+                """If onset found, then search offset"""
+                if frame_output[i, k] <= frame_threshold and frame_disappear == 0:
+                    """Frame disappear detected"""
+                    frame_disappear = i
+
+                if offset_output[i, k] == 1 and offset_occur == 0:
+                    """Offset detected"""
+                    offset_occur = i
+
+                fin = -1
+                if frame_disappear > 0:
+                    if offset_occur > 0 and offset_occur - bgn > frame_disappear - offset_occur:
+                        fin = offset_occur
+                    else:
+                        fin = frame_disappear
+
+                elif i - bgn >= 600 or i == frames_num - 1:
+                    """Offset not detected"""
+                    fin = i
+
+                if fin >= 0:
+                    output[n, 0] = bgn
+                    output[n, 1] = fin
+                    output[n, 2] = onset_shift_output[bgn, k]
+                    output[n, 3] = offset_shift_output[fin, k]
+                    output[n, 4] = velocity_output[bgn, k]
+                    output[n, 5] = k
+                    n += 1
+                    bgn = 0
+                    frame_disappear = 0
+                    offset_occur = 0
+
+    return output[0 : n]
+
+
+@njit(cache=True)
+def pedal_detection_with_onset_offset_regress_packed(frame_output, 
+    offset_output, offset_shift_output, frame_threshold):
+    """Packed version of pedal_detection_with_onset_offset_regress.
+
+    Args:
+      frame_output: (frames_num,)
+      offset_output: (frames_num,)
+      offset_shift_output: (frames_num,)
+      frame_threshold: float
+
+    Returns:
+      output: (pedals, 4), the four columns are bgn, fin, onset_shift and 
+        offset_shift
+    """
+    frames_num = frame_output.shape[0]
+
+    # Every pedal starts from an onset
+    pedals_num = 0
+    for i in range(1, frames_num):
+        if frame_output[i] >= frame_threshold and frame_output[i] > frame_output[i - 1]:
+            pedals_num += 1
+
+    output = np.zeros((pedals_num, 4))
+    n = 0
+
+    bgn = 0
+    frame_disappear = 0
+    offset_occur = 0
+
+    for i in range(1, frames_num):
+        if frame_output[i] >= frame_threshold and frame_output[i] > frame_output[i - 1]:
+            """Pedal onset detected"""
+            if bgn == 0:
+                bgn = i
+
+        if bgn > 0 and i > bgn:
+            """If onset found, then search offset"""
+            if frame_output[i] <= frame_threshold and frame_disappear == 0:
+                """Frame disappear detected"""
+                frame_disappear = i
+
+            if offset_output[i] == 1 and offset_occur == 0:
+                """Offset detected"""
+                offset_occur = i
+
+            fin = -1
+            if offset_occur > 0:
+                fin = offset_occur
+
+            elif frame_disappear > 0 and i - frame_disappear >= 10:
+                """offset not detected but frame disappear"""
+                fin = frame_disappear
+
+            if fin >= 0:
+                output[n, 0] = bgn
+                output[n, 1] = fin
+                output[n, 2] = 0.
+                output[n, 3] = offset_shift_output[fin]
+                n += 1
+                bgn = 0
+                frame_disappear = 0
+                offset_occur = 0
+
+    return output[0 : n]
+
+
+@njit(cache=True)
+def onsets_frames_note_detection_packed(frame_output, onset_output, 
+    offset_output, velocity_output, threshold):
+    """Packed version of onsets_frames_note_detection.
+
+    Args:
+      frame_output: (frames_num, classes_num)
+      onset_output: (frames_num, classes_num)
+      offset_output: (frames_num, classes_num)
+      velocity_output: (frames_num, classes_num)
+      threshold: float
+
+    Returns:
+      output: (notes, 6), the six columns are bgn, fin, onset_shift, 
+        offset_shift, velocity and class index. Shifts are always 0.
+    """
+    (frames_num, classes_num) = onset_output.shape
+
+    # Every note starts from an onset
+    notes_num = 0
+    for k in range(classes_num):
+        for i in range(frames_num):
+            if onset_output[i, k] > threshold:
+                notes_num += 1
+
+    output = np.zeros((notes_num, 6))
+    n = 0
+
+    for k in range(classes_num):
+        loct = 0
+
+        for i in range(frames_num):
+            # Use onset_output is used to detect the presence of notes
+            if onset_output[i, k] > threshold:
+                if loct > 0:
+                    output[n, 0] = loct
+                    output[n, 1] = i
+                    output[n, 4] = velocity_output[loct, k]
+                    output[n, 5] = k
+                    n += 1
+                loct = i
+
+            if loct > 0 and i > loct:
+                # Use frame_output is used to detect the offset of notes
+                if frame_output[i, k] <= threshold:
+                    output[n, 0] = loct
+                    output[n, 1] = i
+                    output[n, 4] = velocity_output[loct, k]
+                    output[n, 5] = k
+                    n += 1
+                    loct = 0
+
+    return output[0 : n]
+
+
+@njit(cache=True)
+def onsets_frames_pedal_detection_packed(frame_output, offset_output, 
+    frame_threshold):
+    """Packed version of onsets_frames_pedal_detection.
+
+    Args:
+      frame_output: (frames_num,)
+      offset_output: (frames_num,)
+      frame_threshold: float
+
+    Returns:
+      output: (pedals, 4), the four columns are bgn, fin, onset_shift and 
+        offset_shift. Shifts are always 0.
+    """
+    frames_num = frame_output.shape[0]
+
+    # Every pedal starts from an onset
+    pedals_num = 0
+    for i in range(1, frames_num):
+        if frame_output[i] >= frame_threshold and frame_output[i] > frame_output[i - 1]:
+            pedals_num += 1
+
+    output = np.zeros((pedals_num, 4))
+    n = 0
+
+    bgn = 0
+    frame_disappear = 0
+    offset_occur = 0
+
+    for i in range(1, frames_num):
+        if frame_output[i] >= frame_threshold and frame_output[i] > frame_output[i - 1]:
+            if bgn == 0:
+                bgn = i
+
+        if bgn > 0 and i > bgn:
+            """If onset found, then search offset"""
+            if frame_output[i] <= frame_threshold and frame_disappear == 0:
+                """Frame disappear detected"""
+                frame_disappear = i
+
+            if offset_output[i] == 1 and offset_occur == 0:
+                """Offset detected"""
+                offset_occur = i
+
+            fin = -1
+            if offset_occur > 0:
+                fin = offset_occur
+
+            elif frame_disappear > 0 and i - frame_disappear >= 10:
+                """offset not detected but frame disappear"""
+                fin = frame_disappear
+
+            if fin >= 0:
+                output[n, 0] = bgn
+                output[n, 1] = fin
+                n += 1
+                bgn = 0
+                frame_disappear = 0
+                offset_occur = 0
+
+    return output[0 : n]
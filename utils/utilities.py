@@ -4,22 +4,26 @@ import h5py
 import soundfile
 import librosa
 import audioread
+import scipy.signal
 import numpy as np
 import pandas as pd
 import csv
 import datetime
 import collections
 import pickle
+import json
 from mido import MidiFile
 
-from piano_vad import (note_detection_with_onset_offset_regress, 
-    pedal_detection_with_onset_offset_regress, onsets_frames_note_detection, onsets_frames_pedal_detection)
+from piano_vad import (note_detection_with_onset_offset_regress_packed, 
+    pedal_detection_with_onset_offset_regress_packed, 
+    onsets_frames_note_detection_packed, onsets_frames_pedal_detection_packed)
 import config
 
 
 def create_folder(fd):
     if not os.path.exists(fd):
-        os.makedirs(fd)
+        os.makedirs(fd, exist_ok=True)
+        """Ranks of distributed training may create the same folder"""
         
         
 def get_filename(path):
@@ -76,6 +80,206 @@ def float32_to_int16(x):
     return (x * 32767.).astype(np.int16)
 
 
+def get_manifest_path(hdf5s_dir):
+    """Path of the manifest of a directory of packed hdf5 files. It is placed 
+    next to the directory, so that crawling the directory only finds hdf5s."""
+    return '{}_manifest.json'.format(os.path.normpath(hdf5s_dir))
+
+
+def crawl_hdf5s_meta(hdf5s_dir):
+    """Read the meta of all packed hdf5 files by opening each of them.
+
+    Args:
+      hdf5s_dir: str
+
+    Returns:
+      hdf5s_meta: list of dict, in the order of traverse_folder, e.g. [
+        {'path': '2004/MIDI-Unprocessed_SMF_02_R1_2004_01-05_ORIG_MID--AUDIO_02_R1_2004_05_Track05_wav.h5', 
+         'split': 'train', 'year': '2004', 'duration': 291.4, 
+         'mtime_ns': 1587975012345678901, 'size': 18649856}, 
+        ...]. year and duration are None if not packed, e.g. for MAPS. 
+        mtime_ns and size are of the file when it was read.
+    """
+    (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
+    hdf5s_meta = []
+
+    for hdf5_path in hdf5_paths:
+        stat = os.stat(hdf5_path)
+        """Before reading, so that a file rewritten meanwhile looks stale"""
+
+        with h5py.File(hdf5_path, 'r') as hf:
+            meta = {
+                'path': os.path.relpath(hdf5_path, hdf5s_dir), 
+                'split': hf.attrs['split'].decode(), 
+                'year': hf.attrs['year'].decode() if 'year' in hf.attrs else None, 
+                'duration': float(hf.attrs['duration']) if 'duration' in hf.attrs else None, 
+                'mtime_ns': stat.st_mtime_ns, 
+                'size': stat.st_size}
+            hdf5s_meta.append(meta)
+
+    return hdf5s_meta
+
+
+def write_manifest(hdf5s_dir):
+    """Crawl packed hdf5 files once and write their meta to a manifest.
+
+    Args:
+      hdf5s_dir: str
+
+    Returns:
+      manifest_path: str
+    """
+    hdf5s_meta = crawl_hdf5s_meta(hdf5s_dir)
+    manifest = {'hdf5s': hdf5s_meta}
+
+    manifest_path = get_manifest_path(hdf5s_dir)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    return manifest_path
+
+
+def is_hdf5_meta_fresh(hdf5s_dir, meta):
+    """Check if a packed hdf5 file has the modification time and size 
+    recorded in its meta.
+
+    Args:
+      hdf5s_dir: str
+      meta: dict, see crawl_hdf5s_meta
+
+    Returns:
+      fresh: bool
+    """
+    stat = os.stat(os.path.join(hdf5s_dir, meta['path']))
+    return meta.get('mtime_ns') == stat.st_mtime_ns and \
+        meta.get('size') == stat.st_size
+
+
+def read_hdf5s_meta(hdf5s_dir):
+    """Read the meta of packed hdf5 files from the manifest. Fall back to 
+    crawling the hdf5 files if the manifest is missing, does not list the 
+    same files as hdf5s_dir, or if any file has changed its modification time 
+    or size since the manifest was written. Files are checked by os.stat 
+    without being opened.
+
+    Args:
+      hdf5s_dir: str
+
+    Returns:
+      hdf5s_meta: list of dict, see crawl_hdf5s_meta
+    """
+    manifest_path = get_manifest_path(hdf5s_dir)
+
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            hdf5s_meta = json.load(f)['hdf5s']
+
+        (hdf5_names, hdf5_paths) = traverse_folder(hdf5s_dir)
+        hdf5_paths = [os.path.relpath(hdf5_path, hdf5s_dir) for hdf5_path in hdf5_paths]
+
+        if sorted(hdf5_paths) == sorted([meta['path'] for meta in hdf5s_meta]) \
+            and all([is_hdf5_meta_fresh(hdf5s_dir, meta) for meta in hdf5s_meta]):
+            return hdf5s_meta
+
+        logging.info('Manifest {} is stale, crawl hdf5 files.'.format(manifest_path))
+
+    else:
+        logging.info('Manifest {} not found, crawl hdf5 files.'.format(manifest_path))
+
+    return crawl_hdf5s_meta(hdf5s_dir)
+
+
+def get_waveform_store_paths(waveforms_dir, split):
+    """Paths of the waveform store of a split, e.g. waveforms/maestro/train.npy
+    and waveforms/maestro/train_index.json."""
+    return (os.path.join(waveforms_dir, '{}.npy'.format(split)),
+        os.path.join(waveforms_dir, '{}_index.json'.format(split)))
+
+
+def get_shifted_waveform_store_path(waveforms_dir, split, note_shift):
+    """Path of the pitch shifted waveform store of a split, e.g. 
+    waveforms/maestro/train_shift=-1.npy. It shares the index of the waveform 
+    store of the split."""
+    return os.path.join(waveforms_dir, '{}_shift={}.npy'.format(split, note_shift))
+
+
+def write_waveform_stores(hdf5s_dir, waveforms_dir):
+    """Concatenate the int16 waveforms of the packed hdf5 files of each split
+    to a contiguous npy file, which is memory-mapped for training. The index
+    of a split maps the path of each hdf5 file relative to hdf5s_dir to the
+    offset and the number of its samples in the npy file.
+
+    Args:
+      hdf5s_dir: str
+      waveforms_dir: str
+
+    Returns:
+      waveform_paths: list of str
+    """
+    hdf5s_meta = read_hdf5s_meta(hdf5s_dir)
+    create_folder(waveforms_dir)
+    waveform_paths = []
+
+    for split in sorted(set([meta['split'] for meta in hdf5s_meta])):
+        paths = [meta['path'] for meta in hdf5s_meta if meta['split'] == split]
+        index = collections.OrderedDict()
+        offset = 0
+
+        for path in paths:
+            with h5py.File(os.path.join(hdf5s_dir, path), 'r') as hf:
+                samples_num = hf['waveform'].shape[0]
+            index[path] = [offset, samples_num]
+            offset += samples_num
+
+        (waveform_path, index_path) = get_waveform_store_paths(waveforms_dir, split)
+
+        # Write to temporary files first, so that an interrupted write is not
+        # taken for a complete store
+        tmp_path = '{}.tmp.npy'.format(waveform_path[: -len('.npy')])
+        waveforms = np.lib.format.open_memmap(tmp_path, mode='w+',
+            dtype=np.int16, shape=(offset,))
+
+        for path in paths:
+            (offset, samples_num) = index[path]
+            with h5py.File(os.path.join(hdf5s_dir, path), 'r') as hf:
+                waveforms[offset : offset + samples_num] = hf['waveform'][:]
+
+        waveforms.flush()
+        del waveforms
+        os.replace(tmp_path, waveform_path)
+
+        with open('{}.tmp'.format(index_path), 'w') as f:
+            json.dump({'hdf5s': index}, f)
+        os.replace('{}.tmp'.format(index_path), index_path)
+
+        waveform_paths.append(waveform_path)
+
+    return waveform_paths
+
+
+def read_waveform_store_indexes(waveforms_dir):
+    """Read the indexes of the waveform stores of all splits.
+
+    Args:
+      waveforms_dir: str
+
+    Returns:
+      waveform_index: dict, e.g. {'2004/a.h5': ('train', 0, 4662368), ...},
+        values are the split, the offset and the number of samples
+    """
+    waveform_index = {}
+
+    for name in sorted(os.listdir(waveforms_dir)):
+        if name.endswith('_index.json'):
+            split = name[: -len('_index.json')]
+
+            with open(os.path.join(waveforms_dir, name), 'r') as f:
+                for path, (offset, samples_num) in json.load(f)['hdf5s'].items():
+                    waveform_index[path] = (split, offset, samples_num)
+
+    return waveform_index
+
+
 def int16_to_float32(x):
     return (x / 32767.).astype(np.float32)
     
@@ -212,9 +416,268 @@ def read_maps_midi(midi_path):
     return midi_dict
 
 
+midi_event_dtype = np.dtype([('time', np.float32), ('type', np.int8), 
+    ('note', np.int16), ('value', np.int16)])
+"""Structured MIDI event table. type is one of the MIDI_EVENT_* codes below. 
+For note events, note and value are the MIDI note and velocity. For control 
+changes, note and value are the control number and control value."""
+
+MIDI_EVENT_OTHER = 0
+MIDI_EVENT_NOTE_ON = 1
+MIDI_EVENT_NOTE_OFF = 2
+MIDI_EVENT_CONTROL_CHANGE = 3
+
+
+def midi_events_to_table(midi_events_time, midi_events):
+    """Parse MIDI event strings to a structured event table. Events other than 
+    notes and control changes are kept with type MIDI_EVENT_OTHER, so that 
+    the table is aligned with the strings.
+
+    Args:
+      midi_events_time: list of float, e.g. [0, 3.3, 5.1, ...]
+      midi_events: list of str, e.g.
+        ['note_on channel=0 note=75 velocity=37 time=14',
+         'control_change channel=0 control=64 value=54 time=20',
+         ...]
+
+    Returns:
+      midi_event_table: (events_num,), structured array of midi_event_dtype
+    """
+    midi_event_table = np.zeros(len(midi_events), dtype=midi_event_dtype)
+    midi_event_table['time'] = midi_events_time
+
+    for n, midi_event in enumerate(midi_events):
+        attribute_list = midi_event.split(' ')
+
+        if attribute_list[0] in ['note_on', 'note_off']:
+            """E.g. attribute_list: ['note_on', 'channel=0', 'note=41', 'velocity=0', 'time=10']"""
+            if attribute_list[0] == 'note_on':
+                midi_event_table['type'][n] = MIDI_EVENT_NOTE_ON
+            else:
+                midi_event_table['type'][n] = MIDI_EVENT_NOTE_OFF
+
+        elif attribute_list[0] == 'control_change':
+            """E.g. attribute_list: ['control_change', 'channel=0', 'control=64', 'value=45', 'time=43']"""
+            midi_event_table['type'][n] = MIDI_EVENT_CONTROL_CHANGE
+
+        else:
+            continue
+
+        midi_event_table['note'][n] = int(attribute_list[2].split('=')[1])
+        midi_event_table['value'][n] = int(attribute_list[3].split('=')[1])
+
+    return midi_event_table
+
+
+def get_midi_events_active_bgn(midi_event_table):
+    """Index the MIDI events that are still active at each event, so that the 
+    events of a segment can be parsed without scanning from the beginning.
+
+    Args:
+      midi_event_table: (events_num,), structured array of midi_event_dtype
+
+    Returns:
+      active_bgn: (events_num + 1,), int32. For a segment whose first event is 
+        j, active_bgn[j] is the earliest onset event of the notes and the pedal 
+        sounding before event j, and of the notes released while that pedal 
+        is pressed, backtracked to a restart of get_pedal_extension_restarts. 
+        Parsing from active_bgn[j] pairs and extends all note and pedal events 
+        reaching the segment as parsing from the first event does.
+    """
+    events_num = len(midi_event_table)
+    types = midi_event_table['type'].tolist()
+    notes = midi_event_table['note'].tolist()
+    values = midi_event_table['value'].tolist()
+
+    active_bgn = np.zeros(events_num + 1, dtype=np.int32)
+
+    none = events_num
+    note_bgns = {}          # keys: midi notes, values: onset event indexes
+    min_note_bgn = none     # Earliest onset of sounding notes
+    pedal_bgn = none        # Onset of the pressed pedal
+    released_bgn = none     # Earliest onset of notes released while the pedal is pressed
+
+    for i in range(events_num):
+        active_bgn[i] = min(i, min_note_bgn, pedal_bgn, released_bgn)
+
+        # Note
+        if types[i] in [MIDI_EVENT_NOTE_ON, MIDI_EVENT_NOTE_OFF]:
+            midi_note = notes[i]
+
+            if midi_note in note_bgns.keys():
+                bgn = note_bgns.pop(midi_note)
+
+                # Offset of a note, a repeated onset replaces the former one
+                if not (types[i] == MIDI_EVENT_NOTE_ON and values[i] > 0) and pedal_bgn < none:
+                    released_bgn = min(released_bgn, bgn)
+
+                if bgn == min_note_bgn:
+                    min_note_bgn = min(note_bgns.values()) if note_bgns else none
+
+            # Onset
+            if types[i] == MIDI_EVENT_NOTE_ON and values[i] > 0:
+                note_bgns[midi_note] = i
+                min_note_bgn = min(min_note_bgn, i)
+
+        # Pedal
+        elif types[i] == MIDI_EVENT_CONTROL_CHANGE and notes[i] == 64:
+            if values[i] >= 64:
+                if pedal_bgn == none:
+                    pedal_bgn = i
+            else:
+                pedal_bgn = none
+                released_bgn = none
+
+    active_bgn[events_num] = min(events_num, min_note_bgn, pedal_bgn, released_bgn)
+
+    # TargetProcessor.extend_pedal compares notes with pedals in turn, so that 
+    # parsing from a later event may extend a note by another pedal. Backtrack 
+    # to the events from which notes are compared with the same pedals as from 
+    # the first event
+    restarts = np.where(get_pedal_extension_restarts(midi_event_table))[0]
+    active_bgn = restarts[np.searchsorted(restarts, active_bgn, side='right') - 1]
+
+    return active_bgn.astype(np.int32)
+
+
+def get_pedal_extension_restarts(midi_event_table):
+    """Find the events from which TargetProcessor.extend_pedal compares each 
+    note with the same pedal as parsing from the first event does. 
+
+    Args:
+      midi_event_table: (events_num,), structured array of midi_event_dtype
+
+    Returns:
+      restarts: (events_num + 1,), bool
+    """
+    events_num = len(midi_event_table)
+    times = midi_event_table['time'].tolist()
+    types = midi_event_table['type'].tolist()
+    notes = midi_event_table['note'].tolist()
+    values = midi_event_table['value'].tolist()
+
+    # Pair notes and pedals as TargetProcessor.parse_midi_event_table does. 
+    # Unpaired onsets are released at the segment end after all paired notes 
+    # and are not extended, so they are left out
+    note_bgns = {}          # keys: midi notes, values: onset event indexes
+    note_events = []        # (onset event index, offset time) in order of offsets
+    pedal_events = []       # (onset event index, offset event index, onset time, offset time)
+    pedal_bgn = None
+
+    for i in range(events_num):
+        if types[i] in [MIDI_EVENT_NOTE_ON, MIDI_EVENT_NOTE_OFF]:
+            if types[i] == MIDI_EVENT_NOTE_ON and values[i] > 0:
+                note_bgns[notes[i]] = i
+            elif notes[i] in note_bgns.keys():
+                note_events.append((note_bgns.pop(notes[i]), times[i]))
+
+        elif types[i] == MIDI_EVENT_CONTROL_CHANGE and notes[i] == 64:
+            if values[i] >= 64:
+                if pedal_bgn is None:
+                    pedal_bgn = i
+            elif pedal_bgn is not None:
+                pedal_events.append((pedal_bgn, i, times[pedal_bgn], times[i]))
+                pedal_bgn = None
+
+    if pedal_bgn is not None:
+        pedal_events.append((pedal_bgn, events_num, times[pedal_bgn], np.inf))
+
+    # Index of the pedal each note is compared with, and whether the note 
+    # moves the comparison on to the next pedal, as TargetProcessor.extend_pedal
+    pointers = np.full(len(note_events), len(pedal_events))
+    breaks = np.zeros(len(note_events), dtype=bool)
+    n = 0
+    for k, (_, _, pedal_onset_time, pedal_offset_time) in enumerate(pedal_events):
+        while n < len(note_events):
+            offset_time = note_events[n][1]
+            pointers[n] = k
+
+            if pedal_onset_time < offset_time < pedal_offset_time:
+                offset_time = pedal_offset_time
+
+            n += 1
+            if offset_time > pedal_offset_time:
+                breaks[n - 1] = True
+                break
+
+    note_bgns = np.array([bgn for (bgn, _) in note_events], dtype=np.int64)
+    break_bgns = np.where(breaks, note_bgns, events_num + 1)
+    pedal_bgns = np.array([e[0] for e in pedal_events], dtype=np.int64)
+    pedal_fins = np.array([e[1] for e in pedal_events], dtype=np.int64)
+
+    # Maximum onset event of the first n notes, and minimum onset event of the 
+    # notes moving the comparison on from the n-th note
+    max_bgns = np.concatenate(([-1], np.maximum.accumulate(note_bgns)))
+    min_break_bgns = np.concatenate((np.minimum.accumulate(break_bgns[::-1])[::-1], 
+        [events_num + 1]))
+
+    # Parsing from event s, the first pedal is k and the first note compared 
+    # with pedal k is n. The notes from s are compared with the same pedals if 
+    # the notes compared with the former pedals begin before s, and the notes 
+    # left out before s do not move the comparison on
+    s = np.arange(events_num + 1)
+    k = np.searchsorted(pedal_bgns, s, side='left')
+    n = np.searchsorted(pointers, k, side='left')
+    restarts = (max_bgns[n] < s) & (min_break_bgns[n] >= s)
+
+    # Parsing from inside a pedal takes the pedal as begun later
+    if len(pedal_events) > 0:
+        inside = (k > 0) & (pedal_bgns[k - 1] < s) & (s < pedal_fins[k - 1])
+        restarts &= ~inside
+
+    return restarts
+
+
+def read_midi_events(hf):
+    """Read MIDI events from a packed hdf5 file. Use the structured event 
+    table and its active index if they have been packed, otherwise decode the 
+    event strings.
+
+    Args:
+      hf: h5py.File
+
+    Returns:
+      midi_events_time: (events_num,)
+      midi_events: (events_num,) structured array of midi_event_dtype | list of str
+      midi_events_active_bgn: (events_num + 1,) | None, see get_midi_events_active_bgn
+    """
+    if 'midi_event_table' in hf.keys():
+        midi_events = hf['midi_event_table'][:]
+        midi_events_time = midi_events['time']
+    else:
+        midi_events = [e.decode() for e in hf['midi_event'][:]]
+        midi_events_time = hf['midi_event_time'][:]
+
+    if 'midi_event_active_bgn' in hf.keys():
+        midi_events_active_bgn = hf['midi_event_active_bgn'][:]
+    else:
+        midi_events_active_bgn = None
+
+    return midi_events_time, midi_events, midi_events_active_bgn
+
+
+def get_target_cache_dtype(classes_num):
+    """Structured dtype of a frame of a target cache, see
+    TargetProcessor.process_to_cache."""
+    return np.dtype([
+        ('velocity', np.uint8, (classes_num,)),
+        ('onset_shift', np.int8, (classes_num,)),
+        ('offset_shift', np.int8, (classes_num,))])
+
+TARGET_CACHE_NO_ANCHOR = -128
+
+
+def get_target_cache_path(target_caches_dir, hdf5s_dir, hdf5_path):
+    """Path of the target cache of a packed hdf5 file, e.g.
+    target_caches/maestro/2004/a.npy for hdf5s/maestro/2004/a.h5."""
+    relative_path = os.path.relpath(hdf5_path, hdf5s_dir)
+    return os.path.join(target_caches_dir,
+        '{}.npy'.format(os.path.splitext(relative_path)[0]))
+
+
 class TargetProcessor(object):
     def __init__(self, segment_seconds, frames_per_second, begin_note, 
-        classes_num):
+        classes_num, compact_rolls=True):
         """Class for processing MIDI events to target.
 
         Args:
@@ -222,6 +685,8 @@ class TargetProcessor(object):
           frames_per_second: int
           begin_note: int, A0 MIDI note of a piano
           classes_num: int
+          compact_rolls: bool, True: binary and velocity rolls are uint8 and 
+            regression rolls are float32. False: all rolls are float64.
         """
         self.segment_seconds = segment_seconds
         self.frames_per_second = frames_per_second
@@ -229,8 +694,13 @@ class TargetProcessor(object):
         self.classes_num = classes_num
         self.max_piano_note = self.classes_num - 1
 
+        if compact_rolls:
+            (self.binary_dtype, self.regression_dtype) = (np.uint8, np.float32)
+        else:
+            (self.binary_dtype, self.regression_dtype) = (np.float64, np.float64)
+
     def process(self, start_time, midi_events_time, midi_events, 
-        extend_pedal=True, note_shift=0):
+        extend_pedal=True, note_shift=0, midi_events_active_bgn=None):
         """Process MIDI events of an audio segment to target for training, 
         includes: 
         1. Parse MIDI events
@@ -244,9 +714,13 @@ class TargetProcessor(object):
           midi_events: list of str, MIDI events of a recording, e.g.
             ['note_on channel=0 note=75 velocity=37 time=14',
              'control_change channel=0 control=64 value=54 time=20',
-             ...]
+             ...], or the same events as a structured array returned by 
+            midi_events_to_table, which is parsed without string operations
           extend_pedal, bool, True: Notes will be set to ON until pedal is 
             released. False: Ignore pedal events.
+          note_shift: int, number of semitones to shift notes
+          midi_events_active_bgn: None | (events_num + 1,), index returned by 
+            get_midi_events_active_bgn, calculated if None
 
         Returns:
           target_dict: {
@@ -275,118 +749,78 @@ class TargetProcessor(object):
         """
 
         # ------ 1. Parse MIDI events ------
-        # Search the begin index of a segment
-        for bgn_idx, event_time in enumerate(midi_events_time):
-            if event_time > start_time:
-                break
-        """E.g., start_time: 709.0, bgn_idx: 18003, event_time: 709.0146"""
+        (note_events, pedal_events, buffer_dict) = self.get_note_pedal_events(
+            start_time, midi_events_time, midi_events, extend_pedal,
+            midi_events_active_bgn)
 
-        # Search the end index of a segment
-        for fin_idx, event_time in enumerate(midi_events_time):
-            if event_time > start_time + self.segment_seconds:
-                break
-        """E.g., start_time: 709.0, bgn_idx: 18196, event_time: 719.0115"""
-
-        note_events = []
-        """E.g. [
-            {'midi_note': 51, 'onset_time': 696.63544, 'offset_time': 696.9948, 'velocity': 44}, 
-            {'midi_note': 58, 'onset_time': 696.99585, 'offset_time': 697.18646, 'velocity': 50}
-            ...]"""
-
-        pedal_events = []
-        """E.g. [
-            {'onset_time': 696.46875, 'offset_time': 696.62604}, 
-            {'onset_time': 696.8063, 'offset_time': 698.50836}, 
-            ...]"""
+        # Prepare targets
+        frames_num = int(round(self.segment_seconds * self.frames_per_second)) + 1
+        target_dict = self.get_empty_targets(frames_num)
 
-        buffer_dict = {}    # Used to store onset of notes to be paired with offsets
-        pedal_dict = {}     # Used to store onset of pedal to be paired with offset of pedal
+        # ------ 2. Get note targets ------
+        self.write_note_targets(target_dict, start_time, note_events, 
+            buffer_dict, note_shift)
 
-        # Backtrack bgn_idx to earlier indexes: ex_bgn_idx, which is used for 
-        # searching cross segment pedal and note events. E.g.: bgn_idx: 1149, 
-        # ex_bgn_idx: 981
-        _delta = int((fin_idx - bgn_idx) * 1.)  
-        ex_bgn_idx = max(bgn_idx - _delta, 0)
-        
-        for i in range(ex_bgn_idx, fin_idx):
-            # Parse MIDI messiage
-            attribute_list = midi_events[i].split(' ')
+        # ------ 3. Get pedal targets ------
+        self.write_pedal_targets(target_dict, start_time, pedal_events)
 
-            # Note
-            if attribute_list[0] in ['note_on', 'note_off']:
-                """E.g. attribute_list: ['note_on', 'channel=0', 'note=41', 'velocity=0', 'time=10']"""
+        self.get_regression_targets(target_dict)
 
-                midi_note = int(attribute_list[2].split('=')[1])
-                velocity = int(attribute_list[3].split('=')[1])
+        return target_dict, note_events, pedal_events
 
-                # Onset
-                if attribute_list[0] == 'note_on' and velocity > 0:
-                    buffer_dict[midi_note] = {
-                        'onset_time': midi_events_time[i], 
-                        'velocity': velocity}
+    def get_empty_targets(self, frames_num):
+        """Targets without note and pedal events. Regression rolls are 1 
+        before the shifts to onsets and offsets are written, see get_regression.
 
-                # Offset
-                else:
-                    if midi_note in buffer_dict.keys():
-                        note_events.append({
-                            'midi_note': midi_note, 
-                            'onset_time': buffer_dict[midi_note]['onset_time'], 
-                            'offset_time': midi_events_time[i], 
-                            'velocity': buffer_dict[midi_note]['velocity']})
-                        del buffer_dict[midi_note]
+        Args:
+          frames_num: int
 
-            # Pedal
-            elif attribute_list[0] == 'control_change' and attribute_list[2] == 'control=64':
-                """control=64 corresponds to pedal MIDI event. E.g. 
-                attribute_list: ['control_change', 'channel=0', 'control=64', 'value=45', 'time=43']"""
+        Returns:
+          target_dict: dict, see process
+        """
+        binary_dtype = self.binary_dtype
 
-                ped_value = int(attribute_list[3].split('=')[1])
-                if ped_value >= 64:
-                    if 'onset_time' not in pedal_dict:
-                        pedal_dict['onset_time'] = midi_events_time[i]
-                else:
-                    if 'onset_time' in pedal_dict:
-                        pedal_events.append({
-                            'onset_time': pedal_dict['onset_time'], 
-                            'offset_time': midi_events_time[i]})
-                        pedal_dict = {}
+        target_dict = {
+            'onset_roll': np.zeros((frames_num, self.classes_num), dtype=binary_dtype), 
+            'offset_roll': np.zeros((frames_num, self.classes_num), dtype=binary_dtype),
+            'reg_onset_roll': np.ones((frames_num, self.classes_num)), 
+            'reg_offset_roll': np.ones((frames_num, self.classes_num)),
+            'frame_roll': np.zeros((frames_num, self.classes_num), dtype=binary_dtype), 
+            'velocity_roll': np.zeros((frames_num, self.classes_num), dtype=binary_dtype), 
+            'mask_roll': np.ones((frames_num, self.classes_num), dtype=binary_dtype), 
+            'reg_pedal_onset_roll': np.ones(frames_num), 
+            'pedal_onset_roll': np.zeros(frames_num, dtype=binary_dtype), 
+            'pedal_offset_roll': np.zeros(frames_num, dtype=binary_dtype), 
+            'reg_pedal_offset_roll': np.ones(frames_num), 
+            'pedal_frame_roll': np.zeros(frames_num, dtype=binary_dtype)
+            }
+        """mask_roll is used for masking out cross segment notes. Regression 
+        rolls are calculated in float64 and cast at the end"""
 
-        # Add unpaired onsets to events
-        for midi_note in buffer_dict.keys():
-            note_events.append({
-                'midi_note': midi_note, 
-                'onset_time': buffer_dict[midi_note]['onset_time'], 
-                'offset_time': start_time + self.segment_seconds, 
-                'velocity': buffer_dict[midi_note]['velocity']})
+        return target_dict
 
-        # Add unpaired pedal onsets to data
-        if 'onset_time' in pedal_dict.keys():
-            pedal_events.append({
-                'onset_time': pedal_dict['onset_time'], 
-                'offset_time': start_time + self.segment_seconds})
+    def write_note_targets(self, target_dict, start_time, note_events, 
+        buffer_dict, note_shift, written_notes=None):
+        """Write note events to the note targets in place. Regression rolls are 
+        written with the shifts from the center of frames to onsets and offsets.
 
-        # Set notes to ON until pedal is released
-        if extend_pedal:
-            note_events = self.extend_pedal(note_events, pedal_events)
-        
-        # Prepare targets
-        frames_num = int(round(self.segment_seconds * self.frames_per_second)) + 1
-        onset_roll = np.zeros((frames_num, self.classes_num))
-        offset_roll = np.zeros((frames_num, self.classes_num))
-        reg_onset_roll = np.ones((frames_num, self.classes_num))
-        reg_offset_roll = np.ones((frames_num, self.classes_num))
-        frame_roll = np.zeros((frames_num, self.classes_num))
-        velocity_roll = np.zeros((frames_num, self.classes_num))
-        mask_roll = np.ones((frames_num, self.classes_num))
-        """mask_roll is used for masking out cross segment notes"""
-
-        pedal_onset_roll = np.zeros(frames_num)
-        pedal_offset_roll = np.zeros(frames_num)
-        reg_pedal_onset_roll = np.ones(frames_num)
-        reg_pedal_offset_roll = np.ones(frames_num)
-        pedal_frame_roll = np.zeros(frames_num)
+        Args:
+          target_dict: dict, see get_empty_targets
+          start_time: float, start time of a segment
+          note_events: list of dict, see process
+          buffer_dict: dict, unpaired note onsets, see get_note_pedal_events
+          note_shift: int, number of semitones to shift notes
+          written_notes: None | (classes_num,), bool, only the notes shifted to 
+            these piano notes are written, except for mask_roll
+        """
+        onset_roll = target_dict['onset_roll']
+        offset_roll = target_dict['offset_roll']
+        reg_onset_roll = target_dict['reg_onset_roll']
+        reg_offset_roll = target_dict['reg_offset_roll']
+        frame_roll = target_dict['frame_roll']
+        velocity_roll = target_dict['velocity_roll']
+        mask_roll = target_dict['mask_roll']
 
-        # ------ 2. Get note targets ------
         # Process note events to target
         for note_event in note_events:
             """note_event: e.g., {'midi_note': 60, 'onset_time': 722.0719, 'offset_time': 722.47815, 'velocity': 103}"""
@@ -397,8 +831,9 @@ class TargetProcessor(object):
             if 0 <= piano_note <= self.max_piano_note:
                 bgn_frame = int(round((note_event['onset_time'] - start_time) * self.frames_per_second))
                 fin_frame = int(round((note_event['offset_time'] - start_time) * self.frames_per_second))
+                written = written_notes is None or written_notes[piano_note]
 
-                if fin_frame >= 0:
+                if fin_frame >= 0 and written:
                     frame_roll[max(bgn_frame, 0) : fin_frame + 1, piano_note] = 1
 
                     offset_roll[fin_frame, piano_note] = 1
@@ -414,15 +849,10 @@ class TargetProcessor(object):
                         # Vector from the center of a frame to ground truth onset
                         reg_onset_roll[bgn_frame, piano_note] = \
                             (note_event['onset_time'] - start_time) - (bgn_frame / self.frames_per_second)
-                
-                    # Mask out segment notes
-                    else:
-                        mask_roll[: fin_frame + 1, piano_note] = 0
 
-        for k in range(self.classes_num):
-            """Get regression targets"""
-            reg_onset_roll[:, k] = self.get_regression(reg_onset_roll[:, k])
-            reg_offset_roll[:, k] = self.get_regression(reg_offset_roll[:, k])
+                # Mask out segment notes
+                if fin_frame >= 0 and bgn_frame < 0:
+                    mask_roll[: fin_frame + 1, piano_note] = 0
 
         # Process unpaired onsets to target
         for midi_note in buffer_dict.keys():
@@ -431,7 +861,21 @@ class TargetProcessor(object):
                 bgn_frame = int(round((buffer_dict[midi_note]['onset_time'] - start_time) * self.frames_per_second))
                 mask_roll[bgn_frame :, piano_note] = 0     
 
-        # ------ 3. Get pedal targets ------
+    def write_pedal_targets(self, target_dict, start_time, pedal_events):
+        """Write pedal events to the pedal targets in place, see 
+        write_note_targets.
+
+        Args:
+          target_dict: dict, see get_empty_targets
+          start_time: float, start time of a segment
+          pedal_events: list of dict, see process
+        """
+        pedal_onset_roll = target_dict['pedal_onset_roll']
+        pedal_offset_roll = target_dict['pedal_offset_roll']
+        reg_pedal_onset_roll = target_dict['reg_pedal_onset_roll']
+        reg_pedal_offset_roll = target_dict['reg_pedal_offset_roll']
+        pedal_frame_roll = target_dict['pedal_frame_roll']
+
         # Process pedal events to target
         for pedal_event in pedal_events:
             bgn_frame = int(round((pedal_event['onset_time'] - start_time) * self.frames_per_second))
@@ -444,25 +888,364 @@ class TargetProcessor(object):
                 reg_pedal_offset_roll[fin_frame] = \
                     (pedal_event['offset_time'] - start_time) - (fin_frame / self.frames_per_second)
 
-                if bgn_frame >= 0:
-                    pedal_onset_roll[bgn_frame] = 1
-                    reg_pedal_onset_roll[bgn_frame] = \
-                        (pedal_event['onset_time'] - start_time) - (bgn_frame / self.frames_per_second)
+                if bgn_frame >= 0:
+                    pedal_onset_roll[bgn_frame] = 1
+                    reg_pedal_onset_roll[bgn_frame] = \
+                        (pedal_event['onset_time'] - start_time) - (bgn_frame / self.frames_per_second)
+
+    def get_regression_targets(self, target_dict):
+        """Replace the shifts written to the regression rolls by regression 
+        targets of all classes and cast them in place, see get_regression."""
+        for key in ['reg_onset_roll', 'reg_offset_roll', 'reg_pedal_onset_roll', 
+            'reg_pedal_offset_roll']:
+            target_dict[key] = self.get_regression(target_dict[key])
+
+        self.cast_regression_rolls(target_dict)
+
+    def cast_regression_rolls(self, target_dict):
+        """Cast regression rolls of a target dict to self.regression_dtype in 
+        place."""
+        for key in ['reg_onset_roll', 'reg_offset_roll', 'reg_pedal_onset_roll', 
+            'reg_pedal_offset_roll']:
+            target_dict[key] = target_dict[key].astype(self.regression_dtype, copy=False)
+
+    def get_note_pedal_events(self, start_time, midi_events_time, midi_events,
+        extend_pedal=True, midi_events_active_bgn=None):
+        """Parse MIDI events of an audio segment to note and pedal events.
+        Unpaired onsets are released at the end of the segment.
+
+        Args:
+          start_time: float, start time of a segment
+          midi_events_time: list of float, times of MIDI events of a recording
+          midi_events: list of str | structured array, see process
+          extend_pedal, bool, True: Notes will be set to ON until pedal is
+            released. False: Ignore pedal events.
+          midi_events_active_bgn: None | (events_num + 1,), index returned by
+            get_midi_events_active_bgn, calculated if None
+
+        Returns:
+          note_events: list of dict, see process
+          pedal_events: list of dict, see process
+          buffer_dict: dict, unpaired note onsets, e.g. {
+            60: {'onset_time': 722.0719, 'velocity': 103}, ...}
+        """
+        if not (isinstance(midi_events, np.ndarray) and midi_events.dtype.names):
+            midi_events = midi_events_to_table(midi_events_time, midi_events)
+
+        if midi_events_active_bgn is None:
+            midi_events_active_bgn = get_midi_events_active_bgn(midi_events)
+
+        (note_events, pedal_events, buffer_dict, pedal_dict) = \
+            self.parse_midi_event_table(start_time, midi_events_time,
+                midi_events, midi_events_active_bgn)
+
+        # Add unpaired onsets to events
+        for midi_note in buffer_dict.keys():
+            note_events.append({
+                'midi_note': midi_note,
+                'onset_time': buffer_dict[midi_note]['onset_time'],
+                'offset_time': start_time + self.segment_seconds,
+                'velocity': buffer_dict[midi_note]['velocity']})
+
+        # Add unpaired pedal onsets to data
+        if 'onset_time' in pedal_dict.keys():
+            pedal_events.append({
+                'onset_time': pedal_dict['onset_time'],
+                'offset_time': start_time + self.segment_seconds})
+
+        # Set notes to ON until pedal is released
+        if extend_pedal:
+            note_events = self.extend_pedal(note_events, pedal_events)
+
+        return note_events, pedal_events, buffer_dict
+
+    def process_to_cache(self, midi_events_time, midi_events,
+        extend_pedal=True, midi_events_active_bgn=None):
+        """Process MIDI events of a whole recording to a target cache, which is
+        sliced by process_from_cache instead of writing note targets for each 
+        segment. self.segment_seconds is the duration of the recording.
+
+        Args:
+          midi_events_time: list of float, times of MIDI events of a recording
+          midi_events: list of str | structured array, see process
+          extend_pedal, bool
+          midi_events_active_bgn: None | (events_num + 1,)
+
+        Returns:
+          target_cache: (frames_num,), structured array of
+            get_target_cache_dtype(classes_num). Frame rolls are stored as
+            velocities, onset and offset rolls as quantized shifts from the
+            center of frames to onsets and offsets, TARGET_CACHE_NO_ANCHOR if
+            there is no onset or offset in a frame.
+        """
+        frames_num = int(round(self.segment_seconds * self.frames_per_second)) + 1
+
+        (note_events, _, _) = self.get_note_pedal_events(0, midi_events_time, 
+            midi_events, extend_pedal, midi_events_active_bgn)
+
+        target_cache = np.zeros(frames_num,
+            dtype=get_target_cache_dtype(self.classes_num))
+
+        for key in ['onset_shift', 'offset_shift']:
+            target_cache[key] = TARGET_CACHE_NO_ANCHOR
+
+        velocity_roll = target_cache['velocity']
+        onset_shift_roll = target_cache['onset_shift']
+        offset_shift_roll = target_cache['offset_shift']
+
+        # Note targets, the same as process
+        for note_event in note_events:
+            piano_note = np.clip(note_event['midi_note'] - self.begin_note, 0, self.max_piano_note)
+            bgn_frame = int(round(note_event['onset_time'] * self.frames_per_second))
+            fin_frame = int(round(note_event['offset_time'] * self.frames_per_second))
+
+            if fin_frame >= 0:
+                velocity_roll[max(bgn_frame, 0) : fin_frame + 1, piano_note] = note_event['velocity']
+                offset_shift_roll[fin_frame, piano_note] = self.quantize_shift(
+                    note_event['offset_time'] - fin_frame / self.frames_per_second)
+
+                if bgn_frame >= 0:
+                    onset_shift_roll[bgn_frame, piano_note] = self.quantize_shift(
+                        note_event['onset_time'] - bgn_frame / self.frames_per_second)
+
+        return target_cache
+
+    def process_from_cache(self, target_cache, start_time, midi_events_time, 
+        midi_events, note_shift=0, midi_events_active_bgn=None):
+        """Slice the targets of an audio segment from a target cache returned
+        by process_to_cache. MIDI events of the segment are parsed as process 
+        does, which is fast compared with writing the targets. Notes sounding 
+        at the segment end, which are paired and extended by pedals otherwise 
+        in the whole recording, notes shifted to the lowest or highest key, 
+        mask_roll and pedal targets are written from the parsed events. The 
+        targets are identical to process with extend_pedal, except that shifts 
+        from the center of frames sliced from the cache are quantized, see 
+        quantize_shift.
+
+        Args:
+          target_cache: (frames_num,), structured array returned by
+            process_to_cache, can be memory-mapped
+          start_time: float, start time of a segment
+          midi_events_time: list of float, times of MIDI events of a recording
+          midi_events: list of str | structured array, see process
+          note_shift: int, number of semitones to shift notes
+          midi_events_active_bgn: None | (events_num + 1,), see process
+
+        Returns:
+          target_dict: dict, see process
+          note_events: list of dict, see process
+          pedal_events: list of dict, see process
+        """
+        if not (isinstance(midi_events, np.ndarray) and midi_events.dtype.names):
+            midi_events = midi_events_to_table(midi_events_time, midi_events)
+
+        (note_events, pedal_events, buffer_dict) = self.get_note_pedal_events(
+            start_time, midi_events_time, midi_events, True, 
+            midi_events_active_bgn)
+
+        frames_num = int(round(self.segment_seconds * self.frames_per_second)) + 1
+        bgn_frame = int(round(start_time * self.frames_per_second))
+        end_time = start_time + self.segment_seconds
+
+        # Piano notes written from the parsed events
+        written_notes = np.zeros(self.classes_num, dtype=bool)
+
+        if bgn_frame == start_time * self.frames_per_second and \
+            0 <= bgn_frame and bgn_frame + frames_num <= len(target_cache):
+            segment = np.array(target_cache[bgn_frame : bgn_frame + frames_num])
+        else:
+            """Frames of the cache are not aligned with the segment, or the 
+            segment is not inside the recording"""
+            segment = np.zeros(frames_num, dtype=target_cache.dtype)
+            for key in ['onset_shift', 'offset_shift']:
+                segment[key] = TARGET_CACHE_NO_ANCHOR
+            written_notes[:] = True
+
+        if note_shift > 0:
+            written_notes[-1] = True
+        elif note_shift < 0:
+            written_notes[0] = True
+
+        for note_event in note_events:
+            piano_note = np.clip(note_event['midi_note'] - self.begin_note + note_shift, 0, self.max_piano_note)
+
+            if note_event['offset_time'] >= end_time:
+                written_notes[piano_note] = True
+
+            # Frames of the whole recording are rounded otherwise at ties
+            for key in ['onset_time', 'offset_time']:
+                if int(round((note_event[key] - start_time) * self.frames_per_second)) != \
+                    int(round(note_event[key] * self.frames_per_second)) - bgn_frame:
+                    written_notes[piano_note] = True
+
+        # Onsets after the segment end in the last frame
+        (bgn_idx, fin_idx) = np.searchsorted(midi_events_time, 
+            [end_time, end_time + 0.5 / self.frames_per_second], side='right')
+        onsets = midi_events[bgn_idx : fin_idx]
+        onsets = onsets[(onsets['type'] == MIDI_EVENT_NOTE_ON) & (onsets['value'] > 0)]
+        written_notes[np.clip(onsets['note'].astype(np.int64) - self.begin_note + note_shift, 
+            0, self.max_piano_note)] = True
+
+        # Notes of the other piano notes are sliced from the cache
+        velocity_roll = self.shift_notes(segment['velocity'], note_shift, 0)
+        onset_shift_roll = self.shift_notes(segment['onset_shift'], note_shift, TARGET_CACHE_NO_ANCHOR)
+        offset_shift_roll = self.shift_notes(segment['offset_shift'], note_shift, TARGET_CACHE_NO_ANCHOR)
+
+        velocity_roll[:, written_notes] = 0
+        onset_shift_roll[:, written_notes] = TARGET_CACHE_NO_ANCHOR
+        offset_shift_roll[:, written_notes] = TARGET_CACHE_NO_ANCHOR
+
+        target_dict = self.get_empty_targets(frames_num)
+        target_dict['velocity_roll'][:] = velocity_roll
+        target_dict['frame_roll'][:] = velocity_roll > 0
+
+        for (key, shift_roll) in [('onset', onset_shift_roll), ('offset', offset_shift_roll)]:
+            anchors = shift_roll != TARGET_CACHE_NO_ANCHOR
+            target_dict['{}_roll'.format(key)][:] = anchors
+            target_dict['reg_{}_roll'.format(key)][anchors] = self.dequantize_shift(shift_roll[anchors])
+
+        self.write_note_targets(target_dict, start_time, note_events, 
+            buffer_dict, note_shift, written_notes)
+
+        self.write_pedal_targets(target_dict, start_time, pedal_events)
+
+        self.get_regression_targets(target_dict)
+
+        return target_dict, note_events, pedal_events
+
+    def quantize_shift(self, shift):
+        """Quantize a shift from the center of a frame, which is within half a
+        frame, to int8. The error is at most 1 / (508 * frames_per_second)
+        seconds, i.e. 0.02 ms for 100 frames per second.
+        """
+        return np.clip(np.round(shift * 254 * self.frames_per_second), -127, 127).astype(np.int8)
+
+    def dequantize_shift(self, x):
+        return x / (254. * self.frames_per_second)
+
+    def shift_notes(self, x, note_shift, fill_value):
+        """Shift the piano roll columns by note_shift semitones.
+
+        Args:
+          x: (frames_num, classes_num)
+          note_shift: int
+          fill_value: value of the columns shifted in
+
+        Returns:
+          y: (frames_num, classes_num)
+        """
+        if note_shift == 0:
+            return x
+
+        y = np.full_like(x, fill_value)
+
+        if note_shift > 0:
+            y[:, note_shift :] = x[:, : -note_shift]
+        else:
+            y[:, : note_shift] = x[:, -note_shift :]
+
+        return y
+
+    def search_segment_events(self, start_time, midi_events_time, 
+        midi_events_active_bgn):
+        """Search the range of MIDI events to parse for a segment.
+
+        Args:
+          start_time: float, start time of a segment
+          midi_events_time: (events_num,), times of MIDI events of a recording
+          midi_events_active_bgn: (events_num + 1,), see get_midi_events_active_bgn
+
+        Returns:
+          ex_bgn_idx: int, first event to parse, backtracked from the segment 
+            begin to the onsets of notes and pedal active at the segment begin
+          fin_idx: int, the events to parse end before fin_idx
+        """
+        bgn_idx = np.searchsorted(midi_events_time, 
+            start_time - 0.5 / self.frames_per_second, side='left')
+        """E.g., start_time: 709.0, bgn_idx: 18003, event_time: 709.0146. 
+        Events in the half frame before start_time are rounded to frame 0, so 
+        the search begins at the earliest time rounded into the segment"""
+
+        fin_idx = np.searchsorted(midi_events_time, 
+            start_time + self.segment_seconds, side='right')
+        """E.g., start_time: 709.0, fin_idx: 18196, event_time: 719.0115"""
+
+        ex_bgn_idx = midi_events_active_bgn[bgn_idx]
+
+        return int(ex_bgn_idx), int(fin_idx)
+
+    def parse_midi_event_table(self, start_time, midi_events_time, 
+        midi_event_table, midi_events_active_bgn):
+        """Parse MIDI events around a segment to note and pedal events. Offsets 
+        of unpaired onsets are not set yet.
+
+        Args:
+          start_time: float, start time of a segment
+          midi_events_time: (events_num,), times of MIDI events of a recording
+          midi_event_table: (events_num,), structured array of midi_event_dtype
+          midi_events_active_bgn: (events_num + 1,), see get_midi_events_active_bgn
+
+        Returns:
+          note_events: list of dict, e.g. [
+            {'midi_note': 51, 'onset_time': 696.63544, 'offset_time': 696.9948, 'velocity': 44}, 
+            ...]
+          pedal_events: list of dict, e.g. [
+            {'onset_time': 696.46875, 'offset_time': 696.62604}, 
+            ...]
+          buffer_dict: dict, unpaired note onsets, e.g. {
+            60: {'onset_time': 722.0719, 'velocity': 103}, ...}
+          pedal_dict: dict, unpaired pedal onset, e.g. {'onset_time': 720.3}
+        """
+        (ex_bgn_idx, fin_idx) = self.search_segment_events(start_time, 
+            midi_events_time, midi_events_active_bgn)
+
+        note_events = []
+        pedal_events = []
+        buffer_dict = {}    # Used to store onset of notes to be paired with offsets
+        pedal_dict = {}     # Used to store onset of pedal to be paired with offset of pedal
+
+        types = midi_event_table['type'][ex_bgn_idx : fin_idx].tolist()
+        notes = midi_event_table['note'][ex_bgn_idx : fin_idx].tolist()
+        values = midi_event_table['value'][ex_bgn_idx : fin_idx].tolist()
+
+        for j in range(fin_idx - ex_bgn_idx):
+            i = ex_bgn_idx + j
 
-        # Get regresssion padal targets
-        reg_pedal_onset_roll = self.get_regression(reg_pedal_onset_roll)
-        reg_pedal_offset_roll = self.get_regression(reg_pedal_offset_roll)
+            # Note
+            if types[j] in [MIDI_EVENT_NOTE_ON, MIDI_EVENT_NOTE_OFF]:
+                midi_note = notes[j]
+                velocity = values[j]
 
-        target_dict = {
-            'onset_roll': onset_roll, 'offset_roll': offset_roll,
-            'reg_onset_roll': reg_onset_roll, 'reg_offset_roll': reg_offset_roll,
-            'frame_roll': frame_roll, 'velocity_roll': velocity_roll, 
-            'mask_roll': mask_roll, 'reg_pedal_onset_roll': reg_pedal_onset_roll, 
-            'pedal_onset_roll': pedal_onset_roll, 'pedal_offset_roll': pedal_offset_roll, 
-            'reg_pedal_offset_roll': reg_pedal_offset_roll, 'pedal_frame_roll': pedal_frame_roll
-            }
+                # Onset
+                if types[j] == MIDI_EVENT_NOTE_ON and velocity > 0:
+                    buffer_dict[midi_note] = {
+                        'onset_time': midi_events_time[i], 
+                        'velocity': velocity}
 
-        return target_dict, note_events, pedal_events
+                # Offset
+                else:
+                    if midi_note in buffer_dict.keys():
+                        note_events.append({
+                            'midi_note': midi_note, 
+                            'onset_time': buffer_dict[midi_note]['onset_time'], 
+                            'offset_time': midi_events_time[i], 
+                            'velocity': buffer_dict[midi_note]['velocity']})
+                        del buffer_dict[midi_note]
+
+            # Pedal
+            elif types[j] == MIDI_EVENT_CONTROL_CHANGE and notes[j] == 64:
+                ped_value = values[j]
+                if ped_value >= 64:
+                    if 'onset_time' not in pedal_dict:
+                        pedal_dict['onset_time'] = midi_events_time[i]
+                else:
+                    if 'onset_time' in pedal_dict:
+                        pedal_events.append({
+                            'onset_time': pedal_dict['onset_time'], 
+                            'offset_time': midi_events_time[i]})
+                        pedal_dict = {}
+
+        return note_events, pedal_events, buffer_dict, pedal_dict
 
     def extend_pedal(self, note_events, pedal_events):
         """Update the offset of all notes until pedal is released.
@@ -529,10 +1312,70 @@ class TargetProcessor(object):
         [1] Q. Kong, et al., High-resolution Piano Transcription with Pedals by 
         Regressing Onsets and Offsets Times, 2020.
 
+        Each frame is assigned to its nearest onset or offset (anchor) of the 
+        same class. All classes are processed at once, the output is identical 
+        to get_regression_loop applied to each column.
+
+        input:
+          input: (frames_num,) | (frames_num, classes_num)
+
+        Returns: (frames_num,) | (frames_num, classes_num), e.g., [0, 0, 0.1, 
+          0.3, 0.5, 0.7, 0.9, 0.9, 0.7, 0.5, 0.3, 0.1, 0, 0, ...]
+        """
+        if input.ndim == 2:
+            """Classes without anchors are all 0"""
+            columns = np.where(np.any(input < 0.5, axis=0))[0]
+
+            if len(columns) < input.shape[1]:
+                output = np.zeros_like(input)
+                if len(columns) > 0:
+                    output[:, columns] = self.get_regression(input[:, columns])
+                return output
+
+        step = 1. / self.frames_per_second
+        output = np.ones_like(input)
+        frames_num = input.shape[0]
+
+        t = np.arange(frames_num).reshape((frames_num,) + (1,) * (input.ndim - 1))
+        is_loct = input < 0.5
+
+        # Last anchor at or before t, -1 if none
+        prev_loct = np.maximum.accumulate(np.where(is_loct, t, -1), axis=0)
+
+        # First anchor after t, frames_num if none
+        next_loct = np.minimum.accumulate(
+            np.where(is_loct, t, frames_num)[::-1], axis=0)[::-1]
+        next_loct = np.concatenate((next_loct[1 :], 
+            np.full_like(next_loct[0 : 1], frames_num)), axis=0)
+
+        has_prev = prev_loct >= 0
+        has_next = next_loct < frames_num
+
+        """Frames before the first anchor and after the last anchor use that 
+        anchor. Between two anchors, the first half uses the previous anchor and 
+        the second half uses the next anchor, but is still shifted by the value 
+        of the previous anchor."""
+        value_loct = np.where(has_prev, prev_loct, next_loct)
+        anchor_loct = np.where(has_prev & has_next & 
+            (t >= (prev_loct + next_loct) // 2), next_loct, value_loct)
+
+        valid = has_prev | has_next
+        value = np.take_along_axis(input, np.clip(value_loct, 0, frames_num - 1), axis=0)
+        output[valid] = (step * (t - anchor_loct) - value)[valid]
+
+        output = np.clip(np.abs(output), 0., 0.05) * 20
+        output = (1. - output)
+
+        return output
+
+    def get_regression_loop(self, input):
+        """Reference implementation of get_regression looping over frames. 
+        Kept for regression tests.
+
         input:
           input: (frames_num,)
 
-        Returns: (frames_num,), e.g., [0, 0, 0.1, 0.3, 0.5, 0.7, 0.9, 0.9, 0.7, 0.5, 0.3, 0.1, 0, 0, ...]
+        Returns: (frames_num,)
         """
         step = 1. / self.frames_per_second
         output = np.ones_like(input)
@@ -838,7 +1681,59 @@ class RegressionPostProcessor(object):
 
     def get_binarized_output_from_regression(self, reg_output, threshold, neighbour):
         """Calculate binarized output and shifts of onsets or offsets from the
-        regression results.
+        regression results. Vectorized over frames and classes, the outputs are
+        identical to get_binarized_output_from_regression_loop.
+
+        Args:
+          reg_output: (frames_num, classes_num)
+          threshold: float
+          neighbour: int
+
+        Returns:
+          binary_output: (frames_num, classes_num)
+          shift_output: (frames_num, classes_num)
+        """
+        binary_output = np.zeros_like(reg_output)
+        shift_output = np.zeros_like(reg_output)
+        frames_num = reg_output.shape[0]
+
+        if frames_num <= 2 * neighbour:
+            return binary_output, shift_output
+
+        x = reg_output
+        fin = frames_num - neighbour
+
+        # Candidate x[n] for n in [neighbour, frames_num - neighbour)
+        peak = x[neighbour : fin] > threshold
+
+        # Monotonic in both sides. Written as "not less than" to treat NaN the
+        # same as is_monotonic_neighbour
+        for i in range(neighbour):
+            peak &= ~(x[neighbour - i : fin - i] < x[neighbour - i - 1 : fin - i - 1])
+            peak &= ~(x[neighbour + i : fin + i] < x[neighbour + i + 1 : fin + i + 1])
+
+        (frames, classes) = np.nonzero(peak)
+        frames += neighbour
+        binary_output[frames, classes] = 1
+
+        """See Section III-D in [1] for deduction.
+        [1] Q. Kong, et al., High-resolution Piano Transcription 
+        with Pedals by Regressing Onsets and Offsets Times, 2020."""
+        x_prev = x[frames - 1, classes]
+        x_curr = x[frames, classes]
+        x_next = x[frames + 1, classes]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift_output[frames, classes] = np.where(x_prev > x_next, 
+                (x_next - x_prev) / (x_curr - x_next) / 2, 
+                (x_next - x_prev) / (x_curr - x_prev) / 2)
+
+        return binary_output, shift_output
+
+    def get_binarized_output_from_regression_loop(self, reg_output, threshold, 
+        neighbour):
+        """Reference implementation of get_binarized_output_from_regression 
+        looping over classes and frames. Kept for regression tests.
 
         Args:
           reg_output: (frames_num, classes_num)
@@ -890,7 +1785,8 @@ class RegressionPostProcessor(object):
 
         return monotonic
 
-    def output_dict_to_detected_notes(self, output_dict):
+    def output_dict_to_detected_notes(self, output_dict, begin_frame=0, 
+        onset_range=None):
         """Postprocess output_dict to piano notes.
 
         Args:
@@ -902,6 +1798,10 @@ class RegressionPostProcessor(object):
             'frame_output': (frames_num, classes_num),
             'onset_output': (frames_num, classes_num),
             ...}
+          begin_frame: int, frame index of the first frame of output_dict in 
+            the whole recording
+          onset_range: None | (bgn, fin), only keep notes with onset frames in 
+            [bgn, fin) of the whole recording
 
         Returns:
           est_on_off_note_vels: (notes, 4), the four columns are onsets, offsets, 
@@ -910,29 +1810,27 @@ class RegressionPostProcessor(object):
              [11.9824, 12.5000, 33., 0.6892],
              ...]
         """
-        est_tuples = []
-        est_midi_notes = []
-        classes_num = output_dict['frame_output'].shape[-1]
- 
-        for piano_note in range(classes_num):
-            """Detect piano notes"""
-            est_tuples_per_note = note_detection_with_onset_offset_regress(
-                frame_output=output_dict['frame_output'][:, piano_note], 
-                onset_output=output_dict['onset_output'][:, piano_note], 
-                onset_shift_output=output_dict['onset_shift_output'][:, piano_note], 
-                offset_output=output_dict['offset_output'][:, piano_note], 
-                offset_shift_output=output_dict['offset_shift_output'][:, piano_note], 
-                velocity_output=output_dict['velocity_output'][:, piano_note], 
-                frame_threshold=self.frame_threshold)
-            
-            est_tuples += est_tuples_per_note
-            est_midi_notes += [piano_note + self.begin_note] * len(est_tuples_per_note)
+        # Detect piano notes of all classes
+        est_tuples = note_detection_with_onset_offset_regress_packed(
+            frame_output=output_dict['frame_output'], 
+            onset_output=output_dict['onset_output'], 
+            onset_shift_output=output_dict['onset_shift_output'], 
+            offset_output=output_dict['offset_output'], 
+            offset_shift_output=output_dict['offset_shift_output'], 
+            velocity_output=output_dict['velocity_output'], 
+            frame_threshold=self.frame_threshold)
+        """(notes, 6), the six columns are onset, offset, onset_shift, 
+        offset_shift, normalized_velocity and class index"""
+
+        est_midi_notes = est_tuples[:, 5] + self.begin_note    # (notes,)
 
-        est_tuples = np.array(est_tuples)   # (notes, 5)
-        """(notes, 5), the five columns are onset, offset, onset_shift, 
-        offset_shift and normalized_velocity"""
+        if begin_frame:
+            est_tuples[:, 0 : 2] += begin_frame
 
-        est_midi_notes = np.array(est_midi_notes) # (notes,)
+        if onset_range is not None:
+            indexes = (est_tuples[:, 0] >= onset_range[0]) & (est_tuples[:, 0] < onset_range[1])
+            est_tuples = est_tuples[indexes]
+            est_midi_notes = est_midi_notes[indexes]
 
         onset_times = (est_tuples[:, 0] + est_tuples[:, 2]) / self.frames_per_second
         offset_times = (est_tuples[:, 1] + est_tuples[:, 3]) / self.frames_per_second
@@ -964,14 +1862,13 @@ class RegressionPostProcessor(object):
         """
         frames_num = output_dict['pedal_frame_output'].shape[0]
         
-        est_tuples = pedal_detection_with_onset_offset_regress(
+        est_tuples = pedal_detection_with_onset_offset_regress_packed(
             frame_output=output_dict['pedal_frame_output'][:, 0], 
             offset_output=output_dict['pedal_offset_output'][:, 0], 
             offset_shift_output=output_dict['pedal_offset_shift_output'][:, 0], 
             frame_threshold=0.5)
-
-        est_tuples = np.array(est_tuples)
-        """(notes, 2), the two columns are pedal onsets and pedal offsets"""
+        """(pedals, 4), the four columns are pedal onsets, pedal offsets, 
+        onset shifts and offset shifts"""
         
         if len(est_tuples) == 0:
             return np.array([])
@@ -1034,6 +1931,212 @@ class RegressionPostProcessor(object):
         return pedal_events
 
 
+class StreamingRegressionPostProcessor(RegressionPostProcessor):
+    def __init__(self, frames_per_second, classes_num, onset_threshold, 
+        offset_threshold, frame_threshold, pedal_offset_threshold):
+        """Postprocess the output probabilities of a transcription model to 
+        MIDI events block by block. Frames are buffered only until the events 
+        that depend on them are finalized, so the memory does not grow with 
+        the length of a recording. The returned events are the same as 
+        RegressionPostProcessor applied to the concatenation of all blocks.
+
+        Args:
+          frames_per_second: int
+          classes_num: int
+          onset_threshold: float
+          offset_threshold: float
+          frame_threshold: float
+          pedal_offset_threshold: float
+        """
+        super(StreamingRegressionPostProcessor, self).__init__(frames_per_second, 
+            classes_num=classes_num, onset_threshold=onset_threshold, 
+            offset_threshold=offset_threshold, frame_threshold=frame_threshold, 
+            pedal_offset_threshold=pedal_offset_threshold)
+
+        self.note_horizon = 600
+        """A note is closed at most 600 frames after its onset, see 
+        note_detection_with_onset_offset_regress."""
+
+        self.neighbour = 4
+        """Largest neighbour used for binarizing regression outputs."""
+
+        self.pedal_frame_threshold = 0.5
+        self.pedal_disappear_frames = 10
+        """Same as pedal_detection_with_onset_offset_regress."""
+
+        self.reset()
+
+    def reset(self):
+        """Start a new recording."""
+        self.buffer_dict = {}
+        self.note_begin = 0     # Frame index of the first buffered note frame
+        self.pedal_begin = 0    # Frame index of the first buffered pedal frame
+        self.note_pointer = 0   # Notes with onsets before it are returned
+        self.pedal_pointer = 0  # Pedal detection restarts from it
+
+    def process(self, output_dict, final=False):
+        """Post process a block of model outputs following previous blocks.
+
+        Args:
+          output_dict: {
+            'reg_onset_output': (block_frames, classes_num), 
+            'reg_offset_output': (block_frames, classes_num), 
+            'frame_output': (block_frames, classes_num), 
+            'velocity_output': (block_frames, classes_num), 
+            'reg_pedal_onset_output': (block_frames, 1), 
+            'reg_pedal_offset_output': (block_frames, 1), 
+            'pedal_frame_output': (block_frames, 1)}
+          final: bool, True if this is the last block of a recording
+
+        Returns:
+          est_note_events: list of dict, finalized notes of this block
+          est_pedal_events: list of dict | None, finalized pedals of this block
+        """
+        for key in output_dict.keys():
+            if key in self.buffer_dict.keys():
+                self.buffer_dict[key] = np.concatenate(
+                    (self.buffer_dict[key], output_dict[key]), axis=0)
+            else:
+                self.buffer_dict[key] = output_dict[key]
+
+        est_on_off_note_vels = self.process_notes(final)
+        est_note_events = self.detected_notes_to_events(est_on_off_note_vels)
+
+        if 'reg_pedal_onset_output' in self.buffer_dict.keys():
+            est_pedal_on_offs = self.process_pedals(final)
+            est_pedal_events = self.detected_pedals_to_events(est_pedal_on_offs)
+        else:
+            est_pedal_events = None
+
+        if final:
+            self.reset()
+
+        return est_note_events, est_pedal_events
+
+    def process_notes(self, final):
+        """Detect the notes whose onsets and offsets are not affected by 
+        frames after the buffer.
+
+        Returns:
+          est_on_off_note_vels: (notes, 4)
+        """
+        note_keys = ['reg_onset_output', 'reg_offset_output', 'frame_output', 
+            'velocity_output']
+
+        fin_frame = self.note_begin + len(self.buffer_dict['frame_output'])
+
+        if final:
+            safe_frame = fin_frame
+        else:
+            safe_frame = fin_frame - self.note_horizon - self.neighbour - 1
+
+        if safe_frame <= self.note_pointer:
+            return np.zeros((0, 4), dtype=np.float32)
+
+        (onset_output, onset_shift_output) = \
+            self.get_binarized_output_from_regression(
+                reg_output=self.buffer_dict['reg_onset_output'], 
+                threshold=self.onset_threshold, neighbour=2)
+
+        (offset_output, offset_shift_output) = \
+            self.get_binarized_output_from_regression(
+                reg_output=self.buffer_dict['reg_offset_output'], 
+                threshold=self.offset_threshold, neighbour=4)
+
+        note_dict = {
+            'frame_output': self.buffer_dict['frame_output'], 
+            'velocity_output': self.buffer_dict['velocity_output'], 
+            'onset_output': onset_output, 
+            'onset_shift_output': onset_shift_output, 
+            'offset_output': offset_output, 
+            'offset_shift_output': offset_shift_output}
+
+        est_on_off_note_vels = self.output_dict_to_detected_notes(note_dict, 
+            begin_frame=self.note_begin, 
+            onset_range=(self.note_pointer, safe_frame))
+
+        self.note_pointer = safe_frame
+
+        # Keep the neighbours needed for binarizing onsets after note_pointer
+        begin = max(self.note_pointer - self.neighbour, self.note_begin)
+        for key in note_keys:
+            self.buffer_dict[key] = self.buffer_dict[key][begin - self.note_begin :]
+        self.note_begin = begin
+
+        return est_on_off_note_vels
+
+    def process_pedals(self, final):
+        """Detect the pedals that are closed inside the buffer. Pedal detection 
+        is a state machine, so the buffer is kept from the frame where its 
+        state is known to be reset.
+
+        Returns:
+          est_pedal_on_offs: (pedals, 2)
+        """
+        pedal_keys = ['reg_pedal_onset_output', 'reg_pedal_offset_output', 
+            'pedal_frame_output']
+
+        fin_frame = self.pedal_begin + len(self.buffer_dict['pedal_frame_output'])
+
+        if final:
+            safe_frame = fin_frame
+        else:
+            safe_frame = fin_frame - self.neighbour
+
+        if safe_frame - self.pedal_pointer < 2:
+            return np.zeros((0, 2), dtype=np.float32)
+
+        (pedal_offset_output, pedal_offset_shift_output) = \
+            self.get_binarized_output_from_regression(
+                reg_output=self.buffer_dict['reg_pedal_offset_output'], 
+                threshold=self.pedal_offset_threshold, neighbour=4)
+
+        bgn = self.pedal_pointer - self.pedal_begin
+        fin = safe_frame - self.pedal_begin
+        frame_output = self.buffer_dict['pedal_frame_output'][bgn : fin, 0]
+        offset_output = pedal_offset_output[bgn : fin, 0]
+
+        est_tuples = pedal_detection_with_onset_offset_regress_packed(
+            frame_output=frame_output, offset_output=offset_output, 
+            offset_shift_output=pedal_offset_shift_output[bgn : fin, 0], 
+            frame_threshold=self.pedal_frame_threshold)
+        """(pedals, 4), the four columns are pedal onsets, pedal offsets, 
+        onset shifts and offset shifts"""
+
+        # Find the frame where the detection state is reset after the last pedal
+        if len(est_tuples) > 0:
+            last_fin = int(est_tuples[-1, 1])
+            if offset_output[last_fin] == 1:
+                restart = last_fin
+            else:
+                restart = last_fin + self.pedal_disappear_frames
+        else:
+            restart = 0
+
+        # Restart from one frame before the next pedal onset candidate
+        x = frame_output[restart :]
+        onsets = np.where((x[1 :] >= self.pedal_frame_threshold) & (x[1 :] > x[: -1]))[0]
+        if len(onsets) > 0:
+            restart += onsets[0]
+        else:
+            restart = max(len(frame_output) - 1, restart)
+
+        est_tuples[:, 0 : 2] += self.pedal_pointer
+        self.pedal_pointer += restart
+
+        # Keep the neighbours needed for binarizing offsets after pedal_pointer
+        begin = max(self.pedal_pointer - self.neighbour, self.pedal_begin)
+        for key in pedal_keys:
+            self.buffer_dict[key] = self.buffer_dict[key][begin - self.pedal_begin :]
+        self.pedal_begin = begin
+
+        onset_times = (est_tuples[:, 0] + est_tuples[:, 2]) / self.frames_per_second
+        offset_times = (est_tuples[:, 1] + est_tuples[:, 3]) / self.frames_per_second
+        est_on_off = np.stack((onset_times, offset_times), axis=-1)
+        est_on_off = est_on_off.astype(np.float32)
+        return est_on_off
+
+
 class OnsetsFramesPostProcessor(object):
     def __init__(self, frames_per_second, classes_num):
         """Postprocess the Googl's onsets and frames system output. Only used
@@ -1211,33 +2314,23 @@ class OnsetsFramesPostProcessor(object):
              ...]
         """
 
-        est_tuples = []
-        est_midi_notes = []
-
-        for piano_note in range(self.classes_num):
-            
-            est_tuples_per_note = onsets_frames_note_detection(
-                frame_output=output_dict['frame_output'][:, piano_note], 
-                onset_output=output_dict['onset_output'][:, piano_note], 
-                offset_output=output_dict['offset_output'][:, piano_note], 
-                velocity_output=output_dict['velocity_output'][:, piano_note], 
-                threshold=frame_threshold)
-
-            est_tuples += est_tuples_per_note
-            est_midi_notes += [piano_note + self.begin_note] * len(est_tuples_per_note)
-
-        est_tuples = np.array(est_tuples)   # (notes, 3)
-        """(notes, 5), the five columns are onset, offset, onset_shift, 
-        offset_shift and normalized_velocity"""
+        est_tuples = onsets_frames_note_detection_packed(
+            frame_output=output_dict['frame_output'][:, 0 : self.classes_num], 
+            onset_output=output_dict['onset_output'][:, 0 : self.classes_num], 
+            offset_output=output_dict['offset_output'][:, 0 : self.classes_num], 
+            velocity_output=output_dict['velocity_output'][:, 0 : self.classes_num], 
+            threshold=frame_threshold)
+        """(notes, 6), the six columns are onset, offset, onset_shift, 
+        offset_shift, velocity and class index"""
 
-        est_midi_notes = np.array(est_midi_notes) # (notes,)
+        est_midi_notes = est_tuples[:, 5] + self.begin_note    # (notes,)
         
         if len(est_midi_notes) == 0:
             return []
         else:
             onset_times = est_tuples[:, 0] / self.frames_per_second
             offset_times = est_tuples[:, 1] / self.frames_per_second
-            velocities = est_tuples[:, 2]
+            velocities = est_tuples[:, 4]
         
             est_on_off_note_vels = np.stack((onset_times, offset_times, est_midi_notes, velocities), axis=-1)
             """(notes, 3), the three columns are onset_times, offset_times and velocity."""
@@ -1266,13 +2359,12 @@ class OnsetsFramesPostProcessor(object):
 
         frames_num = output_dict['pedal_frame_output'].shape[0]
         
-        est_tuples = onsets_frames_pedal_detection(
+        est_tuples = onsets_frames_pedal_detection_packed(
             frame_output=output_dict['pedal_frame_output'][:, 0], 
             offset_output=output_dict['reg_pedal_offset_output'][:, 0], 
             frame_threshold=0.5)
-
-        est_tuples = np.array(est_tuples)
-        """(notes, 2), the two columns are pedal onsets and pedal offsets"""
+        """(pedals, 4), the four columns are pedal onsets, pedal offsets, 
+        onset shifts and offset shifts"""
         
         if len(est_tuples) == 0:
             return np.array([])
@@ -1370,11 +2462,194 @@ class StatisticsContainer(object):
         self.statistics_dict = resume_statistics_dict
 
 
+class StreamResampler(object):
+    def __init__(self, sr_native, sr):
+        """Polyphase resampler for audio blocks. The output is the same as 
+        scipy.signal.resample_poly on the whole signal. Each block is 
+        resampled with enough neighbouring input samples to cover the FIR 
+        filter, starting from input samples aligned to the resampling ratio.
+
+        Args:
+          sr_native: int, input sample rate
+          sr: int, output sample rate
+        """
+        gcd = np.gcd(int(sr_native), int(sr))
+        self.up = int(sr) // gcd
+        self.down = int(sr_native) // gcd
+
+        half_len = 10 * max(self.up, self.down)
+        """Half length of the FIR filter of scipy.signal.resample_poly in 
+        upsampled samples"""
+
+        self.context = int(np.ceil((half_len / self.up + 1) / self.down)) * self.down
+        """Input samples needed on both sides of a block, a multiple of down"""
+
+        self.buffer = None
+        self.buffer_begin = 0   # Input index of the first buffered sample
+        self.pointer = 0    # Input index from which outputs are not returned
+
+    def process(self, x, final=False):
+        """Resample a block following previous blocks.
+
+        Args:
+          x: (..., block_samples)
+          final: bool, True if this is the last block
+
+        Returns:
+          y: (..., output_samples), output samples finalized by this block
+        """
+        if self.buffer is None:
+            self.buffer = x
+        else:
+            self.buffer = np.concatenate((self.buffer, x), axis=-1)
+
+        end = self.buffer_begin + self.buffer.shape[-1]
+
+        if final:
+            fin = end
+        else:
+            fin = (end - self.context) // self.down * self.down
+
+        if fin <= self.pointer:
+            return self.buffer[..., 0 : 0]
+
+        if self.up == self.down:
+            y = self.buffer[..., self.pointer - self.buffer_begin : fin - self.buffer_begin]
+
+        else:
+            bgn = max(self.pointer - self.context, 0)
+            chunk = self.buffer[..., bgn - self.buffer_begin : 
+                min(fin + self.context, end) - self.buffer_begin]
+
+            y = scipy.signal.resample_poly(chunk, self.up, self.down, axis=-1)
+            y_bgn = (self.pointer - bgn) * self.up // self.down
+
+            if final:
+                y = y[..., y_bgn :]
+            else:
+                y = y[..., y_bgn : y_bgn + (fin - self.pointer) * self.up // self.down]
+
+        self.pointer = fin
+
+        # Keep the context of the next block
+        begin = max(self.pointer - self.context, self.buffer_begin)
+        self.buffer = self.buffer[..., begin - self.buffer_begin :]
+        self.buffer_begin = begin
+
+        return y
+
+
+def load_audio_stream(path, sr=22050, mono=True, offset=0.0, duration=None,
+    dtype=np.float32, block_seconds=1., 
+    backends=[audioread.ffdec.FFmpegAudioFile]):
+    """Decode audio with ffmpeg and yield blocks resampled with a polyphase 
+    filter. Only a block of the native audio is held in memory at a time.
+
+    Args:
+      path: str
+      sr: int | None, None: keep the native sample rate
+      mono: bool
+      offset: float, start reading after this time (in seconds)
+      duration: float | None, only load up to this much audio (in seconds)
+      dtype: numeric type
+      block_seconds: float, duration of decoded audio resampled at a time
+      backends: list of audioread backends
+
+    Yields:
+      y: (block_samples,) if mono else (channels, block_samples)
+    """
+    with audioread.audio_open(os.path.realpath(path), backends=backends) as input_file:
+        sr_native = input_file.samplerate
+        n_channels = input_file.channels
+
+        s_start = int(np.round(sr_native * offset)) * n_channels
+
+        if duration is None:
+            s_end = np.inf
+        else:
+            s_end = s_start + (int(np.round(sr_native * duration))
+                               * n_channels)
+
+        if sr is None:
+            resampler = None
+        else:
+            resampler = StreamResampler(sr_native, sr)
+
+        block_samples = int(sr_native * block_seconds) * n_channels
+        frames = []
+        frames_len = 0
+        n = 0
+
+        for frame in input_file:
+            frame = librosa.core.audio.util.buf_to_float(frame, dtype=dtype)
+            n_prev = n
+            n = n + len(frame)
+
+            if n < s_start:
+                continue
+
+            if s_end < n_prev:
+                break
+
+            if s_end < n:
+                frame = frame[:s_end - n_prev]
+
+            if n_prev <= s_start <= n:
+                frame = frame[(s_start - n_prev):]
+
+            frames.append(frame)
+            frames_len += len(frame)
+
+            if frames_len >= block_samples:
+                y = np.concatenate(frames)
+
+                # Keep the samples of an incomplete multi-channel frame
+                remainder = len(y) % n_channels
+                frames = [y[len(y) - remainder :]]
+                frames_len = remainder
+                y = y[: len(y) - remainder]
+
+                y = _process_audio_block(y, n_channels, mono, resampler, final=False)
+                yield np.ascontiguousarray(y, dtype=dtype)
+
+        if frames:
+            y = np.concatenate(frames)
+        else:
+            y = np.zeros(0, dtype=dtype)
+
+        y = _process_audio_block(y, n_channels, mono, resampler, final=True)
+        yield np.ascontiguousarray(y, dtype=dtype)
+
+
+def _process_audio_block(y, n_channels, mono, resampler, final):
+    """Deinterleave, downmix and resample a block of decoded audio."""
+    y = y[: len(y) // n_channels * n_channels]
+
+    if n_channels > 1:
+        y = y.reshape((-1, n_channels)).T
+        if mono:
+            y = librosa.core.audio.to_mono(y)
+
+    if resampler is not None:
+        y = resampler.process(y, final=final)
+
+    return y
+
+
 def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
     dtype=np.float32, res_type='kaiser_best', 
     backends=[audioread.ffdec.FFmpegAudioFile]):
     """Load audio. Copied from librosa.core.load() except that ffmpeg backend is 
-    always used in this function."""
+    always used in this function. 
+
+    res_type: 'kaiser_best' | 'kaiser_fast' | ... are resampled with librosa 
+    after the whole file is decoded. 'polyphase' is much faster and decodes 
+    and resamples block by block into a preallocated buffer, see 
+    load_audio_stream."""
+
+    if res_type == 'polyphase':
+        return _load_audio_polyphase(path, sr=sr, mono=mono, offset=offset, 
+            duration=duration, dtype=dtype, backends=backends)
 
     y = []
     with audioread.audio_open(os.path.realpath(path), backends=backends) as input_file:
@@ -1433,4 +2708,43 @@ def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
     # Final cleanup for dtype and contiguity
     y = np.ascontiguousarray(y, dtype=dtype)
 
-    return (y, sr)
\ No newline at end of file
+    return (y, sr)
+
+
+def _load_audio_polyphase(path, sr, mono, offset, duration, dtype, backends):
+    """Load audio with load_audio_stream into a preallocated buffer."""
+    with audioread.audio_open(os.path.realpath(path), backends=backends) as input_file:
+        sr_native = input_file.samplerate
+        n_channels = input_file.channels
+        total_seconds = input_file.duration
+
+    if sr is None:
+        sr = sr_native
+
+    if duration is not None:
+        total_seconds = min(total_seconds - offset, duration)
+    else:
+        total_seconds -= offset
+
+    samples_num = max(int(np.ceil(total_seconds * sr)), 0)
+
+    if mono or n_channels == 1:
+        y = np.zeros(samples_num, dtype=dtype)
+    else:
+        y = np.zeros((n_channels, samples_num), dtype=dtype)
+
+    pointer = 0
+    for block in load_audio_stream(path, sr=sr, mono=mono, offset=offset, 
+        duration=duration, dtype=dtype, backends=backends):
+
+        block_len = block.shape[-1]
+
+        if pointer + block_len > y.shape[-1]:
+            """The duration reported by the decoder can be slightly short"""
+            pad_width = [(0, 0)] * (y.ndim - 1) + [(0, pointer + block_len - y.shape[-1])]
+            y = np.pad(y, pad_width, mode='constant')
+
+        y[..., pointer : pointer + block_len] = block
+        pointer += block_len
+
+    return (y[..., 0 : pointer], sr)